@@ -0,0 +1,119 @@
+import logging
+import mimetypes
+import os
+import zipfile
+from attachment_buffer import AttachmentBuffer
+import config
+
+logger = logging.getLogger(__name__)
+
+# Members are decompressed in chunks of this size
+READ_CHUNK_SIZE = 1024 * 1024
+
+# ZIP flag bits: member is encrypted, member name is UTF-8
+FLAG_ENCRYPTED = 0x1
+FLAG_UTF8 = 0x800
+
+def is_archive(mime_type):
+    return mime_type in config.ARCHIVE_MIME_TYPES
+
+def _member_name(info):
+    """Decode a member name; archives made on Windows in Taiwan store Big5 without the UTF-8 flag."""
+    if info.flag_bits & FLAG_UTF8:
+        return info.filename
+    try:
+        raw = info.filename.encode('cp437')
+    except UnicodeEncodeError:
+        return info.filename
+    for encoding in ('utf-8', 'big5'):
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return info.filename
+
+def supported_members(zf):
+    """Return (info, name, mime_type) for the members worth extracting.
+
+    Raises:
+        ValueError: If the archive exceeds ARCHIVE_MAX_MEMBERS, ARCHIVE_MAX_RATIO
+            or ARCHIVE_MAX_TOTAL_SIZE, i.e. is likely a zip bomb
+    """
+    infos = [info for info in zf.infolist() if not info.is_dir()]
+    if len(infos) > config.ARCHIVE_MAX_MEMBERS:
+        raise ValueError(f"too many members ({len(infos)})")
+
+    # zipfile stops reading a member at its declared size, so the declared
+    # sizes bound what extraction can write
+    uncompressed = sum(info.file_size for info in infos)
+    compressed = sum(info.compress_size for info in infos)
+    if uncompressed > config.ARCHIVE_MAX_RATIO * max(compressed, 1):
+        raise ValueError(f"compression ratio {uncompressed / max(compressed, 1):.0f} too high")
+
+    members = []
+    total = 0
+    for info in infos:
+        name = _member_name(info)
+        mime_type, _ = mimetypes.guess_type(name)
+        if mime_type not in config.SUPPORTED_MIME_TYPES:
+            continue
+        if info.flag_bits & FLAG_ENCRYPTED:
+            logger.warning(f"Skipping encrypted archive member: {name}")
+            continue
+        if info.file_size > config.MAX_FILE_SIZE:
+            logger.warning(f"Skipping oversized archive member: {name} ({info.file_size} bytes)")
+            continue
+        total += info.file_size
+        if total > config.ARCHIVE_MAX_TOTAL_SIZE:
+            raise ValueError(f"members exceed {config.ARCHIVE_MAX_TOTAL_SIZE} bytes uncompressed")
+        members.append((info, name, mime_type))
+    return members
+
+def _extract(zf, info):
+    """Decompress one member into its own sealed AttachmentBuffer."""
+    buffer = AttachmentBuffer(size_hint=info.file_size)
+    try:
+        with zf.open(info) as member:
+            while True:
+                chunk = member.read(READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                buffer.write(chunk)
+        return buffer.seal()
+    except Exception:
+        buffer.close()
+        raise
+
+def iter_members(buffer, attachment):
+    """Yield the supported members of a ZIP attachment one at a time.
+
+    A member is decompressed only when the iteration reaches it, into its
+    own buffer that spills to disk above SPOOL_MAX_MEMORY, so the archive is
+    never unpacked as a whole. The caller closes each yielded buffer.
+
+    Args:
+        buffer (AttachmentBuffer): The downloaded archive
+        attachment (dict): The archive's attachment descriptor
+
+    Yields:
+        tuple: (member attachment descriptor, AttachmentBuffer); the descriptor
+            keeps the archive's ids and adds the raw member name as 'member'
+
+    Raises:
+        ValueError: If the archive is corrupt or exceeds the zip bomb limits
+    """
+    try:
+        zf = zipfile.ZipFile(buffer.open())
+    except zipfile.BadZipFile as e:
+        raise ValueError(f"not a valid ZIP file: {str(e)}")
+
+    with zf:
+        for info, name, mime_type in supported_members(zf):
+            member = dict(attachment, filename=os.path.basename(name), mimeType=mime_type,
+                          size=info.file_size, member=info.filename)
+            yield member, _extract(zf, info)
+
+def extract_member(buffer, member):
+    """Return the member with raw name `member` as a sealed AttachmentBuffer."""
+    with zipfile.ZipFile(buffer.open()) as zf:
+        return _extract(zf, zf.getinfo(member))
@@ -0,0 +1,125 @@
+import io
+import mmap
+import os
+import tempfile
+import config
+
+class _MemoryviewReader(io.RawIOBase):
+    """Seekable raw reader over a memoryview, copying only into the caller's buffer."""
+
+    def __init__(self, view):
+        self._view = view
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        # Allocate only what is left rather than the full requested size
+        end = len(self._view) if size is None or size < 0 else self._pos + size
+        chunk = bytes(self._view[self._pos:end])
+        self._pos += len(chunk)
+        return chunk
+
+    def readinto(self, b):
+        chunk = self._view[self._pos:self._pos + len(b)]
+        n = len(chunk)
+        b[:n] = chunk
+        self._pos += n
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = len(self._view) + offset
+        self._pos = max(0, self._pos)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+class AttachmentBuffer:
+    """A downloaded attachment shared read-only by the OCR and upload stages.
+
+    Small attachments live in a preallocated bytearray; larger ones are
+    written to a named temporary file and memory-mapped. Either way `view` is a memoryview of the
+    one stored copy, `open()` gives independent readers over it, and `path`
+    lets external tools such as pdftoppm read the file directly.
+    """
+
+    def __init__(self, size_hint=0):
+        if size_hint > config.SPOOL_MAX_MEMORY:
+            self._file = tempfile.NamedTemporaryFile(prefix='gmail_helper_', delete=False)
+            self.path = self._file.name
+            self._data = None
+        else:
+            # Preallocate so that appending never reallocates and copies
+            self._file = None
+            self.path = None
+            self._data = bytearray(size_hint)
+        self._size = 0
+        self._mmap = None
+        self.view = None
+
+    def write(self, data):
+        if self._file is not None:
+            self._size += self._file.write(data)
+            return len(data)
+        end = self._size + len(data)
+        if end > len(self._data):
+            self._data.extend(bytes(end - len(self._data)))
+        self._data[self._size:end] = data
+        self._size = end
+        return len(data)
+
+    def tell(self):
+        return self._size
+
+    def seal(self):
+        """Finish writing and expose the contents as a read-only memoryview."""
+        if self._file is not None:
+            self._file.flush()
+            if self._size:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self._mmap)
+            else:
+                self.view = memoryview(b'')
+        else:
+            self.view = memoryview(self._data)[:self._size].toreadonly()
+        return self
+
+    def __len__(self):
+        return self._size
+
+    def open(self):
+        """Return a new seekable reader positioned at the start of the data."""
+        return _MemoryviewReader(self.view)
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._data = None
+        if self._file is None:
+            return
+        self._file.close()
+        if self.path:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,178 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from rate_limit import RateLimiter
+from logging_setup import log_context
+import config
+
+logger = logging.getLogger(__name__)
+
+class ThreadFolderCoordinator:
+    """In-process counterpart of the distributed brokers' folder methods.
+
+    Lets backfill threads share folder ids so that two windows filing into
+    the same month never create the same folder twice.
+    """
+
+    def __init__(self):
+        self._folders = {}
+        self._lock = threading.Lock()
+
+    def get_folder(self, key):
+        return self._folders.get(key)
+
+    def set_folder(self, key, folder_id):
+        self._folders[key] = folder_id
+
+    @contextmanager
+    def folder_lock(self, key):
+        with self._lock:
+            yield
+
+class BackfillCheckpoint:
+    """Per-window backfill results, persisted as JSON so an import can resume.
+
+    Windows are keyed by 'YYYY-MM-DD_YYYY-MM-DD' and marked done only when
+    every email in them was processed; partial windows run again on resume.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._windows = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self._windows = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"無法讀取回填檢查點，重新開始: {str(e)}")
+
+    def is_done(self, key):
+        return self._windows.get(key, {}).get('status') == 'done'
+
+    def record(self, key, result, seconds):
+        with self._lock:
+            self._windows[key] = dict(result or {}, seconds=round(seconds, 1),
+                                      status='done' if result and result['processed'] == result['emails'] else 'partial')
+            self._save()
+
+    def _save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._windows, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error(f"無法儲存回填檢查點: {str(e)}")
+
+def date_windows(start, end, window_days):
+    """Split [start, end) into consecutive windows of `window_days` days."""
+    windows = []
+    after = start
+    while after < end:
+        before = min(after + timedelta(days=window_days), end)
+        windows.append((after, before))
+        after = before
+    return windows
+
+def window_key(after, before):
+    return f"{after:%Y-%m-%d}_{before:%Y-%m-%d}"
+
+def run_backfill(start, end=None, window_days=None, workers=None, checkpoint_file=None):
+    """Process a historical date range window by window in parallel threads.
+
+    Each thread owns its Gmail and Drive clients, since the HTTP clients are
+    not thread-safe; the document processor, sender profiles, folder ids and
+    the per-API rate limiters are shared so the limits hold globally. Sharing
+    the document processor also lets the NER fallback of documents from
+    different windows run together in nlp.pipe batches (see NerBatcher).
+
+    Args:
+        start (datetime): First day to import
+        end (datetime): Day after the last one to import, defaults to tomorrow
+        window_days (int): Days per window, defaults to BACKFILL_WINDOW_DAYS
+        workers (int): Parallel windows, defaults to BACKFILL_WORKERS
+        checkpoint_file (str): Defaults to BACKFILL_CHECKPOINT_FILE
+
+    Returns:
+        dict: Counts of windows done, skipped, partial and emails processed
+    """
+    from main import GmailAttachmentProcessor
+    from gmail_service import GmailService
+    from drive_service import DriveService
+
+    end = end or datetime.combine(datetime.now().date() + timedelta(days=1), datetime.min.time())
+    workers = workers or config.BACKFILL_WORKERS
+    checkpoint = BackfillCheckpoint(checkpoint_file or config.BACKFILL_CHECKPOINT_FILE)
+
+    windows = date_windows(start, end, window_days or config.BACKFILL_WINDOW_DAYS)
+    pending = [w for w in windows if not checkpoint.is_done(window_key(*w))]
+    summary = {'windows': len(windows), 'skipped': len(windows) - len(pending),
+               'done': 0, 'partial': 0, 'emails': 0, 'processed': 0}
+    logger.info(f"回填 {start:%Y-%m-%d} 至 {end:%Y-%m-%d}: 共 {len(windows)} 個區間，"
+                f"{summary['skipped']} 個已完成，以 {workers} 個執行緒處理")
+
+    gmail_limiter = RateLimiter(config.GMAIL_RATE_LIMIT)
+    drive_limiter = RateLimiter(config.DRIVE_RATE_LIMIT)
+    coordinator = ThreadFolderCoordinator()
+    # Built up front so the token files are refreshed once, not raced on by threads;
+    # supplies the document processor, sender profiles and single-flight every thread shares
+    shared = GmailAttachmentProcessor(
+        gmail_service=GmailService(rate_limiter=gmail_limiter),
+        drive_service=DriveService(folder_coordinator=coordinator, rate_limiter=drive_limiter)
+    )
+    if config.DRIVE_INDEX:
+        # Synced once here; every thread's DriveService shares the same index
+        shared.drive_service.sync_index()
+    local = threading.local()
+    build_lock = threading.Lock()
+
+    def processor():
+        if not hasattr(local, 'processor'):
+            with build_lock:
+                local.processor = GmailAttachmentProcessor(
+                    gmail_service=GmailService(rate_limiter=gmail_limiter),
+                    drive_service=DriveService(folder_coordinator=coordinator, rate_limiter=drive_limiter,
+                                               index=shared.drive_service.index),
+                    doc_processor=shared.doc_processor,
+                    sender_profiles=shared.sender_profiles,
+                    single_flight=shared.single_flight
+                )
+        return local.processor
+
+    def process_window(window):
+        started = time.monotonic()
+        try:
+            with log_context(window=window_key(*window)):
+                result = processor().process_emails(after=window[0], before=window[1])
+        except Exception as e:
+            logger.error(f"回填區間 {window_key(*window)} 發生錯誤: {str(e)}")
+            result = None
+        checkpoint.record(window_key(*window), result, time.monotonic() - started)
+        return result
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='backfill') as executor:
+        futures = {executor.submit(process_window, window): window for window in pending}
+        for finished, future in enumerate(as_completed(futures), 1):
+            window, result = futures[future], future.result()
+            if result and result['processed'] == result['emails']:
+                summary['done'] += 1
+            else:
+                summary['partial'] += 1
+            if result:
+                summary['emails'] += result['emails']
+                summary['processed'] += result['processed']
+
+            elapsed = time.monotonic() - started
+            eta = timedelta(seconds=int(elapsed / finished * (len(pending) - finished)))
+            logger.info(f"回填進度 {finished}/{len(pending)} ({window_key(*window)}): "
+                        f"已處理 {summary['processed']}/{summary['emails']} 封郵件，預估剩餘 {eta}")
+
+    logger.info(f"回填完成: {summary}")
+    return summary
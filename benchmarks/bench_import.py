@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""量測 run.py 的冷啟動匯入時間
+
+以全新的子程序執行 `python -X importtime -c "import run"`，解析 stderr 中每個模組
+的累計匯入時間，列出總時間與最慢的模組。重量級函式庫（Vision、spaCy、PyMuPDF、
+pdf2image、PIL、googleapiclient.discovery）應延後到第一次使用時才載入；若它們出現
+在匯入清單中，或總時間超過 --max-ms，結束碼為 1，可用於 CI。
+
+使用方式：
+    python benchmarks/bench_import.py [--module run] [--top 15] [--max-ms 300] [--repeat 3]
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Loaded lazily by the stage that needs them; none may be imported at startup
+HEAVY_MODULES = [
+    'google.cloud.vision',
+    'spacy',
+    'fitz',
+    'pdf2image',
+    'PIL.Image',
+    'googleapiclient.discovery',
+    'google_auth_oauthlib.flow',
+]
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+def measure(module):
+    """Import `module` in a fresh interpreter and return {name: cumulative_us} in import order."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    times = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            times[match.group(4)] = int(match.group(2))
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='run', help='要匯入的模組（預設 run）')
+    parser.add_argument('--top', type=int, default=15, help='列出最慢的模組數')
+    parser.add_argument('--max-ms', type=float, help='總匯入時間上限（毫秒），超過時結束碼為 1')
+    parser.add_argument('--repeat', type=int, default=3, help='重複次數，取最快的一次')
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(max(1, args.repeat))]
+    times = min(runs, key=lambda t: t.get(args.module, 0))
+    total_ms = times.get(args.module, 0) / 1000
+
+    print(f"import {args.module}: {total_ms:.1f} ms（{len(times)} 個模組，{len(runs)} 次中最快）")
+    print(f"\n最慢的 {args.top} 個模組（累計毫秒）:")
+    for name, cumulative in sorted(times.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {cumulative / 1000:8.1f}  {name}")
+
+    failed = False
+    eager = [name for name in HEAVY_MODULES if name in times]
+    if eager:
+        failed = True
+        print(f"\n啟動時載入了重量級模組: {', '.join(eager)}")
+    if args.max_ms is not None and total_ms > args.max_ms:
+        failed = True
+        print(f"\n匯入時間 {total_ms:.1f} ms 超過上限 {args.max_ms:.1f} ms")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""比較附件下載 → OCR → 上傳流程的記憶體峰值
+
+舊流程：完整 base64 解碼成 bytes，再以 io.BytesIO 複製一份上傳。
+新流程：分段解碼到 AttachmentBuffer，OCR 與上傳共用同一份資料。
+
+使用方式：
+    python benchmarks/bench_memory.py [--sizes 1 4 8]
+"""
+import argparse
+import base64
+import io
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from gmail_service import GmailService
+
+class _FakeRequest:
+    def __init__(self, payload):
+        self._payload = payload
+
+    def execute(self):
+        return {'size': self._payload['size'], 'data': self._payload['data']}
+
+class _FakeGmailApi:
+    """Stands in for the Gmail client: attachments().get() returns canned base64 data."""
+
+    def __init__(self, payload):
+        self._payload = payload
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def attachments(self):
+        return self
+
+    def get(self, **kwargs):
+        return _FakeRequest(self._payload)
+
+def _read_in_chunks(fh, chunk_size):
+    # Mirrors MediaIoBaseUpload, which reads `chunksize` bytes per request
+    total = 0
+    while True:
+        chunk = fh.read(chunk_size)
+        if not chunk:
+            return total
+        total += len(chunk)
+
+def legacy_path(payload):
+    """The original data path: full decode, BytesIO copy, whole-file upload read."""
+    attachment = _FakeRequest(payload).execute()
+    file_data = base64.urlsafe_b64decode(attachment['data'])
+    del attachment
+    ocr_input = file_data
+    fh = io.BytesIO(file_data)
+    # MediaIoBaseUpload's default chunk size (100MB) reads the whole file at once
+    uploaded = _read_in_chunks(fh, 100 * 1024 * 1024)
+    return len(ocr_input), uploaded
+
+def buffer_path(payload):
+    """The buffered data path used by GmailAttachmentProcessor."""
+    service = GmailService.__new__(GmailService)
+    service.service = _FakeGmailApi(payload)
+    with service.download_attachment_stream('msg', 'att') as buffer:
+        ocr_input = buffer.view
+        uploaded = _read_in_chunks(buffer.open(), config.UPLOAD_CHUNK_SIZE)
+        size = len(ocr_input)
+        del ocr_input
+        return size, uploaded
+
+def measure(func, payload):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    result = func(payload)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=float, nargs='+', default=[0.5, 1, 4, 8],
+                        help='附件大小（MB）')
+    args = parser.parse_args()
+
+    print(f"{'size (MB)':>10} {'legacy peak (MB)':>18} {'buffer peak (MB)':>18} {'reduction':>10}")
+    for size_mb in args.sizes:
+        raw = os.urandom(int(size_mb * 1024 * 1024))
+        payload = {'size': len(raw), 'data': base64.urlsafe_b64encode(raw).decode('ascii')}
+        del raw
+
+        (legacy_size, _), legacy_peak = measure(legacy_path, payload)
+        (buffer_size, _), buffer_peak = measure(buffer_path, payload)
+        assert legacy_size == buffer_size
+
+        reduction = 1 - buffer_peak / legacy_peak
+        print(f"{size_mb:>10.1f} {legacy_peak / 2**20:>18.2f} {buffer_peak / 2**20:>18.2f} {reduction:>10.0%}")
+
+    print("\n峰值不含 base64 回應字串本身，也不含 Vision 請求內的複本（兩種流程相同）。")
+    print("磁碟暫存的附件以 mmap 讀取，屬於檔案快取而非 Python 堆積；PDF 由 pdftoppm 直接讀取檔案路徑。")
+
+if __name__ == '__main__':
+    main()
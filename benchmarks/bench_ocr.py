@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""比較 OCR 引擎的吞吐量、延遲與擷取結果
+
+對語料目錄中的每個 PDF／影像，先以 _preprocess_image 前處理所有頁面，再依序以每個
+指定的 OCR 引擎（vision、tesseract 或 auto）平行辨識，量測每秒頁數與每頁延遲，並列出
+各引擎實際處理的頁數。若存在同名的 .json 檔（例如 invoice.pdf → invoice.json），
+則以其內容為正確答案比較各引擎的欄位正確率。未指定引擎時比較本機可用的引擎：
+安裝 Tesseract 即可在內附語料（tests/data）上比較，不需要網路與 Cloud Vision 憑證；
+有 credentials.json 時一併比較 Cloud Vision。
+
+使用方式：
+    python benchmarks/bench_ocr.py [corpus_dir] [--backend tesseract vision] [--threads 8]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from document_processor import DocumentProcessor
+from ocr_backends import OcrRouter
+from bench_preprocess import DEFAULT_CORPUS, available_backends, iter_pages, extract, field_accuracy
+
+def run_backend(backend, documents, threads):
+    """Recognize every page with one backend; returns (results, seconds, router metrics)."""
+    router = OcrRouter(mode=backend)
+    pages = [page for _, doc_pages in documents for page in doc_pages]
+
+    def recognize(page):
+        start = time.perf_counter()
+        text = router.recognize(page)[0]
+        return text, time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(recognize, pages))
+    return results, time.perf_counter() - start, router.metrics()
+
+def score_documents(processor, documents, results):
+    """Return the field accuracy of each document that has a .json ground truth."""
+    scores = {}
+    offset = 0
+    for path, doc_pages in documents:
+        texts = [text for text, _ in results[offset:offset + len(doc_pages)]]
+        offset += len(doc_pages)
+        expected_path = os.path.splitext(path)[0] + '.json'
+        if os.path.exists(expected_path):
+            with open(expected_path, encoding='utf-8') as f:
+                score = field_accuracy(extract(processor, texts)[1], json.load(f))
+            if score is not None:
+                scores[os.path.basename(path)] = score
+    return scores
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('corpus', nargs='?', default=DEFAULT_CORPUS, help='PDF／影像語料目錄')
+    parser.add_argument('--backend', nargs='+', choices=['vision', 'tesseract', 'auto'],
+                        help='要比較的 OCR 引擎（預設為本機可用的引擎）')
+    parser.add_argument('--threads', type=int, default=config.OCR_LOCAL_WORKERS, help='同時辨識的頁數')
+    args = parser.parse_args()
+
+    backends = args.backend or available_backends()
+    if not backends:
+        print("沒有可用的 OCR 引擎：請安裝 tesseract (chi_tra) 與 pytesseract，或提供 Cloud Vision 憑證")
+        return
+
+    # Preprocessing and extraction need neither Vision credentials nor the spaCy model
+    processor = DocumentProcessor.__new__(DocumentProcessor)
+    processor.region_templates = None
+
+    documents = []
+    for name in sorted(os.listdir(args.corpus)):
+        path = os.path.join(args.corpus, name)
+        pages = [processor._preprocess_image(page) for page in iter_pages(processor, path)]
+        if pages:
+            documents.append((path, pages))
+    page_count = sum(len(doc_pages) for _, doc_pages in documents)
+    if not page_count:
+        print("語料目錄中沒有可處理的 PDF 或影像")
+        return
+
+    accuracy = {}
+    for backend in backends:
+        results, elapsed, metrics = run_backend(backend, documents, args.threads)
+        scores = score_documents(processor, documents, results)
+        for name, score in scores.items():
+            print(f"[{backend}] {name}: 欄位正確率 {score:.0%}")
+
+        latencies = sorted(latency for _, latency in results)
+        print(f"\n引擎: {backend}，{page_count} 頁，{args.threads} 個執行緒")
+        print(f"吞吐量: {page_count / elapsed:.2f} 頁/秒（共 {elapsed:.2f} s）")
+        print(f"每頁延遲: 中位數 {latencies[len(latencies) // 2] * 1000:.0f} ms，"
+              f"最大 {latencies[-1] * 1000:.0f} ms")
+        print(f"各引擎頁數: {metrics}\n")
+        if scores:
+            accuracy[backend] = sum(scores.values()) / len(scores)
+
+    if accuracy:
+        print("欄位正確率: " + "，".join(f"{backend} {score:.0%}" for backend, score in accuracy.items()))
+
+if __name__ == '__main__':
+    main()
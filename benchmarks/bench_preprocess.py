@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""比較 OCR 影像前處理前後的請求大小、OCR 延遲與擷取結果
+
+對語料目錄中的每個 PDF／影像，逐頁比較原始影像與 _preprocess_image 輸出的位元組數。
+加上 --ocr 時會實際辨識前處理前後的影像，量測延遲並比對擷取欄位；若存在同名的 .json 檔
+（例如 invoice.pdf → invoice.json），則以其內容為正確答案。OCR 引擎預設在有
+credentials.json 時使用 Cloud Vision，否則使用本機 Tesseract，因此內附語料
+（tests/data）不需憑證即可比較正確率。
+
+使用方式：
+    python benchmarks/bench_preprocess.py [corpus_dir] [--ocr] [--backend tesseract]
+"""
+import argparse
+import json
+import mimetypes
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from document_processor import DocumentProcessor
+from ocr_backends import OcrRouter, TesseractOcr, VisionOcr
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests', 'data')
+
+def available_backends():
+    """OCR backends usable here: Tesseract when installed, Vision when credentials exist."""
+    return [backend.name for backend in (TesseractOcr(), VisionOcr()) if backend.available()]
+
+def iter_pages(processor, path):
+    mime_type, _ = mimetypes.guess_type(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    if mime_type == 'application/pdf':
+        yield from processor._iter_pdf_pages(data)
+    elif mime_type and mime_type.startswith('image/'):
+        yield data
+
+def extract(processor, texts):
+    full_text = '\n'.join(t for t in texts if t)
+    doc_type = processor._classify_document(full_text)
+    # Pattern fields only, so no spaCy model is needed
+    return doc_type, processor._extract_information(full_text, doc_type, run_ner=False)
+
+def field_accuracy(actual, expected):
+    keys = [k for k, v in expected.items() if v]
+    if not keys:
+        return None
+    return sum(1 for k in keys if actual.get(k) == expected[k]) / len(keys)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('corpus', nargs='?', default=DEFAULT_CORPUS, help='PDF／影像語料目錄')
+    parser.add_argument('--ocr', action='store_true', help='實際辨識影像，量測延遲與擷取結果')
+    parser.add_argument('--backend', choices=['vision', 'tesseract'],
+                        help='--ocr 使用的 OCR 引擎（預設有憑證時用 vision，否則用 tesseract）')
+    args = parser.parse_args()
+
+    # Preprocessing and pattern extraction need neither Vision credentials nor the spaCy model
+    processor = DocumentProcessor.__new__(DocumentProcessor)
+    router = None
+    if args.ocr:
+        backend = args.backend or ('vision' if 'vision' in available_backends() else 'tesseract')
+        router = OcrRouter(mode=backend)
+        print(f"OCR 引擎: {backend}")
+
+    totals = {'raw_bytes': 0, 'processed_bytes': 0, 'raw_ocr': 0.0, 'processed_ocr': 0.0, 'pages': 0}
+    accuracy = {'raw': [], 'processed': []}
+
+    for name in sorted(os.listdir(args.corpus)):
+        path = os.path.join(args.corpus, name)
+        raw_texts, processed_texts = [], []
+        for page in iter_pages(processor, path):
+            start = time.perf_counter()
+            processed = processor._preprocess_image(page)
+            preprocess_time = time.perf_counter() - start
+
+            totals['pages'] += 1
+            totals['raw_bytes'] += len(page)
+            totals['processed_bytes'] += len(processed)
+            line = f"{name} p{totals['pages']}: {len(page):>9,} → {len(processed):>9,} bytes ({preprocess_time * 1000:.0f} ms)"
+
+            if args.ocr:
+                start = time.perf_counter()
+                raw_texts.append(router.recognize(page)[0])
+                raw_time = time.perf_counter() - start
+                start = time.perf_counter()
+                processed_texts.append(router.recognize(processed)[0])
+                processed_time = time.perf_counter() - start
+                totals['raw_ocr'] += raw_time
+                totals['processed_ocr'] += processed_time
+                line += f"  OCR {raw_time * 1000:.0f} → {processed_time * 1000:.0f} ms"
+            print(line)
+
+        if args.ocr and raw_texts:
+            _, raw_info = extract(processor, raw_texts)
+            _, processed_info = extract(processor, processed_texts)
+            expected_path = os.path.splitext(path)[0] + '.json'
+            if os.path.exists(expected_path):
+                with open(expected_path, encoding='utf-8') as f:
+                    expected = json.load(f)
+            else:
+                # Without ground truth, the unprocessed result is the reference
+                expected = raw_info
+            for key, info in (('raw', raw_info), ('processed', processed_info)):
+                score = field_accuracy(info, expected)
+                if score is not None:
+                    accuracy[key].append(score)
+
+    if not totals['pages']:
+        print("語料目錄中沒有可處理的 PDF 或影像")
+        return
+
+    print(f"\n頁數: {totals['pages']}")
+    print(f"請求大小: {totals['raw_bytes']:,} → {totals['processed_bytes']:,} bytes "
+          f"({1 - totals['processed_bytes'] / totals['raw_bytes']:.0%} smaller)")
+    if args.ocr:
+        print(f"OCR 延遲: {totals['raw_ocr']:.2f} → {totals['processed_ocr']:.2f} s")
+        for key in ('raw', 'processed'):
+            if accuracy[key]:
+                print(f"欄位正確率 ({key}): {sum(accuracy[key]) / len(accuracy[key]):.0%}")
+
+if __name__ == '__main__':
+    main()
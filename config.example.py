@@ -5,11 +5,18 @@ import logging
 GOOGLE_APPLICATION_CREDENTIALS = os.path.join(os.path.dirname(__file__), 'credentials.json')
 
 # Gmail API 設定
-GMAIL_QUERY = 'has:attachment -label:processed'  # Gmail 搜尋條件
+GMAIL_QUERY = 'has:attachment'  # Gmail 搜尋條件（已加上 GMAIL_LABEL 標籤的郵件會自動排除）
 GMAIL_LABEL = 'processed'  # 處理完成後的標籤
+GMAIL_SCOPES = ['https://www.googleapis.com/auth/gmail.modify']  # 套用標籤需要 modify 權限
+GMAIL_CREDENTIALS = os.path.join(os.path.dirname(__file__), 'client_secret.json')  # OAuth 用戶端憑證（Gmail 與 Drive 共用）
+TOKEN_FILE = 'token.pickle'  # Gmail 與 Drive 共用的使用者 token
+TOKEN_REFRESH_MARGIN = 300  # 在 token 到期前幾秒於背景更新
 
 # Google Drive 設定
 DRIVE_ROOT_FOLDER = 'Gmail附件'  # Google Drive 根資料夾名稱
+DRIVE_SCOPES = ['https://www.googleapis.com/auth/drive']
+DRIVE_INDEX = True  # 以本機索引查詢資料夾與重複發票，每次執行前依 Drive 變更紀錄同步
+DRIVE_INDEX_FILE = 'drive_index.json'  # 本機索引與變更紀錄檢查點
 
 # 文件類型關鍵字
 DOCUMENT_KEYWORDS = {
@@ -23,12 +30,50 @@ DOCUMENT_KEYWORDS = {
 # 日誌設定
 LOG_FILE = 'gmail_helper.log'
 LOG_LEVEL = logging.INFO
-LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(context)s%(message)s'  # %(context)s 為目前處理的郵件與附件，例如 [message=...] [attachment=...]
 LOG_MAX_SIZE = 10 * 1024 * 1024  # 10MB
 LOG_BACKUP_COUNT = 5
 
 # OCR 設定
 OCR_LANGUAGE_HINTS = ['zh-TW', 'en']  # OCR 語言提示
+OCR_PDF_DPI = 200  # PDF 轉圖片的解析度
+OCR_PREPROCESS = True  # 送出 OCR 前先縮圖、轉灰階並重新壓縮
+OCR_MAX_DIMENSION = 2000  # 影像長邊上限（像素），足以辨識發票文字
+OCR_IMAGE_FORMAT = 'JPEG'  # OCR 影像編碼格式：JPEG、WEBP 或 PNG
+OCR_IMAGE_QUALITY = 85  # JPEG/WEBP 壓縮品質 (1-100)
+OCR_CROP_MARGINS = True  # 裁掉空白邊界
+OCR_DESKEW = False  # 自動校正傾斜（掃描文件建議開啟）
+QR_FAST_PATH = True  # 先在本機解讀電子發票 QR Code，成功即略過 OCR（需安裝 pyzbar 或 opencv-python）
+OCR_EARLY_EXIT = True  # 從第一頁開始辨識，必要欄位齊全即停止處理後續頁面
+INVOICE_REQUIRED_FIELDS = ['invoice_number', 'invoice_date', 'amount']  # 發票必要欄位
+
+# OCR 引擎設定（本機 Tesseract 需安裝 tesseract 與 chi_tra 語言檔，以及 pytesseract）
+OCR_BACKEND = 'vision'  # 'vision'：Cloud Vision；'tesseract'：僅本機辨識；'auto'：先本機辨識，必要時改用 Cloud Vision
+TESSERACT_LANG = 'chi_tra+eng'
+TESSERACT_CMD = ''  # tesseract 執行檔路徑，空字串表示從 PATH 尋找
+OCR_LOCAL_WORKERS = 4  # 本機辨識的處理程序數
+OCR_LOCAL_MIN_CONFIDENCE = 70  # 'auto' 模式下本機辨識平均信心 (0-100) 低於此值即改用 Cloud Vision
+OCR_LOCAL_MAX_BYTES = 4 * 1024 * 1024  # 'auto' 模式下超過此大小的影像直接送 Cloud Vision
+OCR_CLOUD_BUDGET = 0  # 'auto' 模式下每次執行最多送 Cloud Vision 的頁數（0 表示不限制）
+
+# spaCy 設定（僅在正規表示式找不到買賣方時執行 NER）
+NER_MAX_CHARS = 2000  # 送入 NER 的文字上限
+NLP_BATCH_SIZE = 32  # 批次處理時 nlp.pipe 的批次大小
+NLP_PROCESSES = 1  # 批次處理時 nlp.pipe 的程序數
+NLP_BATCH_WAIT = 0.05  # 同時處理多份文件時，等待其他文件一起送 NER 的秒數（0 表示不等待）
+
+# 寄件者設定檔（記住各寄件者的文件類型、符合的欄位規則與供應商資料夾）
+SENDER_PROFILE_FILE = 'sender_profiles.json'
+SENDER_PROFILE_MIN_HITS = 2  # 成功處理幾份後才啟用快速路徑
+SENDER_PROFILE_MAX_PATTERNS = 2  # 每個欄位最多記住的規則數
+
+# 發票欄位區域範本（依寄件者學習第一頁欄位位置，先只辨識該區域）
+REGION_TEMPLATES = True
+REGION_TEMPLATE_FILE = 'region_templates.json'
+REGION_TEMPLATE_MIN_HITS = 2  # 學習幾份發票後才開始使用範本
+REGION_TEMPLATE_MAX_MISSES = 3  # 連續幾次裁切失敗即捨棄範本
+REGION_TEMPLATE_MARGIN = 0.05  # 欄位區域外擴比例
+REGION_TEMPLATE_MAX_AREA = 0.6  # 區域超過頁面此比例即不值得裁切
 
 # 檔案處理設定
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 最大檔案大小 (10MB)
@@ -39,7 +84,60 @@ SUPPORTED_MIME_TYPES = [
     'image/tiff',
     'image/bmp'
 ]
+SPOOL_MAX_MEMORY = 2 * 1024 * 1024  # 附件下載超過此大小即改寫入暫存檔 (2MB)
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # 上傳至 Drive 的分段大小，需為 256KB 的倍數 (4MB)
+
+# 壓縮檔附件設定（逐一解壓 ZIP 內符合 SUPPORTED_MIME_TYPES 的檔案並個別上傳）
+ARCHIVE_MIME_TYPES = ['application/zip', 'application/x-zip-compressed']
+ARCHIVE_MAX_MEMBERS = 100  # 檔案數超過即拒絕處理（防範 zip bomb）
+ARCHIVE_MAX_TOTAL_SIZE = 100 * 1024 * 1024  # 解壓後總大小上限 (100MB)
+ARCHIVE_MAX_RATIO = 100  # 解壓後與壓縮後大小的比例上限
+ARCHIVE_WORKERS = 4  # 同時擷取內容的檔案數
+
+# 日期解析快取筆數
+DATE_CACHE_SIZE = 4096
 
 # 重試設定
-MAX_RETRIES = 3  # 最大重試次數
-RETRY_DELAY = 5  # 重試延遲（秒） 
\ No newline at end of file
+MAX_RETRIES = 3  # 最大重試次數（API 回應 429/503 等節流錯誤時）
+RETRY_DELAY = 5  # 重試延遲（秒），每次重試遞增
+
+# 自適應並行上限（AIMD：延遲穩定時逐步提高同時進行的請求數，遇 429/503 或延遲暴增時減半）
+ADAPTIVE_CONCURRENCY = True
+ADAPTIVE_INITIAL_LIMIT = 4  # 各服務的起始並行數
+ADAPTIVE_MIN_LIMIT = 1
+ADAPTIVE_MAX_LIMITS = {'gmail': 40, 'drive': 10, 'vision': 16}  # 各服務的並行上限
+ADAPTIVE_BACKOFF = 0.5  # 節流時並行數乘上此比例
+ADAPTIVE_LATENCY_TOLERANCE = 2.0  # 延遲超過基準的倍數即視為過載
+ADAPTIVE_LOG_INTERVAL = 60  # 每隔幾秒記錄一次目前的並行上限
+
+# 附件排程設定（最短工作優先並加上老化，讓發票與小檔案先上傳，大型文件也不會被無限延後）
+SCHEDULER_ENABLED = True  # False 則依 Gmail 列出的順序處理
+SCHEDULER_TYPE_WEIGHTS = {  # 依主旨與檔名預測的文件類型之成本倍數，越小越優先
+    'invoice': 0.25,
+    'receipt': 0.5,
+    'order': 0.75,
+    'quotation': 1.0,
+    'contract': 1.5,
+    'unknown': 1.0
+}
+SCHEDULER_BASE_SECONDS = 2.0  # 每個附件的固定處理時間估計（下載、查重、上傳）
+SCHEDULER_BYTES_PER_SECOND = 256 * 1024  # 以附件大小估計 OCR 時間的處理速度
+SCHEDULER_AGING_SECONDS = 3600  # 郵件每多等待這麼多秒，等同預估處理時間減少 1 秒
+
+# 效能分析設定（python run.py --profile DIR）
+PROFILE_SAMPLE_INTERVAL = 0.01  # 堆疊取樣間隔（秒）
+PROFILE_ATTACHMENT_EVERY = 10  # 每幾個附件以 cProfile 完整記錄一個
+
+# 歷史郵件回填設定（python run.py --backfill 2022-01-01）
+BACKFILL_WINDOW_DAYS = 7  # 每個區間的天數
+BACKFILL_WORKERS = 4  # 同時處理的區間數
+BACKFILL_CHECKPOINT_FILE = 'backfill_checkpoint.json'  # 已完成區間的紀錄，中斷後可續傳
+GMAIL_RATE_LIMIT = 40  # 所有執行緒合計每秒 Gmail API 請求數上限（0 表示不限制）
+DRIVE_RATE_LIMIT = 10  # 所有執行緒合計每秒 Drive API 請求數上限（0 表示不限制）
+
+# 分散式處理設定
+BROKER_URL = ''  # 空字串使用本機 broker，或設為 redis://localhost:6379/0 讓多台機器共用
+WORKER_COUNT = 4  # 分散式模式的 worker 程序數量
+WORKER_POLL_INTERVAL = 5  # worker 與 coordinator 等待工作或結果時，每隔幾秒檢查一次是否該停止
+WORKER_RESULT_TIMEOUT = 900  # coordinator 超過此秒數未收到任何結果即視為 worker 已停止，不再等待
+BROKER_FOLDER_TTL = 60 * 60  # Redis broker 共用資料夾 ID 的保存秒數，過期後重新查詢 Drive，避免沿用已刪除的資料夾
@@ -0,0 +1,134 @@
+import logging
+import os
+import pickle
+import threading
+from datetime import datetime, timedelta, timezone
+import config
+
+logger = logging.getLogger(__name__)
+
+# Wait before retrying a failed background refresh
+REFRESH_RETRY_SECONDS = 60
+
+class CredentialsManager:
+    """One OAuth user token for every Gmail and Drive client in the process.
+
+    The token is loaded (or obtained through the OAuth flow) once with the
+    combined GMAIL_SCOPES and DRIVE_SCOPES, then refreshed by a background
+    thread TOKEN_REFRESH_MARGIN seconds before it expires. Clients share the
+    same Credentials object, so it is always valid when they send a request
+    and none of them refreshes synchronously in the middle of a burst.
+    """
+
+    def __init__(self, token_file=None, client_secrets_file=None, scopes=None):
+        self.token_file = token_file or config.TOKEN_FILE
+        self.client_secrets_file = client_secrets_file or config.GMAIL_CREDENTIALS
+        self.scopes = scopes or list(dict.fromkeys(config.GMAIL_SCOPES + config.DRIVE_SCOPES))
+        self._creds = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def get_credentials(self):
+        """Return the shared credentials, loading them and starting the refresher on first use."""
+        with self._lock:
+            if self._creds is None:
+                self._creds = self._load()
+            elif not self._creds.valid:
+                self._refresh()
+            # Forked worker processes inherit the manager but not its thread
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._refresh_loop,
+                                                name='token-refresh', daemon=True)
+                self._thread.start()
+            return self._creds
+
+    def stop(self):
+        self._stop.set()
+
+    def _load(self):
+        from google.auth.transport.requests import Request
+
+        creds = None
+        # Token file stores the user's access and refresh tokens
+        if os.path.exists(self.token_file):
+            with open(self.token_file, 'rb') as token:
+                try:
+                    creds = pickle.load(token)
+                except Exception as e:
+                    logger.warning(f"無法讀取 token 檔案: {str(e)}")
+
+        # Tokens from before Gmail and Drive shared one file lack some scopes
+        if creds and not creds.has_scopes(self.scopes):
+            creds = None
+
+        if creds and not creds.valid and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+            except Exception as e:
+                logger.warning(f"無法更新 token，重新授權: {str(e)}")
+                creds = None
+
+        if not creds or not creds.valid:
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file(self.client_secrets_file, self.scopes)
+            creds = flow.run_local_server(port=0)
+
+        self._save(creds)
+        return creds
+
+    def _refresh(self):
+        """Refresh the token in place; callers hold the lock."""
+        from google.auth.transport.requests import Request
+
+        self._creds.refresh(Request())
+        self._save(self._creds)
+        logger.info(f"已更新存取 token，到期時間 {self._creds.expiry}")
+
+    def _seconds_until_refresh(self):
+        expiry = self._creds.expiry
+        if expiry is None:
+            return None
+        # google-auth keeps expiry as naive UTC
+        refresh_at = expiry - timedelta(seconds=config.TOKEN_REFRESH_MARGIN)
+        return max(0.0, (refresh_at - datetime.now(timezone.utc).replace(tzinfo=None)).total_seconds())
+
+    def _refresh_loop(self):
+        while True:
+            with self._lock:
+                delay = self._seconds_until_refresh()
+            if delay is None:
+                # Tokens without an expiry never need refreshing
+                return
+            if self._stop.wait(delay):
+                return
+            try:
+                with self._lock:
+                    self._refresh()
+            except Exception as e:
+                logger.error(f"背景更新 token 失敗: {str(e)}")
+                if self._stop.wait(REFRESH_RETRY_SECONDS):
+                    return
+
+    def _save(self, creds):
+        # Written atomically, since worker processes may refresh concurrently
+        tmp_path = f"{self.token_file}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as token:
+                pickle.dump(creds, token)
+            os.replace(tmp_path, self.token_file)
+        except OSError as e:
+            logger.error(f"無法儲存 token 檔案: {str(e)}")
+
+_default_manager = None
+_default_lock = threading.Lock()
+
+def get_credentials_manager():
+    """Return the process-wide CredentialsManager."""
+    global _default_manager
+    with _default_lock:
+        if _default_manager is None:
+            _default_manager = CredentialsManager()
+        return _default_manager
@@ -0,0 +1,60 @@
+import email.utils
+import re
+from datetime import datetime
+from functools import lru_cache
+import config
+
+# Timezone comments such as "(UTC)" or "(CST)" trailing an RFC 2822 date
+TZ_COMMENT_PATTERN = re.compile(r'\s*\([A-Z]{2,}\)')
+
+# 2024年03月15日, 113年03月15日 (民國), 2024/03/15, 2024-3-15, 2024.03.15
+YMD_PATTERN = re.compile(r'^(\d{3,4})\s*[年/\-.]\s*(\d{1,2})\s*[月/\-.]\s*(\d{1,2})\s*日?$')
+COMPACT_PATTERN = re.compile(r'^(\d{4})(\d{2})(\d{2})$')
+
+@lru_cache(maxsize=config.DATE_CACHE_SIZE)
+def parse_date(date_str):
+    """Parse an email header or invoice date, caching results.
+
+    Handles the RFC 2822, ISO 8601 and 年/月/日 (including 民國) formats we see
+    without dateutil, which is only imported for anything else.
+
+    Args:
+        date_str (str): Date string to parse
+
+    Returns:
+        datetime: Parsed datetime object or None if parsing fails
+    """
+    if not date_str:
+        return None
+
+    value = TZ_COMMENT_PATTERN.sub('', date_str).strip()
+
+    # RFC 2822, as in every email Date header
+    if value[:1].isalpha() or ',' in value:
+        try:
+            return email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError, IndexError):
+            pass
+
+    match = YMD_PATTERN.match(value) or COMPACT_PATTERN.match(value)
+    if match:
+        year_str = match.group(1)
+        year, month, day = (int(part) for part in match.groups())
+        # 處理民國年（三位數年份；1900 等四位數年份維持西元）
+        if len(year_str) <= 3:
+            year += 1911
+        try:
+            return datetime(year, month, day)
+        except ValueError:
+            return None
+
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        pass
+
+    try:
+        from dateutil import parser
+        return parser.parse(value)
+    except (ValueError, OverflowError):
+        return None
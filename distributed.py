@@ -0,0 +1,499 @@
+import json
+import logging
+import multiprocessing
+import queue
+import time
+import uuid
+from contextlib import contextmanager
+from scheduler import AttachmentScheduler
+from single_flight import AttachmentSingleFlight
+from worker_files import worker_path
+from logging_setup import setup_logging, stop_logging
+import config
+
+logger = logging.getLogger(__name__)
+
+# Sentinel job telling a worker to shut down
+STOP_JOB = None
+
+# States of a single-flight entry kept in the broker
+FLIGHT_RUNNING = 'running'
+FLIGHT_DONE = 'done'
+
+class LocalBroker:
+    """Broker backed by a multiprocessing manager, for workers on one machine."""
+
+    def __init__(self):
+        self._manager = multiprocessing.Manager()
+        self._jobs = self._manager.Queue()
+        self._results = self._manager.Queue()
+        self._folders = self._manager.dict()
+        self._folder_lock = self._manager.Lock()
+        self._prekeys = self._manager.dict()
+        self._flights = self._manager.dict()
+        self._flight_lock = self._manager.Lock()
+
+    def __getstate__(self):
+        # Only the proxies travel to worker processes, never the manager itself
+        state = self.__dict__.copy()
+        state['_manager'] = None
+        return state
+
+    def start_run(self):
+        """Start a coordinator run; the manager's queues already belong to it alone."""
+        return uuid.uuid4().hex
+
+    def end_run(self):
+        pass
+
+    def put_job(self, job):
+        self._jobs.put(job)
+
+    def get_job(self, timeout=None):
+        """Return the next job, or raise queue.Empty after timeout seconds."""
+        return self._jobs.get(timeout=timeout)
+
+    def put_result(self, result):
+        self._results.put(result)
+
+    def get_result(self, timeout=None):
+        """Return the next result, or raise queue.Empty after timeout seconds."""
+        return self._results.get(timeout=timeout)
+
+    def get_folder(self, key):
+        return self._folders.get(key)
+
+    def set_folder(self, key, folder_id):
+        self._folders[key] = folder_id
+
+    @contextmanager
+    def folder_lock(self, key):
+        # Folder creation is rare next to OCR, so one lock for all keys is enough
+        with self._folder_lock:
+            yield
+
+    def set_prekeys(self, counts):
+        self._prekeys.clear()
+        self._prekeys.update(counts)
+
+    def get_prekey_count(self, prekey):
+        return self._prekeys.get(prekey, 0)
+
+    def begin_flight(self, key):
+        """Claim the flight for `key`; returns True if the caller leads it."""
+        with self._flight_lock:
+            entry = self._flights.get(key)
+            # The leader of a flight left running that long has died
+            if entry and (entry[0] == FLIGHT_DONE or time.time() - entry[1] < config.WORKER_RESULT_TIMEOUT):
+                return False
+            self._flights[key] = (FLIGHT_RUNNING, time.time())
+            return True
+
+    def get_flight(self, key):
+        entry = self._flights.get(key)
+        return entry[0] if entry else None
+
+    def finish_flight(self, key, ok):
+        if ok:
+            self._flights[key] = (FLIGHT_DONE, time.time())
+        else:
+            self._flights.pop(key, None)
+
+    def close(self):
+        if self._manager:
+            self._manager.shutdown()
+
+class RedisBroker:
+    """Broker backed by Redis lists, for workers spread across machines."""
+
+    def __init__(self, url, namespace='gmail_helper'):
+        self.url = url
+        self.namespace = namespace
+        self.run_id = None
+        self._client = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_client'] = None
+        return state
+
+    @property
+    def client(self):
+        if self._client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImportError("RedisBroker requires the 'redis' package: pip install redis")
+            self._client = redis.Redis.from_url(self.url)
+        return self._client
+
+    def _key(self, name):
+        return f"{self.namespace}:{name}"
+
+    def _pop(self, name, timeout):
+        # BRPOP treats 0 as "block forever"
+        item = self.client.brpop(self._key(name), timeout=0 if timeout is None else max(1, int(timeout)))
+        if item is None:
+            raise queue.Empty
+        return json.loads(item[1])
+
+    def start_run(self):
+        """Start a coordinator run with its own job and result lists.
+
+        Jobs, stop jobs and results of an earlier, interrupted run live under
+        another run id, so they are never picked up by this one.
+        """
+        self.run_id = uuid.uuid4().hex
+        self.client.set(self._key('run'), self.run_id)
+        return self.run_id
+
+    def end_run(self):
+        """Drop the run's unconsumed jobs and results and its pre-key counts."""
+        if self.run_id:
+            self.client.delete(self._key(f"jobs:{self.run_id}"), self._key(f"results:{self.run_id}"),
+                               self._key(f"prekeys:{self.run_id}"))
+
+    def put_job(self, job):
+        self.client.lpush(self._key(f"jobs:{self.run_id}"), json.dumps(job))
+
+    def get_job(self, timeout=None):
+        """Return the next job of the current run, or raise queue.Empty after timeout seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = config.WORKER_POLL_INTERVAL
+            if deadline is not None:
+                wait = min(wait, max(0, deadline - time.monotonic()))
+            run_id = self._current_run()
+            if run_id:
+                try:
+                    return self._pop(f"jobs:{run_id}", wait)
+                except queue.Empty:
+                    pass
+            else:
+                time.sleep(wait)
+            if deadline is not None and time.monotonic() >= deadline:
+                raise queue.Empty
+
+    def put_result(self, result):
+        key = self._key(f"results:{result['run_id']}")
+        self.client.lpush(key, json.dumps(result))
+        # Results nobody collects, e.g. of a coordinator that crashed, expire
+        self.client.expire(key, 24 * 60 * 60)
+
+    def get_result(self, timeout=None):
+        """Return the next result of this run, or raise queue.Empty after timeout seconds."""
+        return self._pop(f"results:{self.run_id}", timeout)
+
+    def get_folder(self, key):
+        folder_id = self.client.get(self._key(f"folder:{key}"))
+        return folder_id.decode('utf-8') if folder_id else None
+
+    def set_folder(self, key, folder_id):
+        # Ids expire so a folder deleted in Drive is looked up and recreated again
+        self.client.set(self._key(f"folder:{key}"), folder_id, ex=config.BROKER_FOLDER_TTL)
+
+    def set_prekeys(self, counts):
+        key = self._key(f"prekeys:{self.run_id}")
+        if counts:
+            self.client.hset(key, mapping=counts)
+            self.client.expire(key, 24 * 60 * 60)
+
+    def _current_run(self):
+        # Workers follow whichever run the coordinator started last
+        run_id = self.client.get(self._key('run'))
+        return run_id.decode('utf-8') if run_id else None
+
+    def get_prekey_count(self, prekey):
+        count = self.client.hget(self._key(f"prekeys:{self._current_run()}"), prekey)
+        return int(count) if count else 0
+
+    def _flight_key(self, key):
+        # Flights are per run, like the deduplication of a single-process run
+        return self._key(f"flight:{self._current_run()}:{key}")
+
+    def begin_flight(self, key):
+        """Claim the flight for `key`; returns True if the caller leads it."""
+        # A leader that dies leaves its claim to expire
+        return bool(self.client.set(self._flight_key(key), FLIGHT_RUNNING, nx=True,
+                                    ex=config.WORKER_RESULT_TIMEOUT))
+
+    def get_flight(self, key):
+        state = self.client.get(self._flight_key(key))
+        return state.decode('utf-8') if state else None
+
+    def finish_flight(self, key, ok):
+        if ok:
+            self.client.set(self._flight_key(key), FLIGHT_DONE, ex=24 * 60 * 60)
+        else:
+            self.client.delete(self._flight_key(key))
+
+    @contextmanager
+    def folder_lock(self, key):
+        lock = self.client.lock(self._key(f"lock:{key}"), timeout=60, blocking_timeout=120)
+        if not lock.acquire():
+            raise TimeoutError(f"Timed out waiting for folder lock: {key}")
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+
+class _BrokerFlight:
+    """A flight whose leader may run in another worker process."""
+
+    def __init__(self, broker, key):
+        self.broker = broker
+        self.key = key
+
+    def wait(self):
+        while True:
+            state = self.broker.get_flight(self.key)
+            if state != FLIGHT_RUNNING:
+                return True if state == FLIGHT_DONE else None
+            time.sleep(config.WORKER_POLL_INTERVAL)
+
+class BrokerSingleFlight(AttachmentSingleFlight):
+    """AttachmentSingleFlight whose tables live in the broker.
+
+    The coordinator registers the listing, so workers, which only see one
+    attachment per job, still know which attachments may have copies, and
+    copies handled by different workers share one extraction and upload.
+    """
+
+    def __init__(self, broker):
+        super().__init__()
+        self.broker = broker
+
+    @staticmethod
+    def _encode(key):
+        return key if isinstance(key, str) else json.dumps(list(key), ensure_ascii=False)
+
+    def register(self, emails):
+        """Store the pre-key counts of a listing; call after broker.start_run()."""
+        counts = {}
+        for email in emails:
+            for attachment in email['attachments']:
+                key = self._encode(self.prekey(attachment))
+                counts[key] = counts.get(key, 0) + 1
+        self.broker.set_prekeys(counts)
+
+    def may_have_copies(self, attachment):
+        return self.broker.get_prekey_count(self._encode(self.prekey(attachment))) > 1
+
+    def begin(self, digest):
+        key = self._encode(digest)
+        return _BrokerFlight(self.broker, key), self.broker.begin_flight(key)
+
+    def finish(self, digest, flight, result):
+        self.broker.finish_flight(flight.key, bool(result))
+
+def create_broker(url=None):
+    """Create a broker from a URL; an empty URL selects the local broker.
+
+    Args:
+        url (str): 'redis://host:port/db' or empty for a single-machine run
+
+    Returns:
+        LocalBroker or RedisBroker
+    """
+    url = url if url is not None else getattr(config, 'BROKER_URL', '')
+    if not url:
+        return LocalBroker()
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBroker(url)
+    raise ValueError(f"Unsupported broker URL: {url}")
+
+def run_coordinator(broker, num_workers, gmail_service=None, workers_alive=None, stop_workers=True):
+    """List emails and shard their attachments to workers as individual jobs.
+
+    Results are collected until every job has reported back, all workers have
+    died, or none has reported for WORKER_RESULT_TIMEOUT seconds. Mail with
+    attachments that never reported back is left unlabelled for the next run.
+
+    Args:
+        broker: Broker shared with the workers
+        num_workers (int): Number of workers to send a stop job to when done
+        gmail_service (GmailService): Optional pre-built Gmail client
+        workers_alive (callable): Optional check whether any worker is still running
+        stop_workers (bool): False when the caller stops its workers itself
+
+    Returns:
+        dict: Counts of dispatched, succeeded, failed and lost jobs and labelled messages
+    """
+    if gmail_service is None:
+        from gmail_service import GmailService
+        gmail_service = GmailService()
+
+    emails = gmail_service.get_emails_with_attachments()
+    logger.info(f"找到 {len(emails)} 封含附件的郵件")
+
+    jobs = []
+    for email in emails:
+        email_info = {k: v for k, v in email.items() if k != 'attachments'}
+        jobs.extend((email_info, attachment) for attachment in email['attachments'])
+    if config.SCHEDULER_ENABLED:
+        # Queued in priority order, so workers pick up invoices and small files first
+        scheduler = AttachmentScheduler()
+        for email_info, attachment in jobs:
+            scheduler.push(email_info, attachment)
+        jobs = list(scheduler)
+
+    run_id = broker.start_run()
+    try:
+        # Workers only see single attachments, so the copies are counted here
+        BrokerSingleFlight(broker).register(emails)
+        for email_info, attachment in jobs:
+            broker.put_job({'run_id': run_id, 'email': email_info, 'attachment': attachment})
+        dispatched = len(jobs)
+
+        if stop_workers:
+            for _ in range(num_workers):
+                broker.put_job(STOP_JOB)
+        logger.info(f"已分派 {dispatched} 個附件工作給 {num_workers} 個 worker")
+
+        summary = {'dispatched': dispatched, 'succeeded': 0, 'failed': 0}
+        pending = {email['message_id']: len(email['attachments']) for email in emails}
+        failed_messages = set()
+        received = 0
+        last_result = time.monotonic()
+        while received < dispatched:
+            try:
+                result = broker.get_result(timeout=config.WORKER_POLL_INTERVAL)
+            except queue.Empty:
+                if workers_alive is not None and not workers_alive():
+                    logger.error(f"所有 worker 皆已停止，仍有 {dispatched - received} 個附件未回報結果")
+                    break
+                if time.monotonic() - last_result >= config.WORKER_RESULT_TIMEOUT:
+                    logger.error(f"{config.WORKER_RESULT_TIMEOUT} 秒內未收到任何結果，"
+                                 f"放棄等待其餘 {dispatched - received} 個附件")
+                    break
+                continue
+
+            last_result = time.monotonic()
+            if result.get('run_id') != run_id or result.get('message_id') not in pending:
+                logger.warning(f"略過不屬於本次執行的結果: {result.get('message_id')}")
+                continue
+            received += 1
+            pending[result['message_id']] -= 1
+            if result['ok']:
+                summary['succeeded'] += 1
+            else:
+                summary['failed'] += 1
+                failed_messages.add(result['message_id'])
+        summary['lost'] = dispatched - received
+    finally:
+        broker.end_run()
+
+    # Only label mail whose attachments all made it to Drive
+    processed_ids = [
+        message_id for message_id, remaining in pending.items()
+        if remaining == 0 and message_id not in failed_messages
+    ]
+    summary['labelled'] = gmail_service.mark_processed(processed_ids)
+
+    logger.info(f"分散式處理完成: 成功 {summary['succeeded']}，失敗 {summary['failed']}，"
+                f"未回報 {summary['lost']}")
+    return summary
+
+def run_worker(broker, processor=None, stop_event=None):
+    """Consume attachment jobs until a stop job arrives or stop_event is set.
+
+    Args:
+        broker: Broker shared with the coordinator
+        processor (GmailAttachmentProcessor): Optional pre-built processor
+        stop_event: Optional multiprocessing.Event checked between jobs
+    """
+    if processor is None:
+        from main import GmailAttachmentProcessor
+        from document_processor import DocumentProcessor
+        from region_templates import RegionTemplateStore
+        from sender_profiles import SenderProfileStore
+        # Each worker saves what it learns to its own files, merged once the
+        # workers stop (merge_worker_stores), so workers never overwrite each other
+        processor = GmailAttachmentProcessor(
+            folder_coordinator=broker,
+            single_flight=BrokerSingleFlight(broker),
+            sender_profiles=SenderProfileStore(config.SENDER_PROFILE_FILE,
+                                               save_path=worker_path(config.SENDER_PROFILE_FILE)),
+            doc_processor=DocumentProcessor(region_templates=RegionTemplateStore(
+                config.REGION_TEMPLATE_FILE, save_path=worker_path(config.REGION_TEMPLATE_FILE)))
+        )
+
+    while stop_event is None or not stop_event.is_set():
+        try:
+            job = broker.get_job(timeout=config.WORKER_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+        if job is STOP_JOB:
+            break
+
+        email, attachment = job['email'], job['attachment']
+        try:
+            ok = processor._process_attachment(email, attachment)
+        except Exception as e:
+            logger.error(f"處理附件時發生錯誤: {attachment.get('filename')}: {str(e)}")
+            ok = False
+
+        broker.put_result({
+            'run_id': job.get('run_id'),
+            'message_id': email['message_id'],
+            'attachment_id': attachment['id'],
+            'ok': ok
+        })
+
+def merge_worker_stores():
+    """Merge the sender profiles and region templates saved by stopped workers.
+
+    Workers never sync or save the Drive index; only the coordinator side of
+    a single-process or backfill run writes DRIVE_INDEX_FILE.
+    """
+    from region_templates import RegionTemplateStore
+    from sender_profiles import SenderProfileStore
+    merged = SenderProfileStore.merge_worker_files(config.SENDER_PROFILE_FILE)
+    merged += RegionTemplateStore.merge_worker_files(config.REGION_TEMPLATE_FILE)
+    if merged:
+        logger.info(f"已合併 {merged} 個 worker 的學習紀錄")
+
+def _worker_process(broker, stop_event=None):
+    """Entry point of a local worker process."""
+    # Spawned workers start unconfigured and forked ones without the listener thread
+    setup_logging()
+    try:
+        run_worker(broker, stop_event=stop_event)
+    finally:
+        # Worker processes exit without running atexit hooks
+        stop_logging()
+
+def run_distributed(num_workers=None, broker_url=None):
+    """Run a coordinator plus local worker processes over the given broker.
+
+    With a Redis broker, further workers on other machines can join by
+    running `run.py --role worker` against the same BROKER_URL. Local workers
+    are stopped through an event rather than stop jobs, which a remote
+    worker could otherwise take in their place.
+    """
+    num_workers = num_workers or config.WORKER_COUNT
+    broker = create_broker(broker_url)
+    stop_event = multiprocessing.Event()
+    workers = [
+        multiprocessing.Process(target=_worker_process, args=(broker, stop_event), name=f"worker-{i}")
+        for i in range(num_workers)
+    ]
+    try:
+        for worker in workers:
+            worker.start()
+        return run_coordinator(broker, num_workers, stop_workers=False,
+                               workers_alive=lambda: any(worker.is_alive() for worker in workers))
+    finally:
+        stop_event.set()
+        for worker in workers:
+            worker.join(timeout=2 * config.WORKER_POLL_INTERVAL)
+            if worker.is_alive():
+                logger.warning(f"{worker.name} 未在時限內結束，強制終止")
+                worker.terminate()
+                worker.join()
+        merge_worker_stores()
+        broker.close()
@@ -1,35 +1,146 @@
+import logging
 import os
 import io
 import json
 import re
+import email.utils
+import tempfile
+import threading
+import time
 from datetime import datetime
-from google.cloud import vision
-import fitz  # PyMuPDF
-from pdf2image import convert_from_bytes
-import spacy
+from region_templates import RegionTemplateStore
+from ocr_backends import OcrRouter
+import profiling
 import config
 
-class DocumentProcessor:
-    def __init__(self):
-        # Initialize Vision client with explicit credentials
-        try:
-            credentials_path = os.path.normpath(config.GOOGLE_APPLICATION_CREDENTIALS)
-            if not os.path.exists(credentials_path):
-                raise FileNotFoundError(f"Credentials file not found at: {credentials_path}")
+logger = logging.getLogger(__name__)
+
+# Words that mark a line as naming a company, used to narrow the NER input
+COMPANY_HINTS = ['公司', '企業', '商店', '商行', '賣方', '買受人', '有限', 'Ltd', 'Inc', 'Co.']
+
+# Left QR code of a Taiwanese e-invoice (電子發票證明聯): invoice number,
+# ROC date, random code, sales and total amounts in hex, buyer and seller 統一編號
+EINVOICE_QR_PATTERN = re.compile(
+    r'^(?P<invoice_number>[A-Z]{2}\d{8})'
+    r'(?P<year>\d{3})(?P<month>\d{2})(?P<day>\d{2})'
+    r'(?P<random_code>\d{4})'
+    r'(?P<sales_amount>[0-9A-Fa-f]{8})'
+    r'(?P<total_amount>[0-9A-Fa-f]{8})'
+    r'(?P<buyer_tax_id>\d{8})'
+    r'(?P<seller_tax_id>\d{8})'
+)
+
+# Invoice field patterns as (name, regex), tried in order; sender profiles
+# remember the names that matched so known senders only try those
+INVOICE_PATTERNS = {
+    # 統一發票號碼格式: XX-XXXXXXXX
+    'invoice_number': [
+        ('invoice_number', re.compile(r'[A-Z]{2}[-]?\d{8}'))
+    ],
+    # 支援多種日期格式
+    'invoice_date': [
+        ('date_ymd', re.compile(r'(\d{4})[年/\-](\d{1,2})[月/\-](\d{1,2})')),  # 2024年03月15日
+        ('date_roc', re.compile(r'(\d{3})[年/\-](\d{1,2})[月/\-](\d{1,2})')),  # 民國113年03月15日
+        ('date_mdy', re.compile(r'(\d{1,2})[/\-](\d{1,2})[/\-](\d{4})'))       # 03/15/2024
+    ],
+    # 統一編號格式: 8位數字
+    'tax_id': [
+        ('tax_id', re.compile(r'統一編號[：: ]*(\d{8})'))
+    ],
+    # Seller and buyer by the label they are printed with
+    'seller': [
+        ('seller_label', re.compile(r'賣方[：: ]*([^\n]+)')),
+        ('company_name', re.compile(r'公司名稱[：: ]*([^\n]+)')),
+        ('store_name', re.compile(r'商店名稱[：: ]*([^\n]+)'))
+    ],
+    'buyer': [
+        ('buyer_label', re.compile(r'買受人[：: ]*([^\n]+)'))
+    ],
+    'amount': [
+        ('total', re.compile(r'總計[：: ]*NT?\$?(\d+[,\d]*\d*)')),
+        ('grand_total', re.compile(r'總額[：: ]*NT?\$?(\d+[,\d]*\d*)')),
+        ('amount', re.compile(r'金額[：: ]*NT?\$?(\d+[,\d]*\d*)'))
+    ]
+}
+
+class NerBatcher:
+    """Coalesces NER calls from concurrent threads into nlp.pipe batches.
+    
+    The first waiting caller collects further texts for up to NLP_BATCH_WAIT
+    seconds, but only while other documents are still being processed, so a
+    lone thread never waits. It then runs the whole batch and hands every
+    caller its own Doc.
+    """
+    
+    def __init__(self, run_batch, expected):
+        """
+        Args:
+            run_batch (callable): Maps a list of texts to a list of Docs
+            expected (callable): Number of callers that may still join a batch
+        """
+        self._run_batch = run_batch
+        self._expected = expected
+        self._cond = threading.Condition()
+        self._queue = []
+        self._leading = False
+    
+    def __call__(self, text):
+        request = {'text': text, 'done': False, 'doc': None, 'error': None}
+        with self._cond:
+            self._queue.append(request)
+            self._cond.notify_all()
+            while not request['done']:
+                if self._leading:
+                    self._cond.wait()
+                    continue
+                self._leading = True
+                deadline = time.monotonic() + config.NLP_BATCH_WAIT
+                while len(self._queue) < min(config.NLP_BATCH_SIZE, self._expected()):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._queue[:config.NLP_BATCH_SIZE]
+                del self._queue[:config.NLP_BATCH_SIZE]
                 
-            self.vision_client = vision.ImageAnnotatorClient.from_service_account_json(
-                credentials_path
-            )
-            print(f"Successfully initialized Vision client with credentials from: {credentials_path}")
-        except Exception as e:
-            print(f"Error initializing Vision client: {str(e)}")
-            raise
+                self._cond.release()
+                try:
+                    docs, error = self._run_batch([r['text'] for r in batch]), None
+                except Exception as e:
+                    docs, error = [None] * len(batch), e
+                finally:
+                    self._cond.acquire()
+                for r, doc in zip(batch, docs):
+                    r.update(doc=doc, error=error, done=True)
+                self._leading = False
+                self._cond.notify_all()
+        if request['error'] is not None:
+            raise request['error']
+        return request['doc']
+
+class DocumentProcessor:
+    def __init__(self, region_templates=None):
+        """Initialize the processor.
+        
+        Args:
+            region_templates (RegionTemplateStore): Optional store to use instead
+                of REGION_TEMPLATE_FILE, e.g. one saving to a worker's own file
+        """
+        # Vision, spaCy, PyMuPDF and pdf2image are imported on first use, so
+        # runs that find no new attachments never pay their import cost
+        self._ocr = None
+        self._nlp = None
+        self._init_lock = threading.Lock()
+        
+        # NER calls of documents processed in parallel (backfill windows, ZIP
+        # members) share nlp.pipe batches
+        self._active_documents = 0
+        self._ner_batcher = NerBatcher(self._pipe_ner, lambda: self._active_documents)
             
-        try:
-            self.nlp = spacy.load("zh_core_web_sm")
-        except Exception as e:
-            print(f"Error loading spaCy model: {str(e)}")
-            raise
+        # Learned page-1 field regions per vendor, for header-region OCR
+        self.region_templates = None
+        if config.REGION_TEMPLATES:
+            self.region_templates = region_templates or RegionTemplateStore(config.REGION_TEMPLATE_FILE)
             
         # Set up Poppler path for Windows
         if os.name == 'nt':  # Windows
@@ -37,91 +148,442 @@ class DocumentProcessor:
             if os.path.exists(poppler_path):
                 os.environ['PATH'] = poppler_path + os.pathsep + os.environ.get('PATH', '')
             else:
-                print(f"Warning: Poppler not found at {poppler_path}")
-                print("Please install Poppler and add it to PATH")
+                logger.warning(f"Poppler not found at {poppler_path}")
+                logger.warning("Please install Poppler and add it to PATH")
         
-    def process_document(self, file_data, mime_type):
-        """Process document and extract information."""
+    @property
+    def ocr(self):
+        """OcrRouter for the configured OCR_BACKEND, created on first OCR call."""
+        if self._ocr is None:
+            with self._init_lock:
+                if self._ocr is None:
+                    self._ocr = OcrRouter()
+        return self._ocr
+    
+    @ocr.setter
+    def ocr(self, router):
+        self._ocr = router
+    
+    @property
+    def nlp(self):
+        """spaCy pipeline, loaded on first use."""
+        if self._nlp is None:
+            with self._init_lock:
+                if self._nlp is None:
+                    import spacy
+                    try:
+                        self._nlp = spacy.load("zh_core_web_sm")
+                    except Exception as e:
+                        logger.error(f"Error loading spaCy model: {str(e)}")
+                        raise
+        return self._nlp
+    
+    @nlp.setter
+    def nlp(self, nlp):
+        self._nlp = nlp
+    
+    def process_document(self, file_data, mime_type, sender=None, run_ner=True, profile=None):
+        """Process document and extract information.
+        
+        Pages are OCR'd in order and, with OCR_EARLY_EXIT, analysis stops as soon
+        as the fields needed for filing are present, so later pages of long
+        documents are never rendered or sent to OCR. Known vendors first get a
+        crop of their learned page-1 field region.
+        
+        Args:
+            file_data: Document contents as bytes or an AttachmentBuffer
+            mime_type (str): MIME type of the document
+            sender (str): Email sender, used to look up the vendor's region template
+            run_ner (bool): False to leave the NER fallback to the caller, which
+                batches it over several results with apply_batched_ner
+            profile (dict): Sender profile from SenderProfileStore; established
+                invoice senders try their remembered patterns first and skip NER
+                when those find every required field
+        
+        Returns:
+            dict: Document type, text and extracted information; with run_ner
+                False, 'needs_ner' tells whether the NER fallback is still due
+        """
+        with self._init_lock:
+            self._active_documents += 1
         try:
-            # Convert PDF to images if necessary
+            return self._process_document(file_data, mime_type, sender, run_ner, profile)
+        finally:
+            with self._init_lock:
+                self._active_documents -= 1
+    
+    def _process_document(self, file_data, mime_type, sender, run_ner, profile):
+        try:
+            # Render PDF pages lazily, so only one page image is held at a time
             if mime_type == 'application/pdf':
-                images = self._pdf_to_images(file_data)
+                images = profiling.staged_iter('pdf_to_images', self._iter_pdf_pages(file_data))
             else:
-                images = [file_data]
+                images = iter([self._as_bytes(file_data)])
+            
+            vendor = email.utils.parseaddr(sender or '')[1].lower()
+            region = self.region_templates.region_for(vendor) if self.region_templates else None
+            patterns = None
+            if profile and profile.get('doc_type') == 'invoice' and \
+                    profile['hits'] >= config.SENDER_PROFILE_MIN_HITS:
+                patterns = profile['patterns']
+            matched = {}
             
             # Process each image
             extracted_text = []
-            for image_data in images:
-                text = self._perform_ocr(image_data)
+            analysis = None
+            from_qr = False
+            for page_number, image_data in enumerate(images):
+                # E-invoice QR codes decode locally and make OCR unnecessary
+                if page_number == 0 and config.QR_FAST_PATH:
+                    qr_info = self._extract_qr_invoice_info(image_data)
+                    if qr_info:
+                        extracted_text, analysis = [], ('invoice', qr_info, False)
+                        from_qr = True
+                        break
+                    
+                if page_number == 0 and region:
+                    region_text = self._perform_ocr(self._preprocess_image(image_data, region=region))
+                    region_info = self._extract_information(region_text, 'invoice', run_ner=False,
+                                                            matched=matched)
+                    if self._is_extraction_complete('invoice', region_info):
+                        self.region_templates.record_hit(vendor)
+                        extracted_text, analysis = [region_text], ('invoice', region_info, False)
+                        break
+                    self.region_templates.record_miss(vendor)
+                    
+                if page_number == 0:
+                    text, words = self._perform_ocr_layout(self._preprocess_image(image_data))
+                else:
+                    text, words = self._perform_ocr(self._preprocess_image(image_data)), None
                 if text:
                     extracted_text.append(text)
+                    analysis = None
+                    
+                if not config.OCR_EARLY_EXIT and not (words and self.region_templates):
+                    continue
+                    
+                analysis = self._analyze_text('\n'.join(extracted_text), patterns, matched)
+                if words and self.region_templates and analysis[0] == 'invoice':
+                    self.region_templates.learn(vendor, words, analysis[1])
+                if config.OCR_EARLY_EXIT and self._is_extraction_complete(*analysis[:2]):
+                    break
+            
+            if hasattr(images, 'close'):
+                images.close()
             
             # Combine all extracted text
             full_text = '\n'.join(extracted_text)
             
             # Analyze document type and extract information
-            doc_type = self._classify_document(full_text)
-            extracted_info = self._extract_information(full_text, doc_type)
+            if analysis is None:
+                analysis = self._analyze_text(full_text, patterns, matched)
+            doc_type, extracted_info, fast_path = analysis
+            
+            # NER runs at most once per document, never when a known sender's
+            # remembered patterns sufficed, and only if the patterns left a party
+            # empty. A decoded QR code has no text to search, so spaCy is not
+            # even loaded for it.
+            needs_ner = not fast_path and not from_qr and bool(full_text) and \
+                self._needs_ner(doc_type, extracted_info)
+            if run_ner and needs_ner:
+                self._apply_ner_companies(extracted_info, self._run_ner(full_text))
+                needs_ner = False
             
             return {
                 'document_type': doc_type,
                 'extracted_text': full_text,
                 'extracted_info': extracted_info,
+                'matched_patterns': matched,
+                'needs_ner': needs_ner,
                 'processed_date': datetime.now().isoformat()
             }
             
         except Exception as e:
-            print(f"Error processing document: {str(e)}")
+            logger.error(f"Error processing document: {str(e)}")
             return None
     
+    def _decode_qr_codes(self, image_data):
+        """Decode all QR codes in an image locally, with pyzbar or else OpenCV.
+        
+        Returns:
+            list: Decoded payload strings; empty if no decoder is installed
+        """
+        from PIL import Image
+        
+        with Image.open(io.BytesIO(image_data)) as image:
+            image = image.convert('L')
+            
+        try:
+            from pyzbar import pyzbar
+            return [code.data.decode('utf-8', errors='ignore')
+                    for code in pyzbar.decode(image, symbols=[pyzbar.ZBarSymbol.QRCODE])]
+        except ImportError:
+            pass
+            
+        try:
+            import cv2
+            import numpy as np
+            found, payloads, _, _ = cv2.QRCodeDetector().detectAndDecodeMulti(np.array(image))
+            return [p for p in payloads if p] if found else []
+        except ImportError:
+            return []
+    
+    def _parse_einvoice_qr(self, payload):
+        """Parse the left QR code of a Taiwanese e-invoice into invoice fields.
+        
+        Returns:
+            dict: Invoice information, or None if the payload is not an e-invoice
+        """
+        match = EINVOICE_QR_PATTERN.match(payload)
+        if not match:
+            return None
+            
+        fields = match.groupdict()
+        year = int(fields['year']) + 1911  # 民國年
+        buyer_tax_id = fields['buyer_tax_id'] if fields['buyer_tax_id'] != '00000000' else ''
+        return {
+            'invoice_number': fields['invoice_number'],
+            'invoice_date': f"{year}-{fields['month']}-{fields['day']}",
+            'buyer': '',
+            'seller': '',
+            'amount': str(int(fields['total_amount'], 16)),
+            'tax_id': fields['seller_tax_id'],
+            'seller_tax_id': fields['seller_tax_id'],
+            'buyer_tax_id': buyer_tax_id,
+            'sales_amount': str(int(fields['sales_amount'], 16)),
+            'random_code': fields['random_code']
+        }
+    
+    @profiling.staged('qr')
+    def _extract_qr_invoice_info(self, image_data):
+        """Extract invoice fields from an e-invoice QR code on the page, if any."""
+        try:
+            for payload in self._decode_qr_codes(image_data):
+                info = self._parse_einvoice_qr(payload)
+                if info:
+                    return info
+        except Exception as e:
+            logger.error(f"Error decoding QR codes: {str(e)}")
+        return None
+    
+    @profiling.staged('regex')
+    def _analyze_text(self, text, patterns=None, matched=None):
+        """Classify text and extract its fields, without the NER fallback.
+        
+        Args:
+            text (str): OCR text
+            patterns (dict): Remembered invoice patterns of a known sender; when
+                they yield the required fields, classification is skipped
+            matched (dict): Receives field -> matching pattern name
+        
+        Returns:
+            tuple: (document type, extracted information, whether the remembered
+                patterns alone sufficed)
+        """
+        if patterns:
+            fast_matched = {}
+            info = self._extract_invoice_info(text, patterns=patterns, matched=fast_matched)
+            if self._is_extraction_complete('invoice', info):
+                if matched is not None:
+                    matched.clear()
+                    matched.update(fast_matched)
+                return 'invoice', info, True
+                
+        # Generic path for new senders, or when a sender's layout has changed
+        if matched is not None:
+            matched.clear()
+        doc_type = self._classify_document(text)
+        return doc_type, self._extract_information(text, doc_type, run_ner=False, matched=matched), False
+    
+    def _is_extraction_complete(self, doc_type, info):
+        """Check whether the pages seen so far are enough to file the document.
+        
+        Invoices need INVOICE_REQUIRED_FIELDS; other documents are filed by email
+        details, so knowing their type is enough. Unclassified text never is.
+        """
+        if doc_type == 'invoice':
+            return all(info.get(field) for field in config.INVOICE_REQUIRED_FIELDS)
+        return doc_type != 'unknown'
+    
+    def _as_bytes(self, file_data):
+        """Return raw bytes for APIs that accept nothing else, copying only buffers."""
+        if isinstance(file_data, bytes):
+            return file_data
+        view = getattr(file_data, 'view', file_data)
+        return bytes(view)
+    
     def _pdf_to_images(self, pdf_data):
         """Convert PDF to images."""
+        return list(self._iter_pdf_pages(pdf_data))
+    
+    def _iter_pdf_pages(self, pdf_data):
+        """Yield PNG bytes for each PDF page.
+        
+        pdftoppm renders one page per call (first_page/last_page) straight to a
+        temporary directory, so a caller that stops early never pays for
+        rasterising the remaining pages, and there is no PIL decode/re-encode
+        step. Disk-backed attachment buffers are rendered from their path;
+        in-memory ones are written to the temporary directory once.
+        """
+        poppler_path = None
+        if os.name == 'nt':  # Windows
+            poppler_path = os.path.join(os.environ.get('PROGRAMFILES', 'C:\\Program Files'), 'poppler', 'Library', 'bin')
+            
+        path = getattr(pdf_data, 'path', None)
+        with tempfile.TemporaryDirectory(prefix='gmail_helper_pages_') as output_folder:
+            try:
+                # Try using pdf2image with explicit poppler path
+                from pdf2image import convert_from_path, pdfinfo_from_path
+                
+                pdf_path = path
+                if not pdf_path:
+                    pdf_path = os.path.join(output_folder, 'document.pdf')
+                    with open(pdf_path, 'wb') as f:
+                        f.write(getattr(pdf_data, 'view', pdf_data))
+                page_count = pdfinfo_from_path(pdf_path, poppler_path=poppler_path)['Pages']
+            except Exception as e:
+                logger.error(f"Error converting PDF to images: {str(e)}")
+                logger.error("If Poppler is not installed, please install it from: https://github.com/oschwartz10612/poppler-windows/releases/")
+                page_count = None
+                
+            if page_count is not None:
+                for page_number in range(1, page_count + 1):
+                    page_paths = convert_from_path(pdf_path, dpi=config.OCR_PDF_DPI, fmt='png',
+                                                   output_folder=output_folder,
+                                                   first_page=page_number, last_page=page_number,
+                                                   paths_only=True, poppler_path=poppler_path)
+                    for page_path in page_paths:
+                        with open(page_path, 'rb') as f:
+                            page_data = f.read()
+                        os.remove(page_path)
+                        yield page_data
+                return
+                
+        # Fallback to PyMuPDF
         try:
-            # Try using pdf2image with explicit poppler path
-            if os.name == 'nt':  # Windows
-                poppler_path = os.path.join(os.environ.get('PROGRAMFILES', 'C:\\Program Files'), 'poppler', 'Library', 'bin')
-                images = convert_from_bytes(pdf_data, poppler_path=poppler_path)
+            logger.info("Attempting to use PyMuPDF as fallback...")
+            import fitz  # PyMuPDF
+            if path:
+                pdf_doc = fitz.open(path, filetype="pdf")
             else:
-                images = convert_from_bytes(pdf_data)
-                
-            image_data = []
-            for image in images:
-                img_byte_arr = io.BytesIO()
-                image.save(img_byte_arr, format='PNG')
-                image_data.append(img_byte_arr.getvalue())
+                pdf_doc = fitz.open(stream=self._as_bytes(pdf_data), filetype="pdf")
+        except Exception as fallback_e:
+            logger.error(f"Fallback to PyMuPDF also failed: {str(fallback_e)}")
+            return
+        # Closed even when the caller stops early and the generator is discarded
+        with pdf_doc:
+            for page in pdf_doc:
+                yield page.get_pixmap(dpi=config.OCR_PDF_DPI).tobytes()
+    
+    @profiling.staged('preprocess')
+    def _preprocess_image(self, image_data, region=None):
+        """Shrink an image to a compact, OCR-sufficient payload.
+        
+        Downscales to OCR_MAX_DIMENSION, converts to grayscale, optionally crops
+        blank margins and deskews, then re-encodes as OCR_IMAGE_FORMAT. The
+        processed image is returned even when it is not smaller: region
+        templates are learned from word boxes on it and applied by cropping it,
+        so both must see the same frame. The original bytes are returned only
+        when preprocessing is disabled or fails.
+        
+        Args:
+            image_data (bytes): Encoded page image
+            region (tuple): Optional (left, top, right, bottom) fractions to crop to
+        """
+        if not config.OCR_PREPROCESS and not region:
             return image_data
+        
+        from PIL import Image, ImageOps
             
-        except Exception as e:
-            print(f"Error converting PDF to images: {str(e)}")
-            print("If Poppler is not installed, please install it from: https://github.com/oschwartz10612/poppler-windows/releases/")
-            # Fallback to PyMuPDF
-            try:
-                print("Attempting to use PyMuPDF as fallback...")
-                pdf_doc = fitz.open(stream=pdf_data, filetype="pdf")
-                image_data = []
-                for page in pdf_doc:
-                    pix = page.get_pixmap()
-                    img_data = pix.tobytes()
-                    image_data.append(img_data)
-                return image_data
-            except Exception as fallback_e:
-                print(f"Fallback to PyMuPDF also failed: {str(fallback_e)}")
-                return []
-    
-    def _perform_ocr(self, image_data):
-        """Perform OCR on image using Google Cloud Vision."""
         try:
-            image = vision.Image(content=image_data)
-            response = self.vision_client.text_detection(image=image)
-            texts = response.text_annotations
-            
-            if texts:
-                return texts[0].description
-            return ''
+            with Image.open(io.BytesIO(image_data)) as image:
+                if config.OCR_PREPROCESS:
+                    image = ImageOps.exif_transpose(image).convert('L')
+                    
+                    if config.OCR_CROP_MARGINS:
+                        image = self._crop_margins(image)
+                    if config.OCR_DESKEW:
+                        image = self._deskew(image)
+                        
+                    # Downscale after cropping so the text keeps as many pixels as possible
+                    image.thumbnail((config.OCR_MAX_DIMENSION, config.OCR_MAX_DIMENSION), Image.LANCZOS)
+                elif image.mode not in ('L', 'RGB'):
+                    image = image.convert('RGB')
+                    
+                if region:
+                    left, top, right, bottom = region
+                    image = image.crop((
+                        int(left * image.width), int(top * image.height),
+                        int(right * image.width), int(bottom * image.height)
+                    ))
+                
+                output = io.BytesIO()
+                image.save(output, format=config.OCR_IMAGE_FORMAT, quality=config.OCR_IMAGE_QUALITY)
+                
+            return output.getvalue()
             
         except Exception as e:
-            print(f"Error performing OCR: {str(e)}")
-            return ''
+            logger.warning(f"Error preprocessing image, using original: {str(e)}")
+            return image_data
+    
+    def _crop_margins(self, image, threshold=200, padding=20):
+        """Crop near-white borders from a grayscale image, keeping a small padding."""
+        # Dark pixels become white in the mask, so getbbox finds the content area
+        mask = image.point(lambda p: 255 if p < threshold else 0)
+        bbox = mask.getbbox()
+        if not bbox:
+            return image
+        left, top, right, bottom = bbox
+        return image.crop((
+            max(0, left - padding),
+            max(0, top - padding),
+            min(image.width, right + padding),
+            min(image.height, bottom + padding)
+        ))
+    
+    def _deskew(self, image, max_angle=5.0, step=0.5):
+        """Rotate a grayscale image by the angle that best aligns its text lines.
+        
+        Text rows line up horizontally when the image is straight, which
+        maximises the variance of the per-row ink profile. Candidate angles are
+        scored on a small thumbnail, so the search is cheap.
+        """
+        from PIL import Image, ImageOps
+        
+        sample = ImageOps.invert(image)
+        sample.thumbnail((600, 600))
+        
+        def score(angle):
+            rotated = sample.rotate(angle, resample=Image.BILINEAR, expand=False)
+            # Squashing to one column averages each row into its ink level
+            rows = list(rotated.resize((1, rotated.height), Image.BOX).getdata())
+            mean = sum(rows) / len(rows)
+            return sum((r - mean) ** 2 for r in rows)
+            
+        steps = int(max_angle / step)
+        angles = [i * step for i in range(-steps, steps + 1)]
+        best_angle = max(angles, key=score)
+        if abs(best_angle) < step:
+            return image
+        return image.rotate(best_angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+    
+    def _perform_ocr(self, image_data):
+        """Perform OCR on image with the configured OCR backend."""
+        return self._perform_ocr_layout(image_data)[0]
+    
+    @profiling.staged('ocr')
+    def _perform_ocr_layout(self, image_data):
+        """Perform OCR and return the text with word boxes.
+        
+        Pages go to Cloud Vision, local Tesseract or either, as OcrRouter
+        decides from OCR_BACKEND.
+        
+        Returns:
+            tuple: (full text, [(word, (left, top, right, bottom))]) with boxes as
+                fractions of the image size
+        """
+        text, words, _ = self.ocr.recognize(image_data)
+        return text, words
     
     def _classify_document(self, text):
         """Classify document type based on content."""
@@ -140,22 +602,124 @@ class DocumentProcessor:
                 
         return 'unknown'
     
-    def _extract_information(self, text, doc_type):
-        """Extract relevant information based on document type."""
-        doc = self.nlp(text)
+    @profiling.staged('regex')
+    def _extract_information(self, text, doc_type, run_ner=True, matched=None):
+        """Extract relevant information based on document type.
+        
+        Fields come from regular expressions; spaCy NER only runs for invoices
+        whose seller or buyer the patterns could not find.
+        
+        Args:
+            text (str): OCR text
+            doc_type (str): Document type from _classify_document
+            run_ner (bool): False to leave missing parties empty
+            matched (dict): Receives field -> matching invoice pattern name
+        """
         info = {}
         
         if doc_type == 'invoice':
-            info = self._extract_invoice_info(text, doc)
+            info = self._extract_invoice_info(text, matched=matched)
+            if run_ner and self._needs_ner(doc_type, info):
+                self._apply_ner_companies(info, self._run_ner(text))
         elif doc_type == 'quotation':
-            info = self._extract_quotation_info(doc)
+            info = self._extract_quotation_info(None)
         elif doc_type == 'contract':
-            info = self._extract_contract_info(doc)
+            info = self._extract_contract_info(None)
             
         return info
     
-    def _extract_invoice_info(self, text, doc):
-        """Extract information from invoice."""
+    def _needs_ner(self, doc_type, info):
+        """Check whether NER could still fill in an invoice party."""
+        return doc_type == 'invoice' and not (info.get('seller') and info.get('buyer'))
+    
+    def _non_ner_pipes(self):
+        """Pipeline components entity recognition does not need."""
+        return [name for name in self.nlp.pipe_names if name not in ('tok2vec', 'ner')]
+    
+    def _ner_window(self, text):
+        """Trim text to the lines most likely to name the parties, up to NER_MAX_CHARS."""
+        if len(text) <= config.NER_MAX_CHARS:
+            return text
+        lines = [line for line in text.splitlines()
+                 if any(hint in line for hint in COMPANY_HINTS)]
+        window = '\n'.join(lines) if lines else text
+        return window[:config.NER_MAX_CHARS]
+    
+    @profiling.staged('ner')
+    def _run_ner(self, text):
+        """Run only the NER component on the relevant part of the text.
+        
+        Concurrent calls from other documents are batched by the NerBatcher.
+        """
+        return self._ner_batcher(self._ner_window(text))
+    
+    def _pipe_ner(self, windows):
+        """Run only the NER component over a batch of text windows with nlp.pipe.
+        
+        Components are disabled for this call only, not on the shared pipeline,
+        so concurrent attachment threads cannot change each other's pipes.
+        """
+        return list(self.nlp.pipe(windows, batch_size=config.NLP_BATCH_SIZE,
+                                  n_process=config.NLP_PROCESSES, disable=self._non_ner_pipes()))
+    
+    def _apply_ner_companies(self, info, doc):
+        """Fill an empty seller, then an empty buyer, from ORG entities."""
+        known = {info.get('seller'), info.get('buyer')}
+        for ent in doc.ents:
+            if ent.label_ != 'ORG' or ent.text in known:
+                continue
+            if not info.get('seller'):
+                info['seller'] = ent.text
+            elif not info.get('buyer'):
+                info['buyer'] = ent.text
+            else:
+                break
+            known.add(ent.text)
+    
+    def apply_batched_ner(self, results):
+        """Run the NER fallback still due on process_document(run_ner=False) results.
+        
+        All texts go through nlp.pipe together, and each result's parties are
+        filled in place.
+        
+        Args:
+            results (list): process_document results; None entries are skipped
+        """
+        pending = [r for r in results if r and r.get('needs_ner')]
+        if not pending:
+            return
+        with profiling.stage('ner'):
+            docs = self._pipe_ner([self._ner_window(r['extracted_text']) for r in pending])
+        for result, doc in zip(pending, docs):
+            self._apply_ner_companies(result['extracted_info'], doc)
+            result['needs_ner'] = False
+    
+    def process_documents(self, documents):
+        """Process several documents, batching the NER fallback through nlp.pipe.
+        
+        Args:
+            documents (list): (file_data, mime_type, sender) tuples
+            
+        Returns:
+            list: process_document results in the same order
+        """
+        results = [
+            self.process_document(file_data, mime_type, sender=sender, run_ner=False)
+            for file_data, mime_type, sender in documents
+        ]
+        self.apply_batched_ner(results)
+        return results
+    
+    def _extract_invoice_info(self, text, doc=None, patterns=None, matched=None):
+        """Extract information from invoice.
+        
+        Args:
+            text (str): OCR text
+            doc: Optional spaCy Doc whose ORG entities fill parties the patterns missed
+            patterns (dict): Optional field -> pattern names to restrict matching to,
+                as remembered in a sender profile; fields absent from it are skipped
+            matched (dict): Optional dict that receives field -> matching pattern name
+        """
         info = {
             'invoice_number': '',
             'invoice_date': '',
@@ -165,75 +729,41 @@ class DocumentProcessor:
             'tax_id': ''
         }
         
-        # Extract invoice number (統一發票號碼格式: XX-XXXXXXXX)
-        invoice_number_pattern = r'[A-Z]{2}[-]?\d{8}'
-        invoice_matches = re.findall(invoice_number_pattern, text)
-        if invoice_matches:
-            info['invoice_number'] = invoice_matches[0].replace('-', '')
-            
-        # Extract date (支援多種日期格式)
-        date_patterns = [
-            r'(\d{4})[年/\-](\d{1,2})[月/\-](\d{1,2})',  # 2024年03月15日
-            r'(\d{3})[年/\-](\d{1,2})[月/\-](\d{1,2})',   # 民國113年03月15日
-            r'(\d{1,2})[/\-](\d{1,2})[/\-](\d{4})',      # 03/15/2024
-        ]
-        
-        for pattern in date_patterns:
-            date_matches = re.findall(pattern, text)
-            if date_matches:
-                year, month, day = date_matches[0]
-                # 處理民國年
-                if len(year) == 3:
-                    year = str(int(year) + 1911)
-                info['invoice_date'] = f"{year}-{month:0>2}-{day:0>2}"
-                break
-                
-        # Extract tax ID (統一編號格式: 8位數字)
-        tax_id_pattern = r'統一編號[：: ]*(\d{8})'
-        tax_id_matches = re.findall(tax_id_pattern, text)
-        if tax_id_matches:
-            info['tax_id'] = tax_id_matches[0]
-            
-        # Extract seller and buyer
-        company_patterns = [
-            r'公司名稱[：: ]*([^\n]+)',
-            r'買受人[：: ]*([^\n]+)',
-            r'賣方[：: ]*([^\n]+)',
-            r'商店名稱[：: ]*([^\n]+)'
-        ]
-        
-        companies = []
-        for pattern in company_patterns:
-            matches = re.findall(pattern, text)
-            companies.extend(matches)
-            
-        # Also use spaCy NER to find organization names
-        for ent in doc.ents:
-            if ent.label_ == 'ORG':
-                companies.append(ent.text)
-                
-        # Remove duplicates and assign roles
-        companies = list(dict.fromkeys(companies))
-        if companies:
-            info['seller'] = companies[0]
-            if len(companies) > 1:
-                info['buyer'] = companies[1]
-                
-        # Extract amount
-        amount_patterns = [
-            r'總計[：: ]*NT?\$?(\d+[,\d]*\d*)',
-            r'總額[：: ]*NT?\$?(\d+[,\d]*\d*)',
-            r'金額[：: ]*NT?\$?(\d+[,\d]*\d*)'
-        ]
-        
-        for pattern in amount_patterns:
-            amount_matches = re.findall(pattern, text)
-            if amount_matches:
-                info['amount'] = amount_matches[0].replace(',', '')
-                break
+        for field, field_patterns in INVOICE_PATTERNS.items():
+            allowed = patterns.get(field, []) if patterns is not None else None
+            for name, pattern in field_patterns:
+                if allowed is not None and name not in allowed:
+                    continue
+                match = pattern.search(text)
+                if match:
+                    info[field] = self._invoice_field_value(field, name, match)
+                    if matched is not None:
+                        matched[field] = name
+                    break
+                    
+        # Fall back to spaCy organisation entities for missing parties
+        if doc is not None:
+            self._apply_ner_companies(info, doc)
                 
         return info
     
+    def _invoice_field_value(self, field, pattern_name, match):
+        """Normalise a regex match into the stored value of an invoice field."""
+        if field == 'invoice_number':
+            return match.group(0).replace('-', '')
+        if field == 'invoice_date':
+            if pattern_name == 'date_mdy':
+                month, day, year = match.groups()
+            else:
+                year, month, day = match.groups()
+            # 處理民國年
+            if len(year) == 3:
+                year = str(int(year) + 1911)
+            return f"{year}-{month:0>2}-{day:0>2}"
+        if field == 'amount':
+            return match.group(1).replace(',', '')
+        return match.group(1).strip()
+    
     def _extract_quotation_info(self, doc):
         """Extract information from quotation."""
         info = {
@@ -1,57 +1,224 @@
-import os
-import pickle
+import json
 import logging
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+import os
+import re
+import threading
 import io
+from rate_limit import limited_request_class, get_adaptive_limiter
+from credentials import get_credentials_manager
+import profiling
 import config
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+# Drive accepts at most 100 calls per batch request
+DRIVE_BATCH_LIMIT = 100
+# Parents per files.list query when listing the files of the whole tree
+INDEX_PARENTS_PER_QUERY = 40
+
+def _name_parts(name):
+    """Split a file name into its '_'-separated parts, without the extension."""
+    return set(re.split(r'[_\s]+', os.path.splitext(name or '')[0])) - {''}
+
+class DriveIndex:
+    """Local copy of the folders and files under DRIVE_FOLDER_ID.
+
+    Answers folder lookups and duplicate checks without a files.list call per
+    lookup. DriveService.sync_index keeps it current from the Drive changes
+    feed, resuming from `page_token`, and persists it between runs.
+    """
+
+    def __init__(self, root_id, page_token=None):
+        self.root_id = root_id
+        self.page_token = page_token
+        self.items = {}
+        self._folders = {}
+        # (parent, name) -> file ids, and name part -> file ids
+        self._files = {}
+        self._parts = {}
+        self._lock = threading.RLock()
+
+    def add(self, item):
+        """Add or replace a file resource with id, name, mimeType and parents."""
+        item = {k: item.get(k) for k in ('id', 'name', 'mimeType', 'parents')}
+        with self._lock:
+            self.remove(item['id'])
+            self.items[item['id']] = item
+            if item.get('mimeType') == FOLDER_MIME_TYPE:
+                for parent in item.get('parents') or []:
+                    self._folders.setdefault((parent, item['name']), item['id'])
+                return
+            for parent in item.get('parents') or []:
+                self._files.setdefault((parent, item['name']), set()).add(item['id'])
+            for part in _name_parts(item['name']):
+                self._parts.setdefault(part, set()).add(item['id'])
+
+    def remove(self, item_id):
+        with self._lock:
+            item = self.items.pop(item_id, None)
+            if not item:
+                return
+            if item.get('mimeType') == FOLDER_MIME_TYPE:
+                for parent in item.get('parents') or []:
+                    if self._folders.get((parent, item['name'])) == item_id:
+                        del self._folders[(parent, item['name'])]
+                return
+            for parent in item.get('parents') or []:
+                self._discard(self._files, (parent, item['name']), item_id)
+            for part in _name_parts(item['name']):
+                self._discard(self._parts, part, item_id)
+
+    @staticmethod
+    def _discard(ids_by_key, key, item_id):
+        ids = ids_by_key.get(key)
+        if ids is not None:
+            ids.discard(item_id)
+            if not ids:
+                del ids_by_key[key]
+
+    def __contains__(self, item_id):
+        return item_id == self.root_id or item_id in self.items
+
+    def find_folder(self, name, parent_id=None):
+        return self._folders.get((parent_id or self.root_id, name))
+
+    def resolve_path(self, path):
+        """Return the id of the folder at `path` below the root, or None if any part is missing."""
+        folder_id = self.root_id
+        for name in path:
+            folder_id = self.find_folder(name, folder_id)
+            if not folder_id:
+                return None
+        return folder_id
+
+    def find_file(self, name, parent_id):
+        with self._lock:
+            ids = self._files.get((parent_id, name))
+            return next(iter(ids)) if ids else None
+
+    def files_containing(self, *parts):
+        """Return names of files that have every one of `parts` as a '_'-separated part.
+
+        Generated invoice filenames keep the date and the invoice number as
+        separate parts, so both are looked up directly.
+        """
+        with self._lock:
+            ids = set.intersection(*(self._parts.get(part, set()) for part in parts)) if parts else set()
+            return [self.items[item_id]['name'] for item_id in ids]
+
+    def prune(self):
+        """Drop items no longer reachable from the root, e.g. after a folder moved out."""
+        with self._lock:
+            reachable = {self.root_id: True}
+
+            def reaches_root(item_id, seen=()):
+                if item_id not in reachable:
+                    item = self.items.get(item_id)
+                    reachable[item_id] = bool(item) and item_id not in seen and any(
+                        reaches_root(parent, seen + (item_id,)) for parent in item.get('parents') or [])
+                return reachable[item_id]
+
+            for item_id in [i for i in self.items if not reaches_root(i)]:
+                self.remove(item_id)
+
+    def save(self, path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with self._lock:
+            data = {'root_id': self.root_id, 'page_token': self.page_token,
+                    'items': list(self.items.values())}
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.error(f"Error saving Drive index: {str(e)}")
+
+    @classmethod
+    def load(cls, path):
+        """Return the index saved at `path`, or None if there is no usable one."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Error loading Drive index, rebuilding: {str(e)}")
+            return None
+        index = cls(data['root_id'], data.get('page_token'))
+        for item in data.get('items', []):
+            index.add(item)
+        return index
+
 class DriveService:
-    def __init__(self):
-        """Initialize the Drive service."""
+    def __init__(self, folder_coordinator=None, rate_limiter=None, credentials_manager=None, index=None):
+        """Initialize the Drive service.
+        
+        Args:
+            folder_coordinator: Optional shared broker used to serialise folder
+                creation across worker processes (see distributed.py)
+            rate_limiter: Optional RateLimiter shared by every thread calling Drive
+            credentials_manager: Optional CredentialsManager, defaults to the shared one
+            index (DriveIndex): Optional index already synced by another DriveService
+        """
+        self.rate_limiter = rate_limiter
+        self.credentials_manager = credentials_manager or get_credentials_manager()
         self.service = self._get_drive_service()
+        self.folder_coordinator = folder_coordinator
+        self.index = index
         
     def _get_drive_service(self):
         """Initialize Google Drive API service."""
-        creds = None
-        # Token file stores the user's access and refresh tokens
-        if os.path.exists('drive_token.pickle'):
-            with open('drive_token.pickle', 'rb') as token:
-                try:
-                    creds = pickle.load(token)
-                except:
-                    pass
-                
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                try:
-                    creds.refresh(Request())
-                except:
-                    creds = None
-                    
-            if not creds:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    config.GOOGLE_APPLICATION_CREDENTIALS, config.DRIVE_SCOPES)
-                creds = flow.run_local_server(port=0)
-                
-            # Save the credentials for the next run
-            with open('drive_token.pickle', 'wb') as token:
-                pickle.dump(creds, token)
-                
+        from googleapiclient.discovery import build
+        
+        creds = self.credentials_manager.get_credentials()
+        
+        kwargs = {}
+        adaptive = get_adaptive_limiter('drive')
+        if self.rate_limiter or adaptive:
+            kwargs['requestBuilder'] = limited_request_class(self.rate_limiter, adaptive)
+        
         # Build the service with static discovery document
-        return build('drive', 'v3', credentials=creds, cache_discovery=False)
+        return build('drive', 'v3', credentials=creds, cache_discovery=False, **kwargs)
     
+    @profiling.staged('drive_folders')
     def get_or_create_folder(self, folder_name, parent_folder_id=None):
         """Get existing folder or create new one."""
+        if not self.folder_coordinator:
+            return self._get_or_create_folder(folder_name, parent_folder_id)
+            
+        # Workers share one folder id per (parent, name) so that concurrent
+        # workers never create the same year/month/vendor folder twice
+        key = f"{parent_folder_id or config.DRIVE_FOLDER_ID}/{folder_name}"
+        folder_id = self.folder_coordinator.get_folder(key)
+        if folder_id:
+            return folder_id
+            
         try:
+            with self.folder_coordinator.folder_lock(key):
+                folder_id = self.folder_coordinator.get_folder(key)
+                if not folder_id:
+                    folder_id = self._get_or_create_folder(folder_name, parent_folder_id)
+                    if folder_id:
+                        self.folder_coordinator.set_folder(key, folder_id)
+                return folder_id
+        except Exception as e:
+            logger.error(f"Error coordinating folder creation: {str(e)}")
+            return None
+    
+    def _get_or_create_folder(self, folder_name, parent_folder_id=None):
+        """Look up a folder by name under its parent, creating it if missing."""
+        try:
+            if self.index is not None:
+                # The synced index is authoritative, so a miss means the folder does not exist
+                folder_id = self.index.find_folder(folder_name, parent_folder_id)
+                return folder_id or self.create_folder(folder_name, parent_folder_id)
+            
             # Search for existing folder
             query = [
                 f"name='{folder_name}'",
-                "mimeType='application/vnd.google-apps.folder'",
+                f"mimeType='{FOLDER_MIME_TYPE}'",
                 "trashed=false"
             ]
             
@@ -80,12 +247,177 @@ class DriveService:
             logger.error(f"Error getting/creating folder: {str(e)}")
             return None
     
+    @profiling.staged('drive_index')
+    def sync_index(self, force=False):
+        """Bring the local DriveIndex up to date and make lookups use it.
+        
+        The first run lists the whole tree; later runs load DRIVE_INDEX_FILE
+        and apply only the changes reported by the Drive changes feed since
+        the saved page token.
+        
+        Args:
+            force (bool): Sync again even if this service already holds an index
+            
+        Returns:
+            DriveIndex: The synced index, or None if Drive could not be read
+        """
+        if self.index is not None and not force:
+            return self.index
+        try:
+            index = self.index or DriveIndex.load(config.DRIVE_INDEX_FILE)
+            if index and index.page_token and index.root_id == self._root_id():
+                self._apply_changes(index)
+            else:
+                # Take the token before listing so changes made meanwhile are not lost
+                page_token = self.service.changes().getStartPageToken().execute()['startPageToken']
+                index = self.load_index()
+                index.page_token = page_token
+            
+            index.save(config.DRIVE_INDEX_FILE)
+            self.index = index
+            return index
+            
+        except Exception as e:
+            logger.error(f"Error syncing Drive index: {str(e)}")
+            return None
+    
+    def _root_id(self):
+        # DRIVE_FOLDER_ID may be an alias such as 'root'; parents always hold real ids
+        return self.service.files().get(fileId=config.DRIVE_FOLDER_ID, fields='id').execute()['id']
+    
+    def _apply_changes(self, index):
+        """Apply changes().list deltas since index.page_token to the index."""
+        page_token, changed = index.page_token, 0
+        while page_token:
+            results = self.service.changes().list(
+                pageToken=page_token,
+                spaces='drive',
+                pageSize=1000,
+                includeRemoved=True,
+                fields='nextPageToken, newStartPageToken, '
+                       'changes(changeType, removed, fileId, file(id, name, mimeType, parents, trashed))'
+            ).execute()
+            
+            for change in results.get('changes', []):
+                if change.get('changeType', 'file') != 'file':
+                    continue
+                item = change.get('file')
+                if change.get('removed') or not item or item.get('trashed'):
+                    if change['fileId'] in index:
+                        index.remove(change['fileId'])
+                        changed += 1
+                    continue
+                
+                was_indexed = item['id'] in index
+                if was_indexed or any(parent in index for parent in item.get('parents') or []):
+                    index.add(item)
+                    changed += 1
+                    if not was_indexed and item.get('mimeType') == FOLDER_MIME_TYPE:
+                        # A folder moved into the tree brings its whole subtree
+                        self._index_subtree(index, item['id'])
+            
+            if 'newStartPageToken' in results:
+                index.page_token = results['newStartPageToken']
+            page_token = results.get('nextPageToken')
+        
+        # Items whose folder was moved out or deleted are no longer in the tree
+        index.prune()
+        logger.info(f"Applied {changed} Drive changes to the index")
+    
+    def _index_subtree(self, index, folder_id):
+        pending = [folder_id]
+        while pending:
+            parent = pending.pop()
+            for item in self._list_files(f"'{parent}' in parents and trashed=false"):
+                index.add(item)
+                if item.get('mimeType') == FOLDER_MIME_TYPE:
+                    pending.append(item['id'])
+    
+    def load_index(self):
+        """Read the whole folder tree under DRIVE_FOLDER_ID into a new DriveIndex.
+        
+        Folders are listed with one paged query, files with one paged query
+        per INDEX_PARENTS_PER_QUERY folders.
+        """
+        index = DriveIndex(self._root_id())
+        for folder in self._list_files(f"mimeType='{FOLDER_MIME_TYPE}' and trashed=false"):
+            index.add(folder)
+        # Keep only folders whose ancestry reaches the root folder
+        index.prune()
+        
+        tree_ids = [index.root_id] + list(index.items)
+        for start in range(0, len(tree_ids), INDEX_PARENTS_PER_QUERY):
+            parents = ' or '.join(f"'{folder_id}' in parents"
+                                  for folder_id in tree_ids[start:start + INDEX_PARENTS_PER_QUERY])
+            for item in self._list_files(f"mimeType!='{FOLDER_MIME_TYPE}' and trashed=false and ({parents})"):
+                index.add(item)
+        
+        logger.info(f"Indexed {len(tree_ids) - 1} folders and {len(index.items) - len(tree_ids) + 1} files")
+        return index
+    
+    def _list_files(self, query):
+        """Yield every file matching `query`, following nextPageToken."""
+        page_token = None
+        while True:
+            results = self.service.files().list(
+                q=query,
+                spaces='drive',
+                fields='nextPageToken, files(id, name, mimeType, parents)',
+                pageSize=1000,
+                pageToken=page_token
+            ).execute()
+            yield from results.get('files', [])
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return
+    
+    @profiling.staged('drive_folders')
+    def create_folders_batch(self, folders):
+        """Create several folders with batched requests.
+        
+        Args:
+            folders (list): (folder_name, parent_folder_id) tuples
+            
+        Returns:
+            list: Folder ids in the same order, None where creation failed
+        """
+        folder_ids = [None] * len(folders)
+        
+        def callback(request_id, response, exception):
+            if exception:
+                logger.error(f"Error creating folder: {str(exception)}")
+                return
+            i = int(request_id)
+            folder_ids[i] = response.get('id')
+            if self.index is not None and folder_ids[i]:
+                folder_name, parent_folder_id = folders[i]
+                self.index.add({'id': folder_ids[i], 'name': folder_name, 'mimeType': FOLDER_MIME_TYPE,
+                                'parents': [parent_folder_id or self.index.root_id]})
+        
+        for start in range(0, len(folders), DRIVE_BATCH_LIMIT):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for i in range(start, min(start + DRIVE_BATCH_LIMIT, len(folders))):
+                folder_name, parent_folder_id = folders[i]
+                batch.add(self.service.files().create(
+                    body={
+                        'name': folder_name,
+                        'mimeType': FOLDER_MIME_TYPE,
+                        'parents': [parent_folder_id or config.DRIVE_FOLDER_ID]
+                    },
+                    fields='id'
+                ), request_id=str(i))
+            try:
+                batch.execute()
+            except Exception as e:
+                logger.error(f"Error executing folder batch: {str(e)}")
+        return folder_ids
+    
     def create_folder(self, folder_name, parent_folder_id=None):
         """Create a new folder in Google Drive."""
         try:
             file_metadata = {
                 'name': folder_name,
-                'mimeType': 'application/vnd.google-apps.folder',
+                'mimeType': FOLDER_MIME_TYPE,
                 'parents': [parent_folder_id if parent_folder_id else config.DRIVE_FOLDER_ID]
             }
             
@@ -98,25 +430,44 @@ class DriveService:
             if not folder_id:
                 logger.error(f"Failed to create folder: {folder_name}")
                 return None
-                
+            
+            if self.index is not None:
+                self.index.add({'id': folder_id, 'name': folder_name, 'mimeType': FOLDER_MIME_TYPE,
+                                'parents': [parent_folder_id or self.index.root_id]})
             return folder_id
             
         except Exception as e:
             logger.error(f"Error creating folder: {str(e)}")
             return None
     
-    def upload_file(self, file_data, filename, mime_type, folder_id):
-        """Upload file to Google Drive."""
+    @profiling.staged('drive_upload')
+    def upload_file(self, file_data, filename, mime_type, folder_id, metadata=None):
+        """Upload file to Google Drive.
+        
+        Args:
+            file_data: File contents as bytes or a readable, seekable file object
+            metadata (dict): Optional document metadata set with the upload,
+                saving the separate update_file_metadata call
+        """
         try:
             file_metadata = {
                 'name': filename,
                 'parents': [folder_id]
             }
+            if metadata:
+                file_metadata.update(self._metadata_body(metadata))
             
-            fh = io.BytesIO(file_data)
+            if hasattr(file_data, 'read'):
+                fh = file_data
+                fh.seek(0)
+            else:
+                fh = io.BytesIO(file_data)
+            from googleapiclient.http import MediaIoBaseUpload
+            # Bounded chunks keep the uploader from reading the whole file into memory
             media = MediaIoBaseUpload(
                 fh,
                 mimetype=mime_type,
+                chunksize=config.UPLOAD_CHUNK_SIZE,
                 resumable=True
             )
             
@@ -126,6 +477,10 @@ class DriveService:
                 fields='id, name, webViewLink'
             ).execute()
             
+            if self.index is not None:
+                self.index.add({'id': file.get('id'), 'name': file.get('name'),
+                                'mimeType': mime_type, 'parents': [folder_id]})
+            
             return {
                 'file_id': file.get('id'),
                 'file_name': file.get('name'),
@@ -133,32 +488,34 @@ class DriveService:
             }
             
         except Exception as e:
-            print(f"Error uploading file to Drive: {str(e)}")
+            logger.error(f"Error uploading file to Drive: {str(e)}")
             return None
     
+    @profiling.staged('drive_upload')
     def update_file_metadata(self, file_id, metadata):
         """Update file metadata in Google Drive."""
         try:
-            file_metadata = {
-                'description': str(metadata),
-                'properties': {
-                    'document_type': metadata.get('document_type', ''),
-                    'processed_date': metadata.get('processed_date', ''),
-                    'source_email': metadata.get('source_email', '')
-                }
-            }
-            
             self.service.files().update(
                 fileId=file_id,
-                body=file_metadata,
+                body=self._metadata_body(metadata),
                 fields='id, name, description, properties'
             ).execute()
             
             return True
             
         except Exception as e:
-            print(f"Error updating file metadata: {str(e)}")
+            logger.error(f"Error updating file metadata: {str(e)}")
             return False
             
+    def _metadata_body(self, metadata):
+        return {
+            'description': str(metadata),
+            'properties': {
+                'document_type': metadata.get('document_type', ''),
+                'processed_date': metadata.get('processed_date', ''),
+                'source_email': metadata.get('source_email', '')
+            }
+        }
+    
     # Add alias for get_or_create_folder
     create_folder_if_not_exists = get_or_create_folder 
\ No newline at end of file
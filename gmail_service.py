@@ -1,70 +1,95 @@
-import os
+import logging
 import base64
 import email
-import pickle
+import mimetypes
 from datetime import datetime, timedelta
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.discovery_cache import DISCOVERY_DOC_MAX_AGE
+from attachment_buffer import AttachmentBuffer
+import profiling
+from rate_limit import limited_request_class, get_adaptive_limiter
+from credentials import get_credentials_manager
 import config
 
+logger = logging.getLogger(__name__)
+
+# messages().batchModify accepts at most 1000 ids per call
+BATCH_MODIFY_LIMIT = 1000
+
+# Deepest multipart nesting requested from and walked in a message payload;
+# forwarded mail adds a message/rfc822 level plus its own multipart levels
+MIME_MAX_DEPTH = 8
+
+def _payload_fields(depth):
+    """Build a partial-response field mask for a payload nested `depth` levels."""
+    part_fields = 'partId,mimeType,filename,body(attachmentId,size)'
+    fields = part_fields
+    for _ in range(depth):
+        fields = f'{part_fields},parts({fields})'
+    return fields
+
+# Listing only needs headers and part metadata, never the message bodies
+MESSAGE_FIELDS = f'id,payload(headers(name,value),{_payload_fields(MIME_MAX_DEPTH)})'
+
+# Base64 characters decoded per step when streaming an attachment to disk;
+# a multiple of 4 so every chunk decodes independently
+DECODE_CHUNK_SIZE = 4 * 64 * 1024
+
 class GmailService:
-    def __init__(self):
+    def __init__(self, rate_limiter=None, credentials_manager=None):
+        """Initialize the Gmail service.
+        
+        Args:
+            rate_limiter: Optional RateLimiter shared by every thread calling Gmail
+            credentials_manager: Optional CredentialsManager, defaults to the shared one
+        """
+        self.rate_limiter = rate_limiter
+        self.credentials_manager = credentials_manager or get_credentials_manager()
         self.service = self._get_gmail_service()
+        self._label_id = None
         
     def _get_gmail_service(self):
         """Initialize Gmail API service."""
-        creds = None
-        # Token file stores the user's access and refresh tokens
-        if os.path.exists('token.pickle'):
-            with open('token.pickle', 'rb') as token:
-                try:
-                    creds = pickle.load(token)
-                except:
-                    pass
-                
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                try:
-                    creds.refresh(Request())
-                except:
-                    creds = None
-                    
-            if not creds:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    config.GMAIL_CREDENTIALS, config.GMAIL_SCOPES)
-                creds = flow.run_local_server(port=0)
-                
-            # Save the credentials for the next run
-            with open('token.pickle', 'wb') as token:
-                pickle.dump(creds, token)
-                
+        from googleapiclient.discovery import build
+        
+        creds = self.credentials_manager.get_credentials()
+        
+        kwargs = {}
+        adaptive = get_adaptive_limiter('gmail')
+        if self.rate_limiter or adaptive:
+            kwargs['requestBuilder'] = limited_request_class(self.rate_limiter, adaptive)
+        
         # Build the service with static discovery document
-        return build('gmail', 'v1', credentials=creds, cache_discovery=False)
+        return build('gmail', 'v1', credentials=creds, cache_discovery=False, **kwargs)
     
-    def get_emails_with_attachments(self, days_back=config.DAYS_TO_SEARCH):
-        """Fetch emails with attachments from the last X days."""
+    @profiling.staged('gmail_list')
+    def get_emails_with_attachments(self, days_back=config.DAYS_TO_SEARCH, after=None, before=None):
+        """Fetch emails with attachments from the last X days.
+        
+        Args:
+            days_back (int): Days to search back when `after` is not given
+            after (datetime): Optional start of the window, inclusive
+            before (datetime): Optional end of the window, exclusive
+        """
         try:
-            # Calculate date range
-            date_after = (datetime.now() - timedelta(days=days_back)).strftime('%Y/%m/%d')
-            query = f'{config.EMAIL_SEARCH_QUERY} after:{date_after}'
+            # Skip mail already labelled as processed, whatever GMAIL_LABEL is set to
+            query = f'{config.GMAIL_QUERY} -label:"{config.GMAIL_LABEL}"'
+            if after is None:
+                # Calculate date range
+                date_after = (datetime.now() - timedelta(days=days_back)).strftime('%Y/%m/%d')
+                query += f' after:{date_after}'
+            else:
+                # Epoch seconds keep adjacent backfill windows from overlapping
+                query += f' after:{int(after.timestamp()) - 1}'
+            if before is not None:
+                query += f' before:{int(before.timestamp())}'
             
-            # Get list of messages
-            results = self.service.users().messages().list(
-                userId='me',
-                q=query
-            ).execute()
-            
-            messages = results.get('messages', [])
             emails_with_attachments = []
             
-            for message in messages:
+            for message_id in self._list_message_ids(query):
                 msg = self.service.users().messages().get(
                     userId='me',
-                    id=message['id'],
-                    format='full'
+                    id=message_id,
+                    format='full',
+                    fields=MESSAGE_FIELDS
                 ).execute()
                 
                 if self._has_attachments(msg):
@@ -75,18 +100,45 @@ class GmailService:
             return emails_with_attachments
             
         except Exception as e:
-            print(f"Error fetching emails: {str(e)}")
+            logger.error(f"Error fetching emails: {str(e)}")
             return []
     
+    def _list_message_ids(self, query):
+        """Yield the ids of every message matching `query`, following nextPageToken."""
+        page_token = None
+        while True:
+            results = self.service.users().messages().list(
+                userId='me',
+                q=query,
+                maxResults=500,
+                pageToken=page_token,
+                fields='nextPageToken,messages(id)'
+            ).execute()
+            for message in results.get('messages', []):
+                yield message['id']
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return
+    
+    def _iter_attachment_parts(self, payload):
+        """Yield parts with a filename, walking nested multiparts in document order.
+        
+        Uses an explicit stack rather than recursion, so deeply nested
+        multipart/mixed, multipart/alternative and forwarded message/rfc822
+        trees are all covered and callers can stop at the first match.
+        """
+        stack = [(payload, 0)]
+        while stack:
+            part, depth = stack.pop()
+            if part.get('filename'):
+                yield part
+            if depth < MIME_MAX_DEPTH:
+                for child in reversed(part.get('parts', [])):
+                    stack.append((child, depth + 1))
+    
     def _has_attachments(self, message):
         """Check if email has attachments."""
-        if 'parts' not in message['payload']:
-            return False
-            
-        for part in message['payload']['parts']:
-            if part.get('filename'):
-                return True
-        return False
+        return next(self._iter_attachment_parts(message['payload']), None) is not None
     
     def _process_email(self, message):
         """Process email and extract relevant information."""
@@ -97,15 +149,19 @@ class GmailService:
             date = next((h['value'] for h in headers if h['name'].lower() == 'date'), '')
             
             attachments = []
-            if 'parts' in message['payload']:
-                for part in message['payload']['parts']:
-                    if part.get('filename'):
-                        attachment = {
-                            'id': part['body'].get('attachmentId'),
-                            'filename': part['filename'],
-                            'mimeType': part['mimeType']
-                        }
-                        attachments.append(attachment)
+            for part in self._iter_attachment_parts(message['payload']):
+                body = part.get('body', {})
+                attachment = {
+                    # Small parts carry their data inline and have no attachmentId
+                    'id': body.get('attachmentId'),
+                    'part_id': part.get('partId'),
+                    'filename': part['filename'],
+                    'mimeType': self._resolve_mime_type(part),
+                    'size': body.get('size', 0)
+                }
+                # Skip unwanted files before spending bandwidth on them
+                if self._is_supported_attachment(attachment):
+                    attachments.append(attachment)
             
             return {
                 'message_id': message['id'],
@@ -116,21 +172,149 @@ class GmailService:
             }
             
         except Exception as e:
-            print(f"Error processing email: {str(e)}")
+            logger.error(f"Error processing email: {str(e)}")
             return None
     
-    def download_attachment(self, message_id, attachment_id):
-        """Download attachment from Gmail."""
+    def _resolve_mime_type(self, part):
+        """Return the part's MIME type, guessing from the filename for generic types."""
+        mime_type = part.get('mimeType', '')
+        if mime_type in ('', 'application/octet-stream'):
+            guessed, _ = mimetypes.guess_type(part.get('filename', ''))
+            if guessed:
+                return guessed
+        return mime_type
+    
+    def _is_supported_attachment(self, attachment):
+        """Check an attachment's type and declared size against the config limits."""
+        # ZIP files are opened later and their supported members processed one by one
+        if attachment['mimeType'] not in config.SUPPORTED_MIME_TYPES and \
+                attachment['mimeType'] not in config.ARCHIVE_MIME_TYPES:
+            return False
+        if attachment['size'] > config.MAX_FILE_SIZE:
+            logger.warning(f"Skipping oversized attachment: {attachment['filename']} ({attachment['size']} bytes)")
+            return False
+        return True
+    
+    def _get_inline_part_data(self, message_id, part_id):
+        """Fetch the inline base64 data of a part that has no attachmentId."""
+        msg = self.service.users().messages().get(
+            userId='me',
+            id=message_id,
+            format='full',
+            fields='payload'
+        ).execute()
+        
+        stack = [msg['payload']]
+        while stack:
+            part = stack.pop()
+            if part.get('partId') == part_id:
+                return part.get('body', {}).get('data', '')
+            stack.extend(part.get('parts', []))
+        raise KeyError(f"Part {part_id} not found in message {message_id}")
+    
+    @profiling.staged('gmail_download')
+    def download_attachment_stream(self, message_id, attachment_id, part_id=None):
+        """Download attachment from Gmail into a shared attachment buffer.
+        
+        The base64 payload is decoded chunk by chunk, so only one decoded copy
+        exists, on disk and memory-mapped once it is larger than SPOOL_MAX_MEMORY.
+        
+        Args:
+            message_id (str): Gmail message id
+            attachment_id (str): Attachment id, or None for inline-data parts
+            part_id (str): Part id used to locate inline-data parts
+        
+        Returns:
+            AttachmentBuffer: Sealed buffer with the decoded bytes, or None on failure
+        """
+        buffer = None
         try:
-            attachment = self.service.users().messages().attachments().get(
+            if attachment_id:
+                attachment = self.service.users().messages().attachments().get(
+                    userId='me',
+                    messageId=message_id,
+                    id=attachment_id
+                ).execute()
+                data = attachment.pop('data')
+                del attachment
+            else:
+                data = self._get_inline_part_data(message_id, part_id)
+            
+            buffer = AttachmentBuffer(size_hint=len(data) * 3 // 4)
+            for start in range(0, len(data), DECODE_CHUNK_SIZE):
+                chunk = data[start:start + DECODE_CHUNK_SIZE]
+                # Gmail may drop the trailing padding on the final chunk
+                chunk += '=' * (-len(chunk) % 4)
+                buffer.write(base64.urlsafe_b64decode(chunk))
+                if buffer.tell() > config.MAX_FILE_SIZE:
+                    buffer.close()
+                    logger.warning(f"Attachment exceeds MAX_FILE_SIZE, aborting download: {attachment_id}")
+                    return None
+            del data
+                    
+            return buffer.seal()
+            
+        except Exception as e:
+            if buffer is not None:
+                buffer.close()
+            logger.error(f"Error downloading attachment: {str(e)}")
+            return None
+    
+    def get_processed_label_id(self):
+        """Return the id of the processed label, creating the label if needed."""
+        if self._label_id:
+            return self._label_id
+            
+        try:
+            results = self.service.users().labels().list(userId='me').execute()
+            for label in results.get('labels', []):
+                if label['name'] == config.GMAIL_LABEL:
+                    self._label_id = label['id']
+                    return self._label_id
+                    
+            label = self.service.users().labels().create(
                 userId='me',
-                messageId=message_id,
-                id=attachment_id
+                body={
+                    'name': config.GMAIL_LABEL,
+                    'labelListVisibility': 'labelShow',
+                    'messageListVisibility': 'show'
+                }
             ).execute()
-            
-            file_data = base64.urlsafe_b64decode(attachment['data'])
-            return file_data
+            self._label_id = label['id']
+            return self._label_id
             
         except Exception as e:
-            print(f"Error downloading attachment: {str(e)}")
-            return None 
\ No newline at end of file
+            logger.error(f"Error getting processed label: {str(e)}")
+            return None
+    
+    @profiling.staged('gmail_label')
+    def mark_processed(self, message_ids):
+        """Apply the processed label to messages in batches.
+        
+        Args:
+            message_ids (list): Gmail message ids to label
+            
+        Returns:
+            int: Number of messages labelled
+        """
+        message_ids = list(dict.fromkeys(message_ids))
+        if not message_ids:
+            return 0
+            
+        label_id = self.get_processed_label_id()
+        if not label_id:
+            return 0
+            
+        labelled = 0
+        for start in range(0, len(message_ids), BATCH_MODIFY_LIMIT):
+            batch = message_ids[start:start + BATCH_MODIFY_LIMIT]
+            try:
+                self.service.users().messages().batchModify(
+                    userId='me',
+                    body={'ids': batch, 'addLabelIds': [label_id]}
+                ).execute()
+                labelled += len(batch)
+            except Exception as e:
+                logger.error(f"Error labelling messages: {str(e)}")
+                
+        return labelled
@@ -0,0 +1,101 @@
+import atexit
+import contextvars
+import logging
+import os
+import queue
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import config
+
+# (key, value) pairs describing the work in progress, e.g. the message and attachment
+_context = contextvars.ContextVar('log_context', default=())
+_listener = None
+_pid = None
+_registered = False
+
+@contextmanager
+def log_context(**fields):
+    """Tag every record logged inside the block with key=value fields.
+
+    Fields live in a ContextVar, so concurrent threads each see their own.
+    Executors do not copy it into their threads; submit through
+    contextvars.copy_context().run to carry it along.
+    """
+    token = _context.set(_context.get() + tuple(fields.items()))
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+class ContextQueueHandler(QueueHandler):
+    """Queues records for the listener thread, tagged with the current log context.
+
+    Unlike QueueHandler, records are not formatted here: the queue never
+    leaves the process, so the timestamp, format string and traceback are
+    rendered by the listener thread instead of the thread that logged.
+    """
+
+    def prepare(self, record):
+        fields = _context.get()
+        record.context = ''.join(f"[{key}={value}] " for key, value in fields)
+        # Freeze the message so later changes to its arguments cannot alter it
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def setup_logging(console=True):
+    """Send all logging through a queue to a background writer thread.
+
+    The root logger gets a single ContextQueueHandler. A QueueListener thread
+    formats records with LOG_FORMAT and writes them to the rotating LOG_FILE
+    and, if `console` is set, to stderr. Calling it again is a no-op, except
+    in a forked child, which inherits the handler but not the listener thread.
+
+    Returns:
+        QueueListener: The running listener
+    """
+    global _listener, _pid, _registered
+    if _listener is not None and _pid == os.getpid():
+        return _listener
+
+    log_dir = os.path.dirname(config.LOG_FILE)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+
+    formatter = logging.Formatter(config.LOG_FORMAT)
+    handlers = [RotatingFileHandler(
+        config.LOG_FILE,
+        maxBytes=config.LOG_MAX_SIZE,
+        backupCount=config.LOG_BACKUP_COUNT,
+        encoding='utf-8'
+    )]
+    if console:
+        handlers.append(logging.StreamHandler())
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        if isinstance(handler, ContextQueueHandler):
+            root.removeHandler(handler)
+    root.addHandler(ContextQueueHandler(log_queue))
+    root.setLevel(config.LOG_LEVEL)
+
+    _listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    _pid = os.getpid()
+    if not _registered:
+        # Runs before logging's own shutdown hook, which was registered first
+        atexit.register(stop_logging)
+        _registered = True
+    return _listener
+
+def stop_logging():
+    """Write out the queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None and _pid == os.getpid():
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+    _listener = None
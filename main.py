@@ -4,46 +4,318 @@ import logging
 from datetime import datetime
 import email.utils
 import re
+import time
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from gmail_service import GmailService
 from drive_service import DriveService
 from document_processor import DocumentProcessor
+from sender_profiles import SenderProfileStore, sender_key
+from run_plan import RunPlan
+from scheduler import AttachmentScheduler
+import archive
+from single_flight import AttachmentSingleFlight
+import profiling
 import config
-from dateutil import parser
+from date_utils import parse_date
+from logging_setup import log_context, setup_logging
 
-# Set up logging with UTF-8 encoding
-logging.basicConfig(
-    filename=config.LOG_FILE,
-    level=config.LOG_LEVEL,
-    format=config.LOG_FORMAT,
-    encoding='utf-8'
-)
 logger = logging.getLogger(__name__)
 
 class GmailAttachmentProcessor:
-    def __init__(self):
-        self.gmail_service = GmailService()
-        self.drive_service = DriveService()
-        self.doc_processor = DocumentProcessor()
+    def __init__(self, folder_coordinator=None, gmail_service=None, drive_service=None,
+                 doc_processor=None, sender_profiles=None, single_flight=None):
+        """Initialize the processor.
         
-    def process_emails(self):
-        """Main process to handle email attachments."""
+        Args:
+            folder_coordinator: Optional shared broker for folder creation
+            gmail_service, drive_service, doc_processor, sender_profiles, single_flight:
+                Optional instances to use instead of new ones, e.g. to share the
+                document processor between threads that each own their API clients
+        """
+        self.gmail_service = gmail_service or GmailService()
+        self.drive_service = drive_service or DriveService(folder_coordinator=folder_coordinator)
+        self.doc_processor = doc_processor or DocumentProcessor()
+        self.sender_profiles = sender_profiles or SenderProfileStore(config.SENDER_PROFILE_FILE)
+        # Copies of one attachment in a run share one extraction and upload
+        self.single_flight = single_flight or AttachmentSingleFlight()
+        
+    def process_emails(self, after=None, before=None):
+        """Main process to handle email attachments.
+        
+        Args:
+            after (datetime): Optional window start; defaults to DAYS_TO_SEARCH ago
+            before (datetime): Optional window end
+            
+        Returns:
+            dict: Counts of emails found, fully processed and labelled, or None on error
+        """
         try:
+            if config.DRIVE_INDEX:
+                # Folder lookups and duplicate checks then come from the synced index
+                self.drive_service.sync_index()
+            
             # Get emails with attachments
-            emails = self.gmail_service.get_emails_with_attachments()
+            emails = self.gmail_service.get_emails_with_attachments(after=after, before=before)
             logger.info(f"找到 {len(emails)} 封含附件的郵件")
+            self.single_flight.register(emails)
             
-            for email in emails:
-                self._process_email(email)
+            if config.SCHEDULER_ENABLED:
+                processed_ids = self._process_scheduled(emails)
+            else:
+                processed_ids = []
+                for email in emails:
+                    if self._process_email(email):
+                        processed_ids.append(email['message_id'])
+            
+            # Label fully processed mail so the next search skips it
+            labelled = self.gmail_service.mark_processed(processed_ids)
+            logger.info(f"已標記 {labelled} 封郵件為已處理")
+            return {'emails': len(emails), 'processed': len(processed_ids), 'labelled': labelled}
                 
         except Exception as e:
             logger.error(f"主程序執行錯誤: {str(e)}")
+            return None
+    
+    def plan_emails(self):
+        """Compute what process_emails would do, without writing to Drive or Gmail.
+        
+        Lists and extracts attachments as usual, then resolves every folder
+        path and filename against an index of the Drive tree.
+        
+        Returns:
+            RunPlan: The deduplicated operations, or None if listing fails
+        """
+        try:
+            index = self.drive_service.sync_index()
+            if index is None:
+                return None
+            emails = self.gmail_service.get_emails_with_attachments()
+            logger.info(f"找到 {len(emails)} 封含附件的郵件")
+            
+            plan = RunPlan()
+            for email in emails:
+                for attachment in email['attachments']:
+                    self._plan_attachment(plan, index, email, attachment)
+            
+            logger.info(f"執行計畫: {plan.summary()}")
+            return plan
+            
+        except Exception as e:
+            logger.error(f"產生執行計畫時發生錯誤: {str(e)}")
+            return None
     
-    def _check_invoice_exists(self, doc_info, email_info):
+    def _plan_attachment(self, plan, index, email, attachment):
+        """Extract one attachment and add its folders and upload to the plan."""
+        buffer = self.gmail_service.download_attachment_stream(
+            email['message_id'],
+            attachment['id'],
+            attachment.get('part_id')
+        )
+        if not buffer:
+            plan.add_failure(email, attachment, 'download_failed')
+            return
+        
+        with buffer:
+            if not archive.is_archive(attachment['mimeType']):
+                doc_info = self._extract_document(email, attachment, buffer)
+                self._plan_document(plan, index, email, attachment, doc_info)
+                return
+            try:
+                for member, member_buffer in archive.iter_members(buffer, attachment):
+                    with member_buffer:
+                        doc_info = self._extract_document(email, member, member_buffer)
+                    self._plan_document(plan, index, email, member, doc_info)
+            except Exception as e:
+                logger.error(f"無法處理壓縮檔 {attachment['filename']}: {str(e)}")
+                plan.add_failure(email, attachment, 'archive_rejected')
+    
+    def _plan_document(self, plan, index, email, attachment, doc_info):
+        """Add the folders and upload of one extracted document to the plan."""
+        if not doc_info:
+            plan.add_failure(email, attachment, 'extraction_failed')
+            return
+        
+        email_date = parse_date(email['date'])
+        invoice_date = parse_date(doc_info['extracted_info'].get('invoice_date', ''))
+        doc_type = doc_info['document_type']
+        
+        path = self._folder_path(email, doc_type, doc_info,
+                                 email_date=email_date, invoice_date=invoice_date)
+        if not path:
+            plan.add_failure(email, attachment, 'no_folder_path')
+            return
+        
+        filename = self._generate_filename(
+            doc_type,
+            attachment['filename'],
+            email['sender'],
+            doc_info,
+            invoice_date=invoice_date
+        )
+        
+        if doc_type == 'invoice' and self._invoice_in_index(index, doc_info, invoice_date):
+            plan.add_duplicate(email, attachment, filename, 'exists_in_drive')
+            return
+        
+        # Walk the path down the index to find where the missing folders start
+        folder_id, existing_depth = index.root_id, 0
+        for name in path:
+            child = index.find_folder(name, folder_id)
+            if not child:
+                break
+            folder_id, existing_depth = child, existing_depth + 1
+        
+        if existing_depth == len(path) and index.find_file(filename, folder_id):
+            plan.add_duplicate(email, attachment, filename, 'exists_in_drive')
+            return
+        
+        plan.add_folders(path, existing_depth)
+        plan.add_upload(email, attachment, path, filename, doc_info)
+    
+    def _invoice_in_index(self, index, doc_info, invoice_date):
+        """Return True if a file for this invoice number and date is already in the index."""
+        invoice_number = doc_info['extracted_info'].get('invoice_number', '')
+        if not invoice_number:
+            return False
+        parts = [invoice_number]
+        if invoice_date:
+            parts.append(invoice_date.strftime('%Y%m%d'))
+        return bool(index.files_containing(*parts))
+    
+    def apply_plan(self, plan):
+        """Execute a RunPlan in batched order.
+        
+        Missing folders are created level by level with batched requests,
+        then files are uploaded with their metadata set in the upload call.
+        Each attachment is downloaded once, however many of its ZIP members
+        the plan uploads. Anything created since the plan was made is found in
+        the re-synced index and skipped, so applying a plan twice is harmless.
+        
+        Args:
+            plan (RunPlan): Plan from plan_emails
+            
+        Returns:
+            dict: Counts of folders created and files uploaded, skipped and failed
+        """
+        result = {'folders_created': 0, 'uploaded': 0, 'skipped': 0, 'failed': 0, 'labelled': 0}
+        index = self.drive_service.sync_index(force=True)
+        if index is None:
+            logger.error("無法讀取 Drive 資料夾索引")
+            return result
+        
+        folder_ids = {(): index.root_id}
+        paths = {tuple(u['path'][:depth]) for u in plan.uploads for depth in range(1, len(u['path']) + 1)}
+        for depth in range(1, max(map(len, paths), default=0) + 1):
+            missing = []
+            for path in sorted(p for p in paths if len(p) == depth):
+                parent = folder_ids.get(path[:-1])
+                if not parent:
+                    continue
+                folder_id = index.find_folder(path[-1], parent)
+                if folder_id:
+                    folder_ids[path] = folder_id
+                else:
+                    missing.append(path)
+            
+            created = self.drive_service.create_folders_batch(
+                [(path[-1], folder_ids[path[:-1]]) for path in missing])
+            for path, folder_id in zip(missing, created):
+                if not folder_id:
+                    logger.error(f"無法建立資料夾: {'/'.join(path)}")
+                    continue
+                folder_ids[path] = folder_id
+                result['folders_created'] += 1
+        
+        messages = dict(plan.messages)
+        attachments = {}
+        for upload in sorted(plan.uploads, key=lambda u: u['path']):
+            # Like the live path, fall back to the deepest folder below the month
+            path = tuple(upload['path'])
+            while len(path) > 2 and path not in folder_ids:
+                path = path[:-1]
+            folder_id = folder_ids.get(path)
+            
+            if folder_id and index.find_file(upload['filename'], folder_id):
+                result['skipped'] += 1
+                continue
+            if not folder_id:
+                messages[upload['message_id']] = False
+                result['failed'] += 1
+                continue
+            
+            # ZIP members of one attachment share a single download
+            key = (upload['message_id'], upload['attachment_id'])
+            attachments.setdefault(key, []).append((upload, folder_id))
+        
+        for uploads in attachments.values():
+            for upload, drive_file in self._apply_uploads(uploads):
+                if drive_file:
+                    result['uploaded'] += 1
+                    logger.info(f"成功處理並上傳檔案: {upload['filename']}")
+                else:
+                    messages[upload['message_id']] = False
+                    result['failed'] += 1
+        
+        result['labelled'] = self.gmail_service.mark_processed(
+            [message_id for message_id, ok in messages.items() if ok])
+        logger.info(f"計畫執行完成: {result}")
+        return result
+    
+    def _apply_uploads(self, uploads):
+        """Download a planned attachment again, once, and upload each file planned from it.
+        
+        Args:
+            uploads (list): (upload, folder id) pairs of one message and attachment
+            
+        Returns:
+            list: (upload, uploaded Drive file or None) pairs
+        """
+        first = uploads[0][0]
+        buffer = self.gmail_service.download_attachment_stream(
+            first['message_id'],
+            first['attachment_id'],
+            first.get('part_id')
+        )
+        if not buffer:
+            logger.warning(f"無法下載附件: {first['original_filename']}")
+            return [(upload, None) for upload, _ in uploads]
+        
+        with buffer:
+            return [(upload, self._apply_upload(buffer, upload, folder_id)) for upload, folder_id in uploads]
+    
+    def _apply_upload(self, buffer, upload, folder_id):
+        """Upload one planned file from its downloaded attachment, with its metadata."""
+        member = None
+        if upload.get('member'):
+            # Archive members are planned individually; extract this one again
+            try:
+                member = buffer = archive.extract_member(buffer, upload['member'])
+            except Exception as e:
+                logger.warning(f"無法從壓縮檔取出檔案: {upload['original_filename']}: {str(e)}")
+                return None
+        
+        try:
+            return self.drive_service.upload_file(
+                buffer.open(),
+                upload['filename'],
+                upload['mime_type'],
+                folder_id,
+                metadata=upload['metadata']
+            )
+        finally:
+            if member is not None:
+                member.close()
+    
+    @profiling.staged('drive_check')
+    def _check_invoice_exists(self, doc_info, email_info, invoice_date=None):
         """Check if the invoice has already been processed.
         
         Args:
             doc_info (dict): Document information including extracted invoice details
             email_info (dict): Email information
+            invoice_date (datetime): Parsed invoice date, parsed here if not given
             
         Returns:
             bool: True if invoice already exists, False otherwise
@@ -51,8 +323,14 @@ class GmailAttachmentProcessor:
         try:
             if not doc_info or 'extracted_info' not in doc_info:
                 return False
-                
+            
             info = doc_info['extracted_info']
+            if invoice_date is None:
+                invoice_date = parse_date(info.get('invoice_date', ''))
+            
+            # The synced index covers the whole tree without a Drive query
+            if self.drive_service.index is not None:
+                return self._invoice_in_index(self.drive_service.index, doc_info, invoice_date)
             
             # Build search criteria
             search_parts = []
@@ -63,19 +341,14 @@ class GmailAttachmentProcessor:
                 search_parts.append(f"name contains '{invoice_number}'")
             
             # Add invoice date if available
-            invoice_date = info.get('invoice_date', '')
             if invoice_date:
-                try:
-                    parsed_date = parser.parse(invoice_date)
-                    date_str = parsed_date.strftime('%Y%m%d')
-                    search_parts.append(f"name contains '{date_str}'")
-                except:
-                    pass
+                date_str = invoice_date.strftime('%Y%m%d')
+                search_parts.append(f"name contains '{date_str}'")
             
-            # Add amount if available
+            # Add amount if available, as _generate_filename writes it
             amount = info.get('amount', '')
             if amount:
-                search_parts.append(f"name contains 'NT${amount}'")
+                search_parts.append(f"name contains '{amount}元'")
             
             if not search_parts:
                 return False
@@ -104,216 +377,456 @@ class GmailAttachmentProcessor:
             return False
     
     def _process_email(self, email):
-        """Process a single email and its attachments."""
+        """Process a single email and its attachments.
+        
+        Returns:
+            bool: True if every attachment was uploaded or already exists
+        """
         try:
+            ok = True
             for attachment in email['attachments']:
-                # Download attachment
-                file_data = self.gmail_service.download_attachment(
-                    email['message_id'],
-                    attachment['id']
-                )
-                
-                if not file_data:
-                    logger.warning(f"無法下載附件: {attachment['filename']}")
-                    continue
-                
-                # Process document
-                doc_info = self.doc_processor.process_document(
-                    file_data,
-                    attachment['mimeType']
-                )
-                
-                if not doc_info:
-                    logger.warning(f"無法處理文件: {attachment['filename']}")
-                    continue
-                
-                # Check if invoice already exists
-                if doc_info['document_type'] == 'invoice' and self._check_invoice_exists(doc_info, email):
-                    logger.info(f"發票已存在，跳過處理: {attachment['filename']}")
-                    continue
-                
-                # Create folder structure based on document type and info
-                folder_id = self._create_folder_structure(
-                    email,
-                    doc_info['document_type'],
-                    doc_info
-                )
-                
-                if not folder_id:
-                    logger.error(f"無法建立資料夾結構，郵件主旨: {email['subject']}")
-                    continue
-                
-                # Generate filename
-                filename = self._generate_filename(
-                    doc_info['document_type'],
-                    attachment['filename'],
-                    email['sender'],
-                    doc_info
-                )
-                
-                # Upload to Drive
-                drive_file = self.drive_service.upload_file(
-                    file_data,
-                    filename,
-                    attachment['mimeType'],
-                    folder_id
-                )
-                
-                if drive_file:
-                    # Update metadata
-                    metadata = {
-                        'document_type': doc_info['document_type'],
-                        'processed_date': doc_info['processed_date'],
-                        'source_email': email['sender'],
-                        'extracted_info': doc_info.get('extracted_info', {})
-                    }
-                    
-                    self.drive_service.update_file_metadata(
-                        drive_file['file_id'],
-                        metadata
-                    )
-                    
-                    logger.info(f"成功處理並上傳檔案: {filename}")
+                if not self._process_attachment(email, attachment):
+                    ok = False
+            return ok
                     
         except Exception as e:
             logger.error(f"處理郵件時發生錯誤: {str(e)}")
+            return False
+    
+    def _process_scheduled(self, emails):
+        """Process every attachment in AttachmentScheduler order.
+        
+        Returns:
+            list: Ids of the messages whose attachments were all uploaded or already exist
+        """
+        scheduler = AttachmentScheduler()
+        for email in emails:
+            for attachment in email['attachments']:
+                scheduler.push(email, attachment)
+        
+        remaining = {email['message_id']: len(email['attachments']) for email in emails}
+        failed = set()
+        started = time.monotonic()
+        uploaded, waited = 0, 0.0
+        for email, attachment in scheduler:
+            try:
+                ok = self._process_attachment(email, attachment)
+            except Exception as e:
+                logger.error(f"處理附件時發生錯誤: {attachment.get('filename')}: {str(e)}")
+                ok = False
+            remaining[email['message_id']] -= 1
+            if ok:
+                uploaded += 1
+                waited += time.monotonic() - started
+            else:
+                failed.add(email['message_id'])
+        
+        if uploaded:
+            logger.info(f"附件平均完成時間 {waited / uploaded:.1f} 秒（共 {uploaded} 個）")
+        return [message_id for message_id, left in remaining.items()
+                if left == 0 and message_id not in failed]
+    
+    def _process_attachment(self, email, attachment):
+        """Download, extract, file and upload a single attachment.
+        
+        Args:
+            email (dict): Email information from GmailService
+            attachment (dict): Attachment descriptor from the email
+            
+        Returns:
+            bool: True if the attachment was uploaded or already exists in Drive
+        """
+        # Sampled attachments are cProfiled when run.py --profile is on
+        with log_context(message=email['message_id'], attachment=attachment['filename']), \
+                profiling.attachment(), profiling.stage('attachment'):
+            # Only attachments whose size and type recur in the listing are deduplicated
+            if self.single_flight.may_have_copies(attachment):
+                return self._process_once(self.single_flight.copy_key(attachment), attachment,
+                                          lambda: self._process_shared_attachment(email, attachment))
+            
+            buffer = self._download_attachment(email, attachment)
+            if not buffer:
+                return False
+            with buffer:
+                return self._process_attachment_data(email, attachment, buffer)
+    
+    def _download_attachment(self, email, attachment):
+        buffer = self.gmail_service.download_attachment_stream(
+            email['message_id'],
+            attachment['id'],
+            attachment.get('part_id')
+        )
+        if not buffer:
+            logger.warning(f"無法下載附件: {attachment['filename']}")
+        return buffer
     
-    def _create_folder_structure(self, email_info, doc_type, doc_info=None):
+    def _process_shared_attachment(self, email, attachment):
+        """Process an attachment that may have copies in this run, once per content.
+        
+        Runs as the leader of its copy key, so same-named copies are not
+        downloaded; the content digest then also matches renamed copies.
+        """
+        buffer = self._download_attachment(email, attachment)
+        if not buffer:
+            return False
+        with buffer:
+            return self._process_once(self.single_flight.digest(buffer), attachment,
+                                      lambda: self._process_attachment_data(email, attachment, buffer))
+    
+    def _process_once(self, key, attachment, process):
+        """Run `process` unless a copy with the same single-flight key already did.
+        
+        The first copy processes it; concurrent and later copies wait for that
+        result instead of running OCR, the duplicate check and the upload
+        again, which could otherwise race and upload twice.
+        """
+        while True:
+            flight, leader = self.single_flight.begin(key)
+            if leader:
+                break
+            if flight.wait():
+                logger.info(f"相同附件已在本次執行中處理，跳過: {attachment['filename']}")
+                return True
+            # The leader failed; retry, possibly as the new leader
+        
+        ok = False
+        try:
+            ok = process()
+            return ok
+        finally:
+            self.single_flight.finish(key, flight, ok)
+    
+    def _process_attachment_data(self, email, attachment, buffer):
+        """Run extraction, filing and upload on a downloaded attachment.
+        
+        OCR and upload both read the single decoded copy held by `buffer`.
+        """
+        if archive.is_archive(attachment['mimeType']):
+            return self._process_archive(email, attachment, buffer)
+        return self._file_document(email, attachment, buffer,
+                                   self._extract_document(email, attachment, buffer))
+    
+    def _extract_document(self, email, attachment, buffer, run_ner=True):
+        """Classify a document and extract its information; safe to call from several threads.
+        
+        With run_ner False the NER fallback is left for DocumentProcessor.apply_batched_ner.
+        """
+        return self.doc_processor.process_document(
+            buffer,
+            attachment['mimeType'],
+            sender=email['sender'],
+            run_ner=run_ner,
+            profile=self.sender_profiles.get(email['sender'])
+        )
+    
+    def _process_archive(self, email, attachment, buffer):
+        """Extract, file and upload every supported member of a ZIP attachment.
+        
+        Members are decompressed one at a time while up to ARCHIVE_WORKERS of
+        them go through extraction in parallel, so at most that many are held
+        at once. Each such group then gets its NER fallback in one nlp.pipe
+        batch. Filing and upload stay on this thread, since the Gmail and
+        Drive clients are not thread-safe.
+        
+        Returns:
+            bool: True if every member was uploaded or already exists
+        """
+        ok = True
+        members = 0
+        pending = deque()
+        
+        def file_pending():
+            results = deque()
+            for member, _, future in pending:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    logger.error(f"處理壓縮檔內的檔案時發生錯誤: {member['filename']}: {str(e)}")
+                    results.append(None)
+            try:
+                self.doc_processor.apply_batched_ner(results)
+            except Exception as e:
+                logger.error(f"批次 NER 失敗: {str(e)}")
+            
+            filed = True
+            while pending:
+                member, member_buffer, _ = pending.popleft()
+                with member_buffer, log_context(member=member['filename']):
+                    filed = self._file_document(email, member, member_buffer, results.popleft()) and filed
+            return filed
+        
+        try:
+            with ThreadPoolExecutor(max_workers=config.ARCHIVE_WORKERS,
+                                    thread_name_prefix='archive') as executor:
+                for member, member_buffer in archive.iter_members(buffer, attachment):
+                    members += 1
+                    # Pool threads log under this attachment's context too
+                    with log_context(member=member['filename']):
+                        future = executor.submit(contextvars.copy_context().run,
+                                                 self._extract_document, email, member, member_buffer,
+                                                 run_ner=False)
+                    pending.append((member, member_buffer, future))
+                    if len(pending) >= config.ARCHIVE_WORKERS:
+                        ok = file_pending() and ok
+                if pending:
+                    ok = file_pending() and ok
+        except Exception as e:
+            logger.error(f"無法處理壓縮檔 {attachment['filename']}: {str(e)}")
+            ok = False
+        finally:
+            for _, member_buffer, _ in pending:
+                member_buffer.close()
+        
+        if not members and ok:
+            logger.warning(f"壓縮檔中沒有可處理的檔案: {attachment['filename']}")
+        return ok
+    
+    def _file_document(self, email, attachment, buffer, doc_info):
+        """File an extracted document in its Drive folder and upload it.
+        
+        Returns:
+            bool: True if the document was uploaded or already exists in Drive
+        """
+        if not doc_info:
+            logger.warning(f"無法處理文件: {attachment['filename']}")
+            return False
+        
+        # Parse the email and invoice dates once for every step below
+        email_date = parse_date(email['date'])
+        invoice_date = parse_date(doc_info['extracted_info'].get('invoice_date', ''))
+        
+        # Check if invoice already exists
+        if doc_info['document_type'] == 'invoice' and \
+                self._check_invoice_exists(doc_info, email, invoice_date=invoice_date):
+            logger.info(f"發票已存在，跳過處理: {attachment['filename']}")
+            return True
+        
+        # Create folder structure based on document type and info
+        folder_id = self._create_folder_structure(
+            email,
+            doc_info['document_type'],
+            doc_info,
+            email_date=email_date,
+            invoice_date=invoice_date
+        )
+        
+        if not folder_id:
+            logger.error(f"無法建立資料夾結構，郵件主旨: {email['subject']}")
+            return False
+        
+        # Generate filename
+        filename = self._generate_filename(
+            doc_info['document_type'],
+            attachment['filename'],
+            email['sender'],
+            doc_info,
+            invoice_date=invoice_date
+        )
+        
+        # Upload to Drive straight from the downloaded buffer
+        drive_file = self.drive_service.upload_file(
+            buffer.open(),
+            filename,
+            attachment['mimeType'],
+            folder_id
+        )
+        
+        if not drive_file:
+            return False
+            
+        # Update metadata
+        metadata = {
+            'document_type': doc_info['document_type'],
+            'processed_date': doc_info['processed_date'],
+            'source_email': email['sender'],
+            'extracted_info': doc_info.get('extracted_info', {})
+        }
+        
+        self.drive_service.update_file_metadata(
+            drive_file['file_id'],
+            metadata
+        )
+        
+        # Remember what worked for this sender to speed up its next documents
+        self.sender_profiles.record(
+            email['sender'],
+            doc_info['document_type'],
+            doc_info.get('matched_patterns')
+        )
+        
+        logger.info(f"成功處理並上傳檔案: {filename}")
+        return True
+    
+    def _create_folder_structure(self, email_info, doc_type, doc_info=None,
+                                 email_date=None, invoice_date=None):
         """Create folder structure based on email information and document type.
         
         For invoices, the folder structure will be:
         Year/Month/Vendor/InvoiceDate_Description/
+        
+        Args:
+            email_date (datetime): Parsed email date, parsed here if not given
+            invoice_date (datetime): Parsed invoice date, parsed here if not given
         """
         try:
-            # Parse email date for year/month folders
-            email_date = self._parse_date(email_info['date'])
-            if not email_date:
+            path = self._folder_path(email_info, doc_type, doc_info,
+                                     email_date=email_date, invoice_date=invoice_date)
+            if not path:
                 return None
             
-            year = str(email_date.year)
-            month = f"{email_date.month:02d}"
-            
-            # Create year and month folders
-            year_folder = self.drive_service.get_or_create_folder(year)
-            if not year_folder:
-                logger.error(f"無法建立年份資料夾: {year}")
-                return None
+            is_invoice = doc_type == 'invoice' and bool(doc_info) and 'extracted_info' in doc_info
+            return self._ensure_folder_path(path, email_info.get('sender', ''), is_invoice)
                 
-            month_folder = self.drive_service.get_or_create_folder(month, parent_folder_id=year_folder)
-            if not month_folder:
-                logger.error(f"無法建立月份資料夾: {month}")
-                return None
+        except Exception as e:
+            logger.error(f"建立資料夾結構時發生錯誤: {str(e)}")
+            return None
+    
+    def _folder_path(self, email_info, doc_type, doc_info=None, email_date=None, invoice_date=None):
+        """Compute the folder names a document is filed under, without touching Drive.
+        
+        Args:
+            email_info (dict): Email information
+            doc_type (str): Classified document type
+            doc_info (dict): Document information including extracted details
+            email_date (datetime): Parsed email date, parsed here if not given
+            invoice_date (datetime): Parsed invoice date, parsed here if not given
             
-            if doc_type == 'invoice' and doc_info and 'extracted_info' in doc_info:
-                info = doc_info['extracted_info']
-                
-                # Get vendor name
-                vendor = info.get('seller_name', '')
-                if not vendor:
-                    # 如果沒有賣家名稱，使用郵件主旨中的公司名稱
-                    subject = email_info.get('subject', '')
-                    if '電子發票' in subject or '發票' in subject:
-                        # 嘗試從主旨中提取公司名稱
-                        vendor = subject.split('：')[0] if '：' in subject else subject.split(':')[0]
-                    else:
-                        # 如果還是無法獲取，使用寄件者信箱
-                        vendor = email_info.get('from', '').split('@')[0]
-                
-                vendor = self._clean_folder_name(vendor)
-                if not vendor:
-                    logger.error("無法獲取有效的供應商名稱")
-                    return month_folder
-                
-                vendor_folder = self.drive_service.get_or_create_folder(vendor, parent_folder_id=month_folder)
-                if not vendor_folder:
-                    logger.error(f"無法建立供應商資料夾: {vendor}")
-                    return month_folder
-                
-                # Get invoice date and create description
-                invoice_date = info.get('invoice_date', '')
-                if invoice_date:
-                    try:
-                        # Parse invoice date
-                        parsed_date = parser.parse(invoice_date)
-                        invoice_date_str = parsed_date.strftime('%Y%m%d')
-                        
-                        # Create description from invoice details
-                        description_parts = []
-                        
-                        # Add invoice number if available
-                        invoice_number = info.get('invoice_number', '')
-                        if invoice_number:
-                            description_parts.append(invoice_number)
-                        
-                        # Add amount if available
-                        amount = info.get('amount', '')
-                        if amount:
-                            description_parts.append(f'NT${amount}')
-                        
-                        # Add tax ID if available
-                        tax_id = info.get('tax_id', '')
-                        if tax_id:
-                            description_parts.append(f'統編{tax_id}')
-                        
-                        # Create folder name with date and description
-                        folder_name = invoice_date_str
-                        if description_parts:
-                            folder_name += '_' + '_'.join(description_parts)
-                        
-                        folder_name = self._clean_folder_name(folder_name)
-                        invoice_folder = self.drive_service.get_or_create_folder(folder_name, parent_folder_id=vendor_folder)
-                        if invoice_folder:
-                            return invoice_folder
-                        else:
-                            logger.error(f"無法建立發票資料夾: {folder_name}")
-                            return vendor_folder
-                        
-                    except Exception as e:
-                        logger.error(f"處理發票日期時發生錯誤: {str(e)}")
-                        return vendor_folder
-                
-                return vendor_folder
-            else:
-                # For non-invoice documents
-                sender = email_info.get('from', '').split('@')[0]
-                sender = self._clean_folder_name(sender)
-                if not sender:
-                    sender = "unknown_sender"
-                
-                sender_folder = self.drive_service.get_or_create_folder(sender, parent_folder_id=month_folder)
-                if not sender_folder:
-                    logger.error(f"無法建立寄件者資料夾: {sender}")
-                    return month_folder
-                
-                # Create a more descriptive folder name from subject and date
+        Returns:
+            list: Folder names below DRIVE_FOLDER_ID, or None without a usable email date
+        """
+        # Parse email date for year/month folders
+        if email_date is None:
+            email_date = self._parse_date(email_info['date'])
+        if not email_date:
+            return None
+        
+        path = [str(email_date.year), f"{email_date.month:02d}"]
+        
+        if doc_type == 'invoice' and doc_info and 'extracted_info' in doc_info:
+            info = doc_info['extracted_info']
+            
+            # The extracted seller wins; a known sender's last vendor name fills
+            # in when the document names none
+            sender = email_info.get('sender', '')
+            vendor = info.get('seller', '')
+            if not vendor:
+                vendor = self.sender_profiles.get_vendor(sender)
+            if not vendor:
+                # 如果沒有賣家名稱，使用郵件主旨中的公司名稱
                 subject = email_info.get('subject', '')
-                if subject:
-                    # Clean and format subject
-                    clean_subject = self._clean_folder_name(subject)
+                if '電子發票' in subject or '發票' in subject:
+                    # 嘗試從主旨中提取公司名稱
+                    vendor = subject.split('：')[0] if '：' in subject else subject.split(':')[0]
+                else:
+                    # 如果還是無法獲取，使用寄件者信箱
+                    vendor = sender_key(sender).split('@')[0]
+            
+            vendor = self._clean_folder_name(vendor)
+            if not vendor:
+                logger.error("無法獲取有效的供應商名稱")
+                return path
+            path.append(vendor)
+            
+            # Get invoice date and create description
+            if invoice_date is None:
+                invoice_date = parse_date(info.get('invoice_date', ''))
+            if invoice_date:
+                try:
+                    invoice_date_str = invoice_date.strftime('%Y%m%d')
                     
-                    # Add date to subject if available
-                    if email_date:
-                        date_str = email_date.strftime('%Y%m%d')
-                        folder_name = f"{date_str}_{clean_subject}"
-                    else:
-                        folder_name = clean_subject
+                    # Create description from invoice details
+                    description_parts = []
                     
-                    # Limit length
-                    if len(folder_name) > 100:
-                        folder_name = folder_name[:97] + '...'
+                    # Add invoice number if available
+                    invoice_number = info.get('invoice_number', '')
+                    if invoice_number:
+                        description_parts.append(invoice_number)
                     
-                    subject_folder = self.drive_service.get_or_create_folder(folder_name, parent_folder_id=sender_folder)
-                    if subject_folder:
-                        return subject_folder
-                    else:
-                        logger.error(f"無法建立主旨資料夾: {folder_name}")
-                        return sender_folder
-                
-                return sender_folder
-                
-        except Exception as e:
-            logger.error(f"建立資料夾結構時發生錯誤: {str(e)}")
-            return None
+                    # Add amount if available
+                    amount = info.get('amount', '')
+                    if amount:
+                        description_parts.append(f'NT${amount}')
+                    
+                    # Add tax ID if available
+                    tax_id = info.get('tax_id', '')
+                    if tax_id:
+                        description_parts.append(f'統編{tax_id}')
+                    
+                    # Create folder name with date and description
+                    folder_name = invoice_date_str
+                    if description_parts:
+                        folder_name += '_' + '_'.join(description_parts)
+                    
+                    path.append(self._clean_folder_name(folder_name))
+                    
+                except Exception as e:
+                    logger.error(f"處理發票日期時發生錯誤: {str(e)}")
+            
+            return path
+        
+        # For non-invoice documents
+        sender = sender_key(email_info.get('sender', '')).split('@')[0]
+        sender = self._clean_folder_name(sender)
+        if not sender:
+            sender = "unknown_sender"
+        path.append(sender)
+        
+        # Create a more descriptive folder name from subject and date
+        subject = email_info.get('subject', '')
+        if subject:
+            # Clean and format subject, prefixed with the email date
+            clean_subject = self._clean_folder_name(subject)
+            folder_name = f"{email_date.strftime('%Y%m%d')}_{clean_subject}"
+            
+            # Limit length
+            if len(folder_name) > 100:
+                folder_name = folder_name[:97] + '...'
+            path.append(folder_name)
+        
+        return path
+    
+    def _ensure_folder_path(self, path, sender, is_invoice, use_cache=True):
+        """Get or create each folder of `path`, returning the id of the deepest one.
+        
+        Failing to create the year or month folder fails the whole path; below
+        that the document is filed in the deepest folder that could be created.
+        The vendor folder id of an invoice is cached in the sender's profile,
+        per vendor name. A cached id missing from the synced Drive index, or
+        under which the invoice folder cannot be created, is dropped and the
+        path is resolved again without the cache, so a deleted vendor folder
+        is never returned as the upload target.
+        """
+        labels = ['年份', '月份'] + (['供應商', '發票'] if is_invoice else ['寄件者', '主旨'])
+        index = getattr(self.drive_service, 'index', None)
+        parent = month_folder = None
+        vendor_cached = False
+        for depth, name in enumerate(path):
+            is_vendor = is_invoice and depth == 2
+            folder = None
+            if is_vendor and use_cache:
+                folder = self.sender_profiles.get_vendor_folder(sender, name, parent)
+                if folder and index is not None and folder not in index:
+                    # Deleted or moved out of the tree since it was cached
+                    self.sender_profiles.forget_vendor_folder(sender, name, parent)
+                    folder = None
+                vendor_cached = bool(folder)
+            if not folder:
+                folder = self.drive_service.get_or_create_folder(name, parent_folder_id=parent)
+                if folder and is_vendor:
+                    self.sender_profiles.set_vendor_folder(sender, name, parent, folder)
+            
+            if not folder:
+                logger.error(f"無法建立{labels[depth]}資料夾: {name}")
+                if vendor_cached and depth == 3:
+                    # The cached vendor folder may have been deleted in Drive; retry once without it
+                    self.sender_profiles.forget_vendor_folder(sender, path[2], month_folder)
+                    return self._ensure_folder_path(path, sender, is_invoice, use_cache=False)
+                return parent if depth >= 2 else None
+            
+            if depth == 1:
+                month_folder = folder
+            parent = folder
+        return parent
     
     def _clean_folder_name(self, name):
         """Clean folder name to be compatible with file system.
@@ -344,7 +857,7 @@ class GmailAttachmentProcessor:
             
         return name
     
-    def _generate_filename(self, doc_type, original_filename, sender, doc_info=None):
+    def _generate_filename(self, doc_type, original_filename, sender, doc_info=None, invoice_date=None):
         """Generate a standardized filename based on document type and information.
         
         Args:
@@ -352,6 +865,7 @@ class GmailAttachmentProcessor:
             original_filename (str): Original filename from email
             sender (str): Email sender
             doc_info (dict): Additional document information
+            invoice_date (datetime): Parsed invoice date, parsed here if not given
             
         Returns:
             str: Generated filename
@@ -360,16 +874,14 @@ class GmailAttachmentProcessor:
         
         if doc_type == 'invoice' and doc_info:
             # Extract invoice information
-            date = doc_info.get('date', '')
-            if date:
-                try:
-                    date = parser.parse(date).strftime('%Y%m%d')
-                except:
-                    date = ''
+            info = doc_info.get('extracted_info', doc_info)
+            if invoice_date is None:
+                invoice_date = parse_date(info.get('invoice_date', ''))
+            date = invoice_date.strftime('%Y%m%d') if invoice_date else ''
             
-            vendor = doc_info.get('seller', '')
-            invoice_number = doc_info.get('invoice_number', '')
-            amount = doc_info.get('amount', '')
+            vendor = info.get('seller', '')
+            invoice_number = info.get('invoice_number', '')
+            amount = info.get('amount', '')
             
             # Build filename components
             components = []
@@ -411,38 +923,13 @@ class GmailAttachmentProcessor:
         Returns:
             datetime: Parsed datetime object or None if parsing fails
         """
-        try:
-            # Remove timezone name (UTC, CST, etc.)
-            date_str = re.sub(r'\s*\([A-Z]{2,}\)', '', date_str)
-            
-            # Try parsing with dateutil first
-            try:
-                return parser.parse(date_str)
-            except:
-                pass
-                
-            # Try specific formats
-            formats = [
-                '%a, %d %b %Y %H:%M:%S %z',  # RFC 2822
-                '%Y-%m-%d %H:%M:%S%z',       # ISO format
-                '%Y年%m月%d日',              # Chinese format
-                '%Y/%m/%d',                  # Simple date
-                '%Y%m%d'                     # Compact date
-            ]
-            
-            for fmt in formats:
-                try:
-                    return datetime.strptime(date_str, fmt)
-                except:
-                    continue
-                    
-            return None
-            
-        except Exception as e:
-            logger.error(f"日期解析錯誤: {str(e)}, 日期字串: {date_str}")
-            return None
+        date = parse_date(date_str)
+        if date is None:
+            logger.error(f"日期解析錯誤, 日期字串: {date_str}")
+        return date
 
 def main():
+    setup_logging(console=False)
     processor = GmailAttachmentProcessor()
     processor.process_emails()
 
@@ -0,0 +1,230 @@
+import atexit
+import io
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from rate_limit import call_with_limits, get_adaptive_limiter
+import config
+
+logger = logging.getLogger(__name__)
+
+# An empty result: text, word boxes and mean confidence
+NO_TEXT = ('', [], None)
+
+CJK_CHAR = re.compile(r'[\u3000-\u30ff\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]')
+
+class VisionOcr:
+    """Cloud Vision text_detection; accurate, but a billed network call per page."""
+
+    name = 'vision'
+
+    def __init__(self, credentials_path=None):
+        self.credentials_path = os.path.normpath(credentials_path or config.GOOGLE_APPLICATION_CREDENTIALS)
+        self._client = None
+        self._lock = threading.Lock()
+
+    def available(self):
+        return os.path.exists(self.credentials_path)
+
+    @property
+    def client(self):
+        """Vision client, created with explicit credentials on first use."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from google.cloud import vision
+                    if not self.available():
+                        raise FileNotFoundError(f"Credentials file not found at: {self.credentials_path}")
+                    self._client = vision.ImageAnnotatorClient.from_service_account_json(self.credentials_path)
+                    logger.info(f"Successfully initialized Vision client with credentials from: {self.credentials_path}")
+        return self._client
+
+    def recognize(self, image_data):
+        """Return (text, word boxes, None); Vision text_detection reports no confidence."""
+        from google.cloud import vision
+        from PIL import Image
+
+        try:
+            image = vision.Image(content=image_data)
+            # Concurrent OCR calls adapt to Vision's latency and throttling
+            response = call_with_limits(
+                lambda: self.client.text_detection(image=image),
+                adaptive=get_adaptive_limiter('vision'),
+                kind='text_detection'
+            )
+            texts = response.text_annotations
+            if not texts:
+                return NO_TEXT
+
+            words = []
+            with Image.open(io.BytesIO(image_data)) as sent_image:
+                width, height = sent_image.size
+            for annotation in texts[1:]:
+                xs = [v.x for v in annotation.bounding_poly.vertices]
+                ys = [v.y for v in annotation.bounding_poly.vertices]
+                words.append((annotation.description, (
+                    min(xs) / width, min(ys) / height, max(xs) / width, max(ys) / height
+                )))
+            return texts[0].description, words, None
+
+        except Exception as e:
+            logger.error(f"Error performing OCR: {str(e)}")
+            return NO_TEXT
+
+def _join_words(words):
+    """Join a line's words, without the spaces Tesseract puts between CJK characters."""
+    line = ''
+    for word in words:
+        if line and not (CJK_CHAR.match(line[-1]) or CJK_CHAR.match(word[0])):
+            line += ' '
+        line += word
+    return line
+
+def _tesseract_recognize(image_data, lang, cmd):
+    """Run Tesseract on one image; executed in a worker process."""
+    import pytesseract
+    from PIL import Image
+
+    if cmd:
+        pytesseract.pytesseract.tesseract_cmd = cmd
+    with Image.open(io.BytesIO(image_data)) as image:
+        width, height = image.size
+        data = pytesseract.image_to_data(image, lang=lang, output_type=pytesseract.Output.DICT)
+
+    lines = {}
+    words = []
+    confidences = []
+    for i, word in enumerate(data['text']):
+        word = word.strip()
+        conf = float(data['conf'][i])
+        if not word or conf < 0:
+            continue
+        lines.setdefault((data['block_num'][i], data['par_num'][i], data['line_num'][i]), []).append(word)
+        left, top = data['left'][i], data['top'][i]
+        words.append((word, (left / width, top / height,
+                             (left + data['width'][i]) / width, (top + data['height'][i]) / height)))
+        confidences.append(conf)
+
+    text = '\n'.join(_join_words(line) for _, line in sorted(lines.items()))
+    confidence = sum(confidences) / len(confidences) if confidences else None
+    return text, words, confidence
+
+class TesseractOcr:
+    """Local Tesseract OCR (TESSERACT_LANG) in a pool of OCR_LOCAL_WORKERS processes.
+
+    Needs the tesseract binary with the chi_tra language data and the
+    pytesseract package. Pages are recognized in worker processes, so several
+    threads calling recognize() use several cores.
+    """
+
+    name = 'tesseract'
+
+    def __init__(self, lang=None, cmd=None, workers=None):
+        self.lang = lang or config.TESSERACT_LANG
+        self.cmd = cmd or config.TESSERACT_CMD
+        self.workers = workers or config.OCR_LOCAL_WORKERS
+        self._available = None
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def available(self):
+        if self._available is None:
+            try:
+                import pytesseract  # noqa: F401
+                self._available = shutil.which(self.cmd or 'tesseract') is not None
+            except ImportError:
+                self._available = False
+            if not self._available:
+                logger.warning("Tesseract OCR not available: install tesseract (chi_tra) and pytesseract")
+        return self._available
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    # Spawned, since forking a process that holds gRPC channels is unsafe
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                    atexit.register(self.close)
+        return self._pool
+
+    def recognize(self, image_data):
+        """Return (text, word boxes, mean word confidence 0-100)."""
+        try:
+            return self._get_pool().submit(_tesseract_recognize, image_data, self.lang, self.cmd).result()
+        except Exception as e:
+            logger.error(f"Error performing local OCR: {str(e)}")
+            return NO_TEXT
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+class OcrRouter:
+    """Chooses the OCR backend for each page according to OCR_BACKEND.
+
+    - 'vision' and 'tesseract' always use that backend.
+    - 'auto' recognizes pages locally and sends them to Cloud Vision only if
+      the local result is empty or below OCR_LOCAL_MIN_CONFIDENCE, or the
+      image is larger than OCR_LOCAL_MAX_BYTES. At most OCR_CLOUD_BUDGET pages
+      per run go to Vision; after that, and whenever Vision has no
+      credentials, local results are kept. Without Tesseract every page goes
+      to Vision.
+    """
+
+    def __init__(self, mode=None, local=None, cloud=None):
+        self.mode = mode or config.OCR_BACKEND
+        self.local = local or TesseractOcr()
+        self.cloud = cloud or VisionOcr()
+        self.pages = {'vision': 0, 'tesseract': 0, 'fallback': 0}
+        self._lock = threading.Lock()
+        self._cloud_reserved = 0
+        self._budget_logged = False
+
+    def recognize(self, image_data):
+        """Return (text, word boxes, confidence) from the chosen backend."""
+        if self.mode == 'tesseract':
+            return self._run(self.local, image_data)
+        if self.mode != 'auto' or not self.local.available():
+            return self._run(self.cloud, image_data)
+
+        if len(image_data) > config.OCR_LOCAL_MAX_BYTES and self._take_cloud_page():
+            return self._run(self.cloud, image_data)
+
+        result = self._run(self.local, image_data)
+        text, _, confidence = result
+        if (not text or (confidence or 0) < config.OCR_LOCAL_MIN_CONFIDENCE) and self._take_cloud_page():
+            with self._lock:
+                self.pages['fallback'] += 1
+            cloud_result = self._run(self.cloud, image_data)
+            if cloud_result[0]:
+                return cloud_result
+        return result
+
+    def _run(self, backend, image_data):
+        with self._lock:
+            self.pages[backend.name] += 1
+        return backend.recognize(image_data)
+
+    def _take_cloud_page(self):
+        """Reserve one page of the Vision budget; False if spent or Vision is unavailable."""
+        if not self.cloud.available():
+            return False
+        with self._lock:
+            budget = config.OCR_CLOUD_BUDGET
+            if budget and self._cloud_reserved >= budget:
+                if not self._budget_logged:
+                    self._budget_logged = True
+                    logger.warning(f"Cloud OCR budget of {budget} pages used up, using local OCR only")
+                return False
+            self._cloud_reserved += 1
+            return True
+
+    def metrics(self):
+        with self._lock:
+            return dict(self.pages, mode=self.mode)
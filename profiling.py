@@ -0,0 +1,201 @@
+import cProfile
+import functools
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+
+_NULL = nullcontext()
+_active = None
+
+class Profiler:
+    """Low-overhead profiling of a whole run.
+
+    Three kinds of data are written to `output_dir` by stop():
+
+    - stages.json: calls, wall time and CPU time per pipeline stage
+      (download, pdf_to_images, ocr, regex, ner, drive_upload, ...). Wall time
+      well above CPU time means the stage is blocked on I/O or an API.
+    - stacks.collapsed: all threads sampled every `sample_interval` seconds,
+      one 'thread;stage;frame;...;frame count' line per distinct stack, ready
+      for flamegraph.pl or speedscope.
+    - attachments.pstats: cProfile data for every `attachment_every`-th
+      attachment, merged; cProfile's overhead is paid only for that sample.
+    """
+
+    def __init__(self, output_dir, sample_interval=0.01, attachment_every=10):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.attachment_every = attachment_every
+        self._stages = {}
+        self._current = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stacks = Counter()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._attachments = 0
+        self._profiled = 0
+        self._profile_lock = threading.Lock()
+        self._stats = None
+        self._started = None
+
+    def start(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._started = (time.perf_counter(), time.process_time())
+        if self.sample_interval:
+            self._sampler = threading.Thread(target=self._sample_loop, name='profiler-sampler', daemon=True)
+            self._sampler.start()
+
+    @contextmanager
+    def stage(self, name):
+        stack = getattr(self._local, 'stages', None)
+        if stack is None:
+            stack = self._local.stages = []
+        # Nested calls of the same stage are already timed by the outer one
+        if stack and stack[-1] == name:
+            yield
+            return
+
+        thread_id = threading.get_ident()
+        stack.append(name)
+        self._current[thread_id] = name
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            stack.pop()
+            self._current[thread_id] = stack[-1] if stack else None
+            with self._lock:
+                totals = self._stages.setdefault(name, [0, 0.0, 0.0])
+                totals[0] += 1
+                totals[1] += wall
+                totals[2] += cpu
+
+    @contextmanager
+    def attachment(self):
+        """cProfile this attachment if it falls in the sample."""
+        with self._lock:
+            self._attachments += 1
+            sampled = self.attachment_every and (self._attachments - 1) % self.attachment_every == 0
+        # Only one cProfile can be active at a time, so concurrent samples are skipped
+        if not sampled or not self._profile_lock.acquire(blocking=False):
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+            with self._lock:
+                self._profiled += 1
+                if self._stats is None:
+                    self._stats = pstats.Stats(profile)
+                else:
+                    self._stats.add(profile)
+        finally:
+            self._profile_lock.release()
+
+    def _sample_loop(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.sample_interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                stage = self._current.get(thread_id) or 'other'
+                key = ';'.join([names.get(thread_id, str(thread_id)), stage] + frames[::-1])
+                self._stacks[key] += 1
+
+    def stop(self):
+        """Stop sampling, write the output files and return the stage summary."""
+        self._stop.set()
+        if self._sampler:
+            self._sampler.join()
+
+        wall = time.perf_counter() - self._started[0]
+        cpu = time.process_time() - self._started[1]
+        summary = {
+            'run': {'wall': round(wall, 3), 'cpu': round(cpu, 3)},
+            'stages': {
+                name: {'calls': calls, 'wall': round(stage_wall, 3), 'cpu': round(stage_cpu, 3),
+                       'waiting': round(max(0.0, stage_wall - stage_cpu), 3)}
+                for name, (calls, stage_wall, stage_cpu)
+                in sorted(self._stages.items(), key=lambda item: -item[1][1])
+            },
+            'attachments': self._attachments,
+            'profiled_attachments': self._profiled
+        }
+
+        with open(os.path.join(self.output_dir, 'stages.json'), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        with open(os.path.join(self.output_dir, 'stacks.collapsed'), 'w', encoding='utf-8') as f:
+            for stack, count in self._stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        if self._stats is not None:
+            self._stats.dump_stats(os.path.join(self.output_dir, 'attachments.pstats'))
+        return summary
+
+def start(output_dir, sample_interval=0.01, attachment_every=10):
+    """Start profiling the rest of the run in this process."""
+    global _active
+    _active = Profiler(output_dir, sample_interval, attachment_every)
+    _active.start()
+    return _active
+
+def stop():
+    """Stop profiling and write its output; returns the stage summary or None."""
+    global _active
+    profiler, _active = _active, None
+    return profiler.stop() if profiler else None
+
+def stage(name):
+    """Time a block as pipeline stage `name`; free when profiling is off."""
+    return _active.stage(name) if _active else _NULL
+
+def attachment():
+    """Wrap the processing of one attachment, cProfiling it if sampled."""
+    return _active.attachment() if _active else _NULL
+
+def staged(name):
+    """Decorator timing every call of a function as stage `name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with _active.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def staged_iter(name, iterable):
+    """Yield from `iterable`, timing the production of each item as stage `name`."""
+    iterator = iter(iterable)
+    try:
+        while True:
+            with stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+    finally:
+        # Closing early, e.g. on OCR early exit, must still clean up the source
+        if hasattr(iterator, 'close'):
+            iterator.close()
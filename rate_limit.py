@@ -0,0 +1,211 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+import config
+
+logger = logging.getLogger(__name__)
+
+# Status codes and error reasons meaning the backend wants us to slow down
+OVERLOAD_STATUSES = {429, 503}
+OVERLOAD_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'RESOURCE_EXHAUSTED')
+
+# Calls whose latency grows with the payload rather than with backend load
+TRANSFER_METHODS = {'gmail.users.messages.attachments.get'}
+
+class RateLimiter:
+    """Token bucket shared by every thread calling one API.
+
+    Allows `rate` requests per second on average with bursts of up to `burst`
+    requests. A rate of 0 or less disables limiting.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(1, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` requests may be sent."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+def is_overload(error):
+    """Return True for errors that signal throttling: HTTP 429/503 or a rate limit 403."""
+    status = getattr(getattr(error, 'resp', None), 'status', None) or getattr(error, 'code', None)
+    try:
+        status = int(status)
+    except (TypeError, ValueError):
+        status = None
+    return status in OVERLOAD_STATUSES or any(reason in str(error) for reason in OVERLOAD_REASONS)
+
+class AdaptiveLimiter:
+    """AIMD limit on the calls in flight to one backend.
+
+    Every successful call whose latency stays within
+    ADAPTIVE_LATENCY_TOLERANCE times the best latency seen for that kind of
+    call raises the limit by 1/limit, i.e. by about one per round of calls.
+    A 429/503 or a latency spike multiplies it by ADAPTIVE_BACKOFF, at most
+    once per average latency so one burst of failures counts once.
+
+    Transfers (media uploads and downloads, attachment fetches) take as long
+    as their payload needs, so their latency is not tracked; only throttling
+    errors back the limit off for them.
+    """
+
+    def __init__(self, name, initial=None, minimum=None, maximum=None):
+        self.name = name
+        self.minimum = minimum or config.ADAPTIVE_MIN_LIMIT
+        self.maximum = maximum or config.ADAPTIVE_MAX_LIMITS.get(name, config.ADAPTIVE_INITIAL_LIMIT)
+        self.limit = float(min(initial or config.ADAPTIVE_INITIAL_LIMIT, self.maximum))
+        self.in_flight = 0
+        self.calls = 0
+        self.backoffs = 0
+        # Per kind of call: [smoothed latency, baseline latency] in seconds
+        self._latency = {}
+        self._last_backoff = 0.0
+        self._last_log = time.monotonic()
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def track(self, kind='call', transfer=False):
+        """Hold one in-flight slot around a call, feeding its outcome back into the limit.
+
+        Args:
+            kind (str): Kind of call; latency baselines are kept per kind
+            transfer (bool): True for calls whose latency depends on payload size
+        """
+        with self._cond:
+            while self.in_flight >= max(self.minimum, int(self.limit)):
+                self._cond.wait()
+            self.in_flight += 1
+        started = time.monotonic()
+        overloaded = False
+        try:
+            yield
+        except Exception as e:
+            overloaded = is_overload(e)
+            raise
+        finally:
+            self._release(kind, time.monotonic() - started, overloaded, transfer)
+
+    def _release(self, kind, latency, overloaded, transfer=False):
+        with self._cond:
+            self.in_flight -= 1
+            self.calls += 1
+
+            spike = False
+            if not transfer:
+                smoothed, baseline = self._latency.get(kind, (latency, latency))
+                smoothed = 0.8 * smoothed + 0.2 * latency
+                # Let the baseline creep up so it follows a slower backend
+                baseline = min(latency, baseline * 1.01)
+                self._latency[kind] = (smoothed, baseline)
+                spike = smoothed > baseline * config.ADAPTIVE_LATENCY_TOLERANCE
+            else:
+                smoothed = latency
+
+            now = time.monotonic()
+            if overloaded or spike:
+                if now - self._last_backoff > smoothed:
+                    previous = self.limit
+                    self.limit = max(self.minimum, self.limit * config.ADAPTIVE_BACKOFF)
+                    self._last_backoff = now
+                    self.backoffs += 1
+                    reason = 'throttled' if overloaded else f'latency {smoothed * 1000:.0f}ms'
+                    logger.warning(f"{self.name} concurrency {previous:.1f} -> {self.limit:.1f} ({reason})")
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+            if now - self._last_log >= config.ADAPTIVE_LOG_INTERVAL:
+                self._last_log = now
+                logger.info(f"Adaptive limits: {self.metrics()}")
+
+    def metrics(self):
+        return {
+            'backend': self.name,
+            'limit': round(self.limit, 1),
+            'in_flight': self.in_flight,
+            'calls': self.calls,
+            'backoffs': self.backoffs,
+            'latency_ms': {kind: round(smoothed * 1000) for kind, (smoothed, _) in self._latency.items()}
+        }
+
+_adaptive_limiters = {}
+_adaptive_lock = threading.Lock()
+
+def get_adaptive_limiter(name):
+    """Return the process-wide AdaptiveLimiter for a backend, or None if disabled."""
+    if not config.ADAPTIVE_CONCURRENCY:
+        return None
+    with _adaptive_lock:
+        if name not in _adaptive_limiters:
+            _adaptive_limiters[name] = AdaptiveLimiter(name)
+        return _adaptive_limiters[name]
+
+def adaptive_metrics():
+    """Return the current limit, in-flight calls and latency of every backend."""
+    with _adaptive_lock:
+        return [limiter.metrics() for limiter in _adaptive_limiters.values()]
+
+def call_with_limits(fn, rate_limiter=None, adaptive=None, kind='call', transfer=False):
+    """Call `fn` under the optional rate and concurrency limiters.
+
+    Throttling errors are retried up to MAX_RETRIES times after a growing
+    RETRY_DELAY, once the adaptive limiter has backed off. `transfer` marks
+    calls whose latency says nothing about backend load (see AdaptiveLimiter).
+    """
+    for attempt in range(config.MAX_RETRIES + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            if adaptive is None:
+                return fn()
+            with adaptive.track(kind, transfer=transfer):
+                return fn()
+        except Exception as e:
+            if attempt >= config.MAX_RETRIES or not is_overload(e):
+                raise
+            logger.warning(f"{kind} throttled, retrying in {config.RETRY_DELAY * (attempt + 1)}s: {str(e)}")
+            time.sleep(config.RETRY_DELAY * (attempt + 1))
+
+def limited_request_class(rate_limiter=None, adaptive=None):
+    """Return an HttpRequest class whose execute() runs through call_with_limits.
+
+    Pass it to googleapiclient's build() as requestBuilder so that every call
+    made through the service object is rate limited and concurrency limited.
+    """
+    from googleapiclient.http import HttpRequest
+
+    class LimitedHttpRequest(HttpRequest):
+        def execute(self, *args, **kwargs):
+            parent = super()
+            return call_with_limits(lambda: parent.execute(*args, **kwargs),
+                                    rate_limiter, adaptive, kind=self.methodId or 'call',
+                                    transfer=is_transfer(self))
+
+    return LimitedHttpRequest
+
+def is_transfer(request):
+    """Return True for media uploads and downloads, whose latency follows payload size.
+
+    drive.files.create serves both folder creation and resumable uploads, so
+    the request itself, not its methodId, decides.
+    """
+    uri = getattr(request, 'uri', None) or ''
+    return (getattr(request, 'resumable', None) is not None
+            or getattr(request, 'methodId', None) in TRANSFER_METHODS
+            or 'alt=media' in uri or 'uploadType=' in uri)
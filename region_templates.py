@@ -0,0 +1,138 @@
+import logging
+import json
+import os
+import re
+import threading
+from worker_files import merge_worker_files, remove_worker_files
+import config
+
+logger = logging.getLogger(__name__)
+
+# Fields whose printed values are distinctive enough to locate on the page
+ANCHOR_FIELDS = ['invoice_number', 'amount', 'tax_id']
+
+def _normalize(text):
+    # Drop separators so 'AB-12345678' matches 'AB12345678' and '3,000' matches '3000'
+    return re.sub(r'[\s\-,:：$]', '', text or '').upper()
+
+class RegionTemplateStore:
+    """Per-vendor page-1 regions that hold the invoice fields, learned from OCR layout.
+
+    Regions are stored as (left, top, right, bottom) fractions of the image sent
+    to OCR. Each observation widens the vendor's region to cover the new field
+    positions; a region is only used after REGION_TEMPLATE_MIN_HITS observations
+    and is dropped after REGION_TEMPLATE_MAX_MISSES failed crops.
+    """
+
+    def __init__(self, path, save_path=None):
+        """Load the store from `path`; changes are saved to save_path, by default `path`."""
+        self.path = path
+        self.save_path = save_path or path
+        self._lock = threading.Lock()
+        self._templates = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self._templates = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Error loading region templates, starting empty: {str(e)}")
+
+    def region_for(self, vendor):
+        """Return the learned crop region for a vendor, or None if not yet reliable."""
+        template = self._templates.get(vendor) if vendor else None
+        if not template or template['hits'] < config.REGION_TEMPLATE_MIN_HITS:
+            return None
+        return tuple(template['region'])
+
+    def learn(self, vendor, words, info):
+        """Record where a vendor's invoice fields sit, from word boxes on page 1.
+
+        Args:
+            vendor (str): Vendor key, normally the sender address
+            words (list): (text, (left, top, right, bottom)) normalised word boxes
+            info (dict): Fields extracted from the same page
+        """
+        if not vendor or not words:
+            return
+
+        values = [_normalize(info.get(field, '')) for field in ANCHOR_FIELDS]
+        values = [v for v in values if len(v) >= 3]
+        if not values:
+            return
+
+        boxes = []
+        for text, box in words:
+            token = _normalize(text)
+            if len(token) >= 3 and any(token in value or value in token for value in values):
+                boxes.append(box)
+        if not boxes:
+            return
+
+        margin = config.REGION_TEMPLATE_MARGIN
+        region = [
+            max(0.0, min(b[0] for b in boxes) - margin),
+            max(0.0, min(b[1] for b in boxes) - margin),
+            min(1.0, max(b[2] for b in boxes) + margin),
+            min(1.0, max(b[3] for b in boxes) + margin)
+        ]
+
+        with self._lock:
+            template = self._templates.get(vendor)
+            if template:
+                old = template['region']
+                region = [min(old[0], region[0]), min(old[1], region[1]),
+                          max(old[2], region[2]), max(old[3], region[3])]
+                template['hits'] += 1
+            else:
+                template = {'hits': 1, 'misses': 0}
+            template['region'] = region
+
+            # A region covering most of the page saves nothing over a full-page OCR
+            area = (region[2] - region[0]) * (region[3] - region[1])
+            if area > config.REGION_TEMPLATE_MAX_AREA:
+                self._templates.pop(vendor, None)
+            else:
+                self._templates[vendor] = template
+            self._save()
+
+    def record_hit(self, vendor):
+        with self._lock:
+            if vendor in self._templates:
+                self._templates[vendor]['misses'] = 0
+                self._save()
+
+    def record_miss(self, vendor):
+        """Count a crop that missed required fields, forgetting the region after too many."""
+        with self._lock:
+            template = self._templates.get(vendor)
+            if not template:
+                return
+            template['misses'] += 1
+            if template['misses'] >= config.REGION_TEMPLATE_MAX_MISSES:
+                del self._templates[vendor]
+            self._save()
+
+    @classmethod
+    def merge_worker_files(cls, path):
+        """Fold the copies saved by distributed workers (see worker_files.py) into `path`.
+
+        Returns:
+            int: Number of worker files merged
+        """
+        store = cls(path)
+        with store._lock:
+            merged = merge_worker_files(path, store._templates)
+            if merged and store._save():
+                remove_worker_files(merged)
+        return len(merged)
+
+    def _save(self):
+        tmp_path = f"{self.save_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._templates, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.save_path)
+            return True
+        except OSError as e:
+            logger.error(f"Error saving region templates: {str(e)}")
+            return False
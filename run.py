@@ -1,49 +1,33 @@
 #!/usr/bin/env python3
 import os
 import sys
+import argparse
 import logging
-from logging.handlers import RotatingFileHandler
+from datetime import datetime
 import traceback
 from main import GmailAttachmentProcessor
+from logging_setup import setup_logging
+from run_plan import RunPlan
+import distributed
+import backfill
+import rate_limit
+import profiling
 import config
 
-def setup_logging():
-    """設置日誌系統"""
-    # 建立日誌目錄
-    log_dir = os.path.dirname(config.LOG_FILE)
-    if log_dir and not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-
-    # 設置日誌處理器
-    handler = RotatingFileHandler(
-        config.LOG_FILE,
-        maxBytes=config.LOG_MAX_SIZE,
-        backupCount=config.LOG_BACKUP_COUNT,
-        encoding='utf-8'
-    )
-    
-    # 設置日誌格式
-    formatter = logging.Formatter(config.LOG_FORMAT)
-    handler.setFormatter(formatter)
-    
-    # 設置根日誌記錄器
-    root_logger = logging.getLogger()
-    root_logger.setLevel(config.LOG_LEVEL)
-    root_logger.addHandler(handler)
-    
-    # 同時輸出到控制台
-    console_handler = logging.StreamHandler()
-    console_handler.setFormatter(formatter)
-    root_logger.addHandler(console_handler)
-
 def check_dependencies():
     """檢查必要的依賴和設定"""
-    # 檢查 credentials.json
+    # 檢查 credentials.json（只有會用到 Cloud Vision 的 OCR_BACKEND 需要）
     if not os.path.exists(config.GOOGLE_APPLICATION_CREDENTIALS):
-        raise FileNotFoundError(
-            f"找不到 Google Cloud 憑證檔案：{config.GOOGLE_APPLICATION_CREDENTIALS}\n"
-            "請確保已下載憑證檔案並放置在正確位置。"
-        )
+        if config.OCR_BACKEND == 'vision':
+            raise FileNotFoundError(
+                f"找不到 Google Cloud 憑證檔案：{config.GOOGLE_APPLICATION_CREDENTIALS}\n"
+                "請確保已下載憑證檔案並放置在正確位置，或將 OCR_BACKEND 設為 'tesseract'。"
+            )
+        if config.OCR_BACKEND == 'auto':
+            logging.warning(
+                f"找不到 Google Cloud 憑證檔案：{config.GOOGLE_APPLICATION_CREDENTIALS}，"
+                "辨識信心不足的頁面將保留本機 OCR 結果，不會改用 Cloud Vision"
+            )
     
     # 檢查 Poppler（Windows）
     if os.name == 'nt':
@@ -57,8 +41,34 @@ def check_dependencies():
                 "3. 將 C:\\Program Files\\poppler\\Library\\bin 加入系統環境變數 PATH"
             )
 
-def main():
+def parse_args(argv=None):
+    """解析命令列參數"""
+    parser = argparse.ArgumentParser(description='Gmail 附件處理程序')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='以分散式模式執行的 worker 數量（0 表示單一程序）')
+    parser.add_argument('--broker', default=None,
+                        help='分散式模式的 broker URL，例如 redis://localhost:6379/0（預設使用 config.BROKER_URL）')
+    parser.add_argument('--role', choices=['all', 'coordinator', 'worker'], default='all',
+                        help='分散式模式中本程序的角色')
+    parser.add_argument('--plan', metavar='FILE', default=None,
+                        help='只產生執行計畫（需建立的資料夾、上傳與重複檔案數量及預估 API 呼叫數）並寫入 FILE，不寫入 Drive')
+    parser.add_argument('--apply', metavar='FILE', default=None,
+                        help='依 --plan 產生的計畫檔批次建立資料夾並上傳')
+    parser.add_argument('--backfill', metavar='YYYY-MM-DD', default=None,
+                        help='回填自此日期起的歷史郵件，依區間平行處理並可中斷續傳')
+    parser.add_argument('--until', metavar='YYYY-MM-DD', default=None,
+                        help='回填的結束日期（不含），預設為明天')
+    parser.add_argument('--window-days', type=int, default=None,
+                        help='回填每個區間的天數（預設使用 config.BACKFILL_WINDOW_DAYS）')
+    parser.add_argument('--profile', metavar='DIR', default=None,
+                        help='記錄各階段的實際與 CPU 時間、取樣堆疊（collapsed stacks）及 cProfile 資料至 DIR')
+    parser.add_argument('--profile-every', type=int, default=None, metavar='N',
+                        help='每 N 個附件以 cProfile 完整記錄一個（預設使用 config.PROFILE_ATTACHMENT_EVERY，1 表示全部）')
+    return parser.parse_args(argv)
+
+def main(argv=None):
     """主程序"""
+    args = parse_args(argv)
     try:
         # 設置日誌
         setup_logging()
@@ -68,18 +78,63 @@ def main():
         check_dependencies()
         logging.info("依賴檢查完成")
         
-        # 建立處理器實例
-        processor = GmailAttachmentProcessor()
+        if args.profile:
+            # 分散式模式的 worker 程序不在此記錄範圍內
+            profiling.start(
+                args.profile,
+                sample_interval=config.PROFILE_SAMPLE_INTERVAL,
+                attachment_every=args.profile_every or config.PROFILE_ATTACHMENT_EVERY
+            )
         
-        # 執行處理
-        processor.process_emails()
+        if args.backfill:
+            backfill.run_backfill(
+                datetime.strptime(args.backfill, '%Y-%m-%d'),
+                datetime.strptime(args.until, '%Y-%m-%d') if args.until else None,
+                window_days=args.window_days,
+                workers=args.workers or None
+            )
+        elif args.plan:
+            processor = GmailAttachmentProcessor()
+            plan = processor.plan_emails()
+            if plan is None:
+                raise RuntimeError("無法產生執行計畫")
+            plan.save(args.plan)
+            logging.info(f"執行計畫已寫入 {args.plan}: {plan.summary()}")
+        elif args.apply:
+            processor = GmailAttachmentProcessor()
+            processor.apply_plan(RunPlan.load(args.apply))
+        elif args.role == 'worker':
+            # 加入既有的分散式處理，直到協調者送出停止工作
+            broker = distributed.create_broker(args.broker)
+            try:
+                distributed.run_worker(broker)
+            finally:
+                distributed.merge_worker_stores()
+        elif args.role == 'coordinator':
+            broker = distributed.create_broker(args.broker)
+            distributed.run_coordinator(broker, args.workers or config.WORKER_COUNT)
+        elif args.workers > 0:
+            distributed.run_distributed(args.workers, args.broker)
+        else:
+            # 建立處理器實例
+            processor = GmailAttachmentProcessor()
+            
+            # 執行處理
+            processor.process_emails()
         
+        metrics = rate_limit.adaptive_metrics()
+        if metrics:
+            logging.info(f"自適應並行上限: {metrics}")
         logging.info("處理完成")
         
     except Exception as e:
         logging.error(f"程序執行時發生錯誤：{str(e)}")
         logging.error(traceback.format_exc())
         sys.exit(1)
+    finally:
+        summary = profiling.stop()
+        if summary:
+            logging.info(f"效能分析結果已寫入 {args.profile}: {summary}")
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()
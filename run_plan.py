@@ -0,0 +1,147 @@
+import json
+import math
+from datetime import datetime
+import config
+from drive_service import DRIVE_BATCH_LIMIT
+from gmail_service import BATCH_MODIFY_LIMIT
+
+class RunPlan:
+    """The Drive operations a run would perform, computed without writing anything.
+
+    Folder paths are lists of folder names below DRIVE_FOLDER_ID, e.g.
+    ['2024', '03', '範例企業', '20240315_AB12345678_NT$1000']. The plan is
+    deduplicated: each missing folder appears once and an upload whose target
+    already exists in Drive, or earlier in the plan, is recorded as a duplicate.
+    """
+
+    def __init__(self):
+        self.created = datetime.now().isoformat()
+        self.folders = []
+        self.uploads = []
+        self.duplicates = []
+        self.failures = []
+        # message_id -> True while every attachment of the message is planned or a duplicate
+        self.messages = {}
+        self._folders = set()
+        self._targets = set()
+
+    def add_folders(self, path, existing_depth):
+        """Record the folders of `path` below the `existing_depth` levels already in Drive."""
+        for depth in range(existing_depth + 1, len(path) + 1):
+            folder = tuple(path[:depth])
+            if folder not in self._folders:
+                self._folders.add(folder)
+                self.folders.append(list(folder))
+
+    def add_upload(self, email, attachment, path, filename, doc_info):
+        """Record an upload, or a duplicate if the same file is already planned."""
+        target = (tuple(path), filename)
+        if target in self._targets:
+            self.add_duplicate(email, attachment, filename, 'duplicate_in_plan')
+            return
+        self._targets.add(target)
+        self.messages.setdefault(email['message_id'], True)
+        self.uploads.append({
+            'message_id': email['message_id'],
+            'attachment_id': attachment['id'],
+            'part_id': attachment.get('part_id'),
+            # Raw name of the file inside a ZIP attachment, None for plain attachments
+            'member': attachment.get('member'),
+            'mime_type': attachment['mimeType'],
+            'size': attachment.get('size', 0),
+            'original_filename': attachment['filename'],
+            'filename': filename,
+            'path': path,
+            'metadata': {
+                'document_type': doc_info['document_type'],
+                'processed_date': doc_info['processed_date'],
+                'source_email': email['sender'],
+                'extracted_info': doc_info.get('extracted_info', {})
+            }
+        })
+
+    def add_duplicate(self, email, attachment, filename, reason):
+        self.messages.setdefault(email['message_id'], True)
+        self.duplicates.append({
+            'message_id': email['message_id'],
+            'original_filename': attachment['filename'],
+            'filename': filename,
+            'reason': reason
+        })
+
+    def add_failure(self, email, attachment, reason):
+        """Record an attachment that could not be planned; its message is not labelled."""
+        self.messages[email['message_id']] = False
+        self.failures.append({
+            'message_id': email['message_id'],
+            'original_filename': attachment['filename'],
+            'reason': reason
+        })
+
+    def summary(self):
+        """Return operation counts and the API calls apply needs versus a live run."""
+        by_depth = {}
+        for folder in self.folders:
+            by_depth[len(folder)] = by_depth.get(len(folder), 0) + 1
+        folder_batches = sum(math.ceil(n / DRIVE_BATCH_LIMIT) for n in by_depth.values())
+
+        # A resumable upload is one session request plus one request per chunk
+        upload_requests = sum(1 + max(1, math.ceil(u['size'] / config.UPLOAD_CHUNK_SIZE))
+                              for u in self.uploads)
+        labelled = sum(1 for ok in self.messages.values() if ok)
+        label_batches = math.ceil(labelled / BATCH_MODIFY_LIMIT)
+
+        apply_calls = {
+            'gmail_downloads': len(self.uploads),
+            'drive_folder_batches': folder_batches,
+            'drive_upload_requests': upload_requests,
+            'gmail_label_batches': label_batches
+        }
+        # A live run downloads and checks every attachment for duplicates,
+        # looks up each folder level per upload, creates missing folders one
+        # at a time and updates metadata in a second call after each upload
+        attachments = len(self.uploads) + len(self.duplicates)
+        live_calls = 2 * attachments + sum(len(u['path']) for u in self.uploads) \
+            + len(self.folders) + upload_requests + len(self.uploads) + label_batches
+
+        return {
+            'folders_to_create': len(self.folders),
+            'uploads': len(self.uploads),
+            'upload_bytes': sum(u['size'] for u in self.uploads),
+            'duplicates': len(self.duplicates),
+            'failures': len(self.failures),
+            'messages_to_label': labelled,
+            'estimated_api_calls': apply_calls,
+            'estimated_api_calls_total': sum(apply_calls.values()),
+            'estimated_live_api_calls': live_calls
+        }
+
+    def to_dict(self):
+        return {
+            'created': self.created,
+            'summary': self.summary(),
+            'folders': self.folders,
+            'uploads': self.uploads,
+            'duplicates': self.duplicates,
+            'failures': self.failures,
+            'messages': self.messages
+        }
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2, default=str)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        plan = cls()
+        plan.created = data.get('created', plan.created)
+        plan.folders = data.get('folders', [])
+        plan.uploads = data.get('uploads', [])
+        plan.duplicates = data.get('duplicates', [])
+        plan.failures = data.get('failures', [])
+        plan.messages = data.get('messages', {})
+        plan._folders = {tuple(folder) for folder in plan.folders}
+        plan._targets = {(tuple(u['path']), u['filename']) for u in plan.uploads}
+        return plan
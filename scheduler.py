@@ -0,0 +1,74 @@
+import heapq
+import itertools
+import threading
+import time
+from email.utils import parsedate_to_datetime
+import config
+
+def predict_document_type(email, attachment):
+    """Guess the document type from the subject and filename, before any download.
+
+    Uses DOCUMENT_KEYWORDS in the same order as DocumentProcessor's
+    classification of the extracted text.
+    """
+    text = f"{email.get('subject', '')} {attachment.get('filename', '')}".lower()
+    for doc_type, keywords in config.DOCUMENT_KEYWORDS.items():
+        if any(keyword.lower() in text for keyword in keywords):
+            return doc_type
+    return 'unknown'
+
+def estimate_seconds(email, attachment):
+    """Estimated processing time of an attachment, scaled by its predicted type's weight."""
+    seconds = config.SCHEDULER_BASE_SECONDS + attachment.get('size', 0) / config.SCHEDULER_BYTES_PER_SECOND
+    weight = config.SCHEDULER_TYPE_WEIGHTS.get(predict_document_type(email, attachment),
+                                               config.SCHEDULER_TYPE_WEIGHTS.get('unknown', 1.0))
+    return seconds * weight
+
+def _arrival(email):
+    """Epoch seconds the email arrived, or now if its Date header cannot be parsed."""
+    try:
+        return parsedate_to_datetime(email['date']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return time.time()
+
+class AttachmentScheduler:
+    """Shortest-job-first queue of attachments, with aging.
+
+    An attachment's priority is its estimated processing time minus one
+    second per SCHEDULER_AGING_SECONDS its email has been waiting. Invoices
+    and small files therefore reach Drive first, while a large contract still
+    overtakes newer work once it has waited long enough. Since every queued
+    item ages at the same rate, the priority is fixed when an item is pushed
+    and a plain heap keeps the order exact.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def priority(self, email, attachment):
+        return estimate_seconds(email, attachment) + _arrival(email) / config.SCHEDULER_AGING_SECONDS
+
+    def push(self, email, attachment):
+        entry = (self.priority(email, attachment), next(self._counter), email, attachment)
+        with self._lock:
+            heapq.heappush(self._heap, entry)
+
+    def pop(self):
+        """Return the next (email, attachment) to process, or None when empty."""
+        with self._lock:
+            if not self._heap:
+                return None
+            _, _, email, attachment = heapq.heappop(self._heap)
+            return email, attachment
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        while True:
+            item = self.pop()
+            if item is None:
+                return
+            yield item
@@ -0,0 +1,139 @@
+import logging
+import email.utils
+import json
+import os
+import threading
+from worker_files import merge_worker_files, remove_worker_files
+import config
+
+logger = logging.getLogger(__name__)
+
+def sender_key(sender):
+    """Return the lowercased address of a From header, used as the profile key."""
+    return email.utils.parseaddr(sender or '')[1].lower()
+
+def _merge_profiles(current, theirs):
+    """Take a worker's version of a profile, keeping the vendor folder ids of both."""
+    merged = dict(theirs)
+    folders = {vendor: dict(ids) for vendor, ids in current.get('vendor_folders', {}).items()}
+    for vendor, ids in theirs.get('vendor_folders', {}).items():
+        folders.setdefault(vendor, {}).update(ids)
+    merged['vendor_folders'] = folders
+    return merged
+
+class SenderProfileStore:
+    """Extraction results remembered per sender, persisted as JSON between runs.
+
+    A profile holds the sender's document type, the invoice pattern names that
+    matched for each field, the last vendor folder name it was filed under and
+    the id of each of its vendor folders under each month folder:
+
+        {'doc_type': 'invoice', 'hits': 5,
+         'patterns': {'invoice_number': ['invoice_number'], 'amount': ['total']},
+         'vendor': '範例企業',
+         'vendor_folders': {'範例企業': {'<month folder id>': '<folder id>'}}}
+    """
+
+    def __init__(self, path, save_path=None):
+        """Load the store from `path`; changes are saved to save_path, by default `path`."""
+        self.path = path
+        self.save_path = save_path or path
+        self._lock = threading.Lock()
+        self._profiles = {}
+        if os.path.exists(path):
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self._profiles = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Error loading sender profiles, starting empty: {str(e)}")
+        for profile in self._profiles.values():
+            # Folder ids cached before they were keyed by vendor cannot be attributed
+            if any(not isinstance(folders, dict) for folders in profile.get('vendor_folders', {}).values()):
+                profile['vendor_folders'] = {}
+
+    def get(self, sender):
+        """Return a copy of the sender's profile, or None for unknown senders."""
+        profile = self._profiles.get(sender_key(sender))
+        return json.loads(json.dumps(profile)) if profile else None
+
+    def record(self, sender, doc_type, matched_patterns=None):
+        """Remember a successful extraction for the sender.
+
+        Args:
+            sender (str): From header of the email
+            doc_type (str): Classified document type
+            matched_patterns (dict): field -> pattern name that matched
+        """
+        key = sender_key(sender)
+        if not key or doc_type == 'unknown':
+            return
+
+        with self._lock:
+            profile = self._profiles.setdefault(key, {'hits': 0, 'patterns': {}, 'vendor_folders': {}})
+            if profile.get('doc_type') != doc_type:
+                # The sender changed what it sends; start learning again
+                profile.update({'doc_type': doc_type, 'hits': 0, 'patterns': {}})
+            profile['hits'] += 1
+
+            for field, name in (matched_patterns or {}).items():
+                names = profile['patterns'].setdefault(field, [])
+                if name in names:
+                    names.remove(name)
+                names.insert(0, name)
+                del names[config.SENDER_PROFILE_MAX_PATTERNS:]
+            self._save()
+
+    def get_vendor(self, sender):
+        """Return the vendor folder name the sender was last filed under, if any."""
+        profile = self._profiles.get(sender_key(sender))
+        return profile.get('vendor') if profile else None
+
+    def get_vendor_folder(self, sender, vendor, parent_folder_id):
+        profile = self._profiles.get(sender_key(sender))
+        if not profile:
+            return None
+        return profile['vendor_folders'].get(vendor, {}).get(parent_folder_id)
+
+    def set_vendor_folder(self, sender, vendor, parent_folder_id, folder_id):
+        """Remember a vendor folder's id under a month folder, and the vendor as the latest."""
+        key = sender_key(sender)
+        if not key:
+            return
+
+        with self._lock:
+            profile = self._profiles.setdefault(key, {'hits': 0, 'patterns': {}, 'vendor_folders': {}})
+            profile['vendor'] = vendor
+            profile['vendor_folders'].setdefault(vendor, {})[parent_folder_id] = folder_id
+            self._save()
+
+    def forget_vendor_folder(self, sender, vendor, parent_folder_id):
+        """Drop a cached vendor folder id that turned out to be stale."""
+        with self._lock:
+            profile = self._profiles.get(sender_key(sender))
+            if profile and profile['vendor_folders'].get(vendor, {}).pop(parent_folder_id, None):
+                self._save()
+
+    @classmethod
+    def merge_worker_files(cls, path):
+        """Fold the copies saved by distributed workers (see worker_files.py) into `path`.
+
+        Returns:
+            int: Number of worker files merged
+        """
+        store = cls(path)
+        with store._lock:
+            merged = merge_worker_files(path, store._profiles, _merge_profiles)
+            if merged and store._save():
+                remove_worker_files(merged)
+        return len(merged)
+
+    def _save(self):
+        tmp_path = f"{self.save_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self._profiles, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.save_path)
+            return True
+        except OSError as e:
+            logger.error(f"Error saving sender profiles: {str(e)}")
+            return False
@@ -0,0 +1,88 @@
+import hashlib
+import threading
+
+class _Flight:
+    """The processing of one attachment content, awaited by its copies."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+
+    def wait(self):
+        self.done.wait()
+        return self.result
+
+class AttachmentSingleFlight:
+    """Run-wide deduplication of identical attachments.
+
+    The same document often arrives several times in one run, e.g. the
+    original, a forward and a reminder. Copies are matched in two steps:
+
+    - Before downloading, by a pre-key of the Gmail part size and MIME type.
+      Attachments whose pre-key occurs once in the registered listing cannot
+      have a copy and skip the rest. The others first join a flight on their
+      copy key, the pre-key plus the file name, so a copy sent under the same
+      name is not even downloaded.
+    - After downloading, by the SHA-256 of the content, which also catches
+      renamed copies.
+
+    In both steps the first copy becomes the leader and processes the
+    attachment; copies arriving while it runs wait for its result, and later
+    copies reuse it directly.
+
+    A failed leader does not poison its copies: the flight is dropped and the
+    next copy processes the attachment itself.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._prekeys = {}
+        self._flights = {}
+
+    @staticmethod
+    def prekey(attachment):
+        return (attachment.get('size', 0), attachment.get('mimeType'))
+
+    @staticmethod
+    def copy_key(attachment):
+        return ('copy', attachment.get('filename'), attachment.get('size', 0), attachment.get('mimeType'))
+
+    def register(self, emails):
+        """Count the pre-keys of every attachment in a listing."""
+        with self._lock:
+            for email in emails:
+                for attachment in email['attachments']:
+                    key = self.prekey(attachment)
+                    self._prekeys[key] = self._prekeys.get(key, 0) + 1
+
+    def may_have_copies(self, attachment):
+        """Return True if another registered attachment has the same size and MIME type."""
+        with self._lock:
+            return self._prekeys.get(self.prekey(attachment), 0) > 1
+
+    @staticmethod
+    def digest(buffer):
+        return hashlib.sha256(buffer.view).hexdigest()
+
+    def begin(self, digest):
+        """Join the flight for `digest`, a content digest or a copy key.
+
+        Returns:
+            tuple: (flight, leader) where leader is True if the caller must
+                process the attachment and then call finish()
+        """
+        with self._lock:
+            flight = self._flights.get(digest)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[digest] = _Flight()
+            return flight, True
+
+    def finish(self, digest, flight, result):
+        """Publish the leader's result to the waiting copies."""
+        with self._lock:
+            if result:
+                flight.result = result
+            elif self._flights.get(digest) is flight:
+                del self._flights[digest]
+        flight.done.set()
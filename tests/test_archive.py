@@ -0,0 +1,47 @@
+import io
+import zipfile
+import pytest
+import archive
+from attachment_buffer import AttachmentBuffer
+
+def _zip(files, compression=zipfile.ZIP_DEFLATED):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', compression) as zf:
+        for name, content in files.items():
+            zf.writestr(name, content)
+    buffer = AttachmentBuffer(len(data.getvalue()))
+    buffer.write(data.getvalue())
+    return buffer.seal()
+
+ATTACHMENT = {'id': 'att1', 'part_id': '2', 'filename': 'invoices.zip', 'mimeType': 'application/zip', 'size': 0}
+
+def test_iter_members_streams_supported_members_only():
+    with _zip({'a/invoice.pdf': b'%PDF-1.4 one', 'scan.png': b'png', 'notes.txt': b'skip', 'nested.zip': b'skip'}) as buffer:
+        members = []
+        for member, member_buffer in archive.iter_members(buffer, ATTACHMENT):
+            with member_buffer:
+                members.append((member['filename'], member['mimeType'], member['member'], bytes(member_buffer.view)))
+
+    assert members == [
+        ('invoice.pdf', 'application/pdf', 'a/invoice.pdf', b'%PDF-1.4 one'),
+        ('scan.png', 'image/png', 'scan.png', b'png'),
+    ]
+
+def test_extract_member_by_raw_name():
+    with _zip({'a/invoice.pdf': b'%PDF-1.4 one'}) as buffer, archive.extract_member(buffer, 'a/invoice.pdf') as member:
+        assert bytes(member.view) == b'%PDF-1.4 one'
+
+def test_rejects_high_compression_ratio():
+    with _zip({'bomb.pdf': b'\0' * (5 * 1024 * 1024)}) as buffer:
+        with pytest.raises(ValueError):
+            list(archive.iter_members(buffer, ATTACHMENT))
+
+def test_rejects_too_many_members(monkeypatch):
+    monkeypatch.setattr(archive.config, 'ARCHIVE_MAX_MEMBERS', 2)
+    with _zip({f'{i}.pdf': b'x' for i in range(3)}, zipfile.ZIP_STORED) as buffer:
+        with pytest.raises(ValueError):
+            list(archive.iter_members(buffer, ATTACHMENT))
+
+def test_decodes_big5_member_names():
+    info = zipfile.ZipInfo('發票.pdf'.encode('big5').decode('cp437'))
+    assert archive._member_name(info) == '發票.pdf'
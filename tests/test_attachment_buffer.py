@@ -0,0 +1,57 @@
+import io
+import os
+import pytest
+from attachment_buffer import AttachmentBuffer
+
+@pytest.fixture(autouse=True)
+def small_spool(monkeypatch):
+    monkeypatch.setattr('attachment_buffer.config.SPOOL_MAX_MEMORY', 16)
+
+def _filled(size_hint, chunks):
+    buffer = AttachmentBuffer(size_hint)
+    for chunk in chunks:
+        buffer.write(chunk)
+    return buffer.seal()
+
+def test_small_attachments_stay_in_memory():
+    # The size hint may be short; writes past it still land in place
+    with _filled(4, [b'%PDF', b'-1.4', b' small']) as buffer:
+        assert buffer.path is None
+        assert len(buffer) == 14
+        assert bytes(buffer.view) == b'%PDF-1.4 small'
+        assert buffer.view.readonly
+
+def test_large_attachments_spill_to_a_memory_mapped_file():
+    with _filled(17, [b'%PDF-1.4 ', b'larger than the spool']) as buffer:
+        assert buffer.path and os.path.exists(buffer.path)
+        with open(buffer.path, 'rb') as f:
+            assert f.read() == b'%PDF-1.4 larger than the spool'
+        assert bytes(buffer.view) == b'%PDF-1.4 larger than the spool'
+        assert buffer.view.readonly
+
+def test_empty_spilled_attachment_seals_without_mmap():
+    with _filled(1024, []) as buffer:
+        assert bytes(buffer.view) == b''
+
+def test_readers_are_independent():
+    with _filled(8, [b'0123456789']) as buffer:
+        first, second = buffer.open(), buffer.open()
+        assert first.read(4) == b'0123'
+        assert second.read() == b'0123456789'
+        first.seek(-2, io.SEEK_END)
+        assert first.read() == b'89'
+        assert io.BufferedReader(buffer.open()).read(3) == b'012'
+
+def test_close_releases_view_and_deletes_spill_file():
+    buffer = _filled(1024, [b'spilled data'])
+    path = buffer.path
+    view = buffer.view
+
+    buffer.close()
+
+    assert buffer.view is None
+    assert not os.path.exists(path)
+    with pytest.raises(ValueError):
+        bytes(view)
+    # Closing twice is harmless
+    buffer.close()
@@ -0,0 +1,20 @@
+from datetime import datetime
+from backfill import BackfillCheckpoint, date_windows, window_key
+
+def test_date_windows_cover_range_without_overlap():
+    windows = date_windows(datetime(2024, 1, 1), datetime(2024, 1, 20), 7)
+
+    assert [window_key(*w) for w in windows] == [
+        '2024-01-01_2024-01-08', '2024-01-08_2024-01-15', '2024-01-15_2024-01-20']
+
+def test_checkpoint_resumes_only_partial_windows(tmp_path):
+    path = str(tmp_path / 'checkpoint.json')
+    checkpoint = BackfillCheckpoint(path)
+    checkpoint.record('2024-01-01_2024-01-08', {'emails': 3, 'processed': 3, 'labelled': 3}, 1.0)
+    checkpoint.record('2024-01-08_2024-01-15', {'emails': 3, 'processed': 2, 'labelled': 2}, 1.0)
+    checkpoint.record('2024-01-15_2024-01-20', None, 1.0)
+
+    resumed = BackfillCheckpoint(path)
+    assert resumed.is_done('2024-01-01_2024-01-08')
+    assert not resumed.is_done('2024-01-08_2024-01-15')
+    assert not resumed.is_done('2024-01-15_2024-01-20')
@@ -0,0 +1,105 @@
+import pickle
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from credentials import CredentialsManager
+
+class FakeCredentials:
+    """google.oauth2 Credentials stand-in; refresh() pushes the expiry an hour ahead."""
+
+    def __init__(self, expires_in=3600, scopes=('gmail', 'drive')):
+        self.expiry = self._now() + timedelta(seconds=expires_in)
+        self.scopes = list(scopes)
+        self.refresh_token = 'refresh'
+        self.refreshed_by = []
+
+    @staticmethod
+    def _now():
+        return datetime.now(timezone.utc).replace(tzinfo=None)
+
+    @property
+    def valid(self):
+        return self.expiry > self._now()
+
+    def has_scopes(self, scopes):
+        return set(scopes) <= set(self.scopes)
+
+    def refresh(self, request):
+        self.refreshed_by.append(threading.current_thread().name)
+        self.expiry = self._now() + timedelta(seconds=3600)
+
+def _manager(tmp_path, creds=None):
+    token_file = str(tmp_path / 'token.pickle')
+    if creds is not None:
+        with open(token_file, 'wb') as f:
+            pickle.dump(creds, f)
+    return CredentialsManager(token_file=token_file, scopes=['gmail', 'drive'])
+
+def test_scopes_combine_gmail_and_drive_once(monkeypatch):
+    monkeypatch.setattr('credentials.config.GMAIL_SCOPES', ['gmail', 'shared'])
+    monkeypatch.setattr('credentials.config.DRIVE_SCOPES', ['drive', 'shared'])
+
+    assert CredentialsManager(token_file='unused').scopes == ['gmail', 'shared', 'drive']
+
+def test_token_is_refreshed_in_background_before_expiry(tmp_path, monkeypatch):
+    monkeypatch.setattr('credentials.config.TOKEN_REFRESH_MARGIN', 300)
+    manager = _manager(tmp_path, FakeCredentials(expires_in=300.2))
+    try:
+        creds = manager.get_credentials()
+        assert creds.refreshed_by == []
+
+        deadline = time.monotonic() + 5
+        while not creds.refreshed_by and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        manager.stop()
+
+    assert creds.refreshed_by == ['token-refresh']
+    assert creds.valid
+    # The refreshed token is saved for the next run
+    with open(manager.token_file, 'rb') as f:
+        assert pickle.load(f).expiry == creds.expiry
+
+def test_token_save_is_atomic(tmp_path, monkeypatch):
+    manager = _manager(tmp_path, FakeCredentials())
+    manager.get_credentials()
+    manager.stop()
+    with open(manager.token_file, 'rb') as before:
+        saved = before.read()
+
+    replaced = []
+
+    def fail_replace(src, dst):
+        replaced.append((src, dst))
+        raise OSError('disk full')
+    monkeypatch.setattr('credentials.os.replace', fail_replace)
+    manager._save(FakeCredentials(expires_in=60))
+
+    # A failed save leaves the previous token intact rather than half written
+    with open(manager.token_file, 'rb') as after:
+        assert after.read() == saved
+    [(src, dst)] = replaced
+    assert dst == manager.token_file and src != dst
+    with open(src, 'rb') as f:
+        assert pickle.load(f).expiry < FakeCredentials().expiry
+
+def test_concurrent_callers_share_one_load(tmp_path, monkeypatch):
+    manager = _manager(tmp_path)
+    loads = []
+
+    def slow_load():
+        loads.append(1)
+        time.sleep(0.05)
+        return FakeCredentials()
+    monkeypatch.setattr(manager, '_load', slow_load)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(manager.get_credentials())) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    manager.stop()
+
+    assert len(loads) == 1
+    assert len(results) == 8 and all(creds is results[0] for creds in results)
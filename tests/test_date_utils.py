@@ -0,0 +1,29 @@
+import pytest
+from datetime import datetime, timezone, timedelta
+from date_utils import parse_date
+
+@pytest.mark.parametrize('date_str, expected', [
+    ('Fri, 15 Mar 2024 10:30:00 +0800', datetime(2024, 3, 15, 10, 30, tzinfo=timezone(timedelta(hours=8)))),
+    ('Fri, 15 Mar 2024 02:30:00 +0000 (UTC)', datetime(2024, 3, 15, 2, 30, tzinfo=timezone.utc)),
+    ('2024-03-15', datetime(2024, 3, 15)),
+    ('2024-03-15T10:30:00', datetime(2024, 3, 15, 10, 30)),
+    ('2024年03月15日', datetime(2024, 3, 15)),
+    ('113年3月15日', datetime(2024, 3, 15)),
+    ('2024/03/15', datetime(2024, 3, 15)),
+    ('20240315', datetime(2024, 3, 15)),
+    ('1900-01-02', datetime(1900, 1, 2)),
+    ('19000102', datetime(1900, 1, 2)),
+])
+def test_parse_date_formats(date_str, expected):
+    assert parse_date(date_str) == expected
+
+def test_parse_date_invalid():
+    assert parse_date('') is None
+    assert parse_date('not a date') is None
+    assert parse_date('2024-02-30') is None
+
+def test_parse_date_is_cached():
+    parse_date.cache_clear()
+    parse_date('2024-03-15')
+    parse_date('2024-03-15')
+    assert parse_date.cache_info().hits == 1
@@ -0,0 +1,170 @@
+import queue
+import threading
+import distributed
+from distributed import BrokerSingleFlight, run_coordinator, run_worker
+
+class FakeBroker:
+    """In-process broker; results can be pre-seeded to mimic leftovers of an earlier run."""
+
+    def __init__(self, stale_results=()):
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        for result in stale_results:
+            self.results.put(result)
+        self.ended = False
+        self.prekeys = {}
+        self.flights = {}
+
+    def start_run(self):
+        return 'run-2'
+
+    def end_run(self):
+        self.ended = True
+
+    def put_job(self, job):
+        self.jobs.put(job)
+
+    def get_job(self, timeout=None):
+        return self.jobs.get(timeout=timeout)
+
+    def put_result(self, result):
+        self.results.put(result)
+
+    def get_result(self, timeout=None):
+        return self.results.get(timeout=timeout)
+
+    def set_prekeys(self, counts):
+        self.prekeys = dict(counts)
+
+    def get_prekey_count(self, prekey):
+        return self.prekeys.get(prekey, 0)
+
+    def begin_flight(self, key):
+        if key in self.flights:
+            return False
+        self.flights[key] = distributed.FLIGHT_RUNNING
+        return True
+
+    def get_flight(self, key):
+        return self.flights.get(key)
+
+    def finish_flight(self, key, ok):
+        if ok:
+            self.flights[key] = distributed.FLIGHT_DONE
+        else:
+            self.flights.pop(key, None)
+
+class FakeGmail:
+    def __init__(self, emails):
+        self.emails = emails
+        self.marked = None
+
+    def get_emails_with_attachments(self):
+        return self.emails
+
+    def mark_processed(self, message_ids):
+        self.marked = sorted(message_ids)
+        return len(message_ids)
+
+class FakeProcessor:
+    def _process_attachment(self, email, attachment):
+        return True
+
+def _emails():
+    return [{'message_id': 'm1', 'subject': 'Invoice', 'attachments': [{'id': 'a1', 'filename': 'a.pdf'}]},
+            {'message_id': 'm2', 'subject': 'Invoice', 'attachments': [{'id': 'a2', 'filename': 'b.pdf'}]}]
+
+def _fast_polling(monkeypatch):
+    monkeypatch.setattr(distributed.config, 'SCHEDULER_ENABLED', False)
+    monkeypatch.setattr(distributed.config, 'WORKER_POLL_INTERVAL', 0.01)
+
+def test_stale_and_unknown_results_are_skipped(monkeypatch):
+    _fast_polling(monkeypatch)
+    broker = FakeBroker(stale_results=[
+        {'run_id': 'run-1', 'message_id': 'm1', 'attachment_id': 'a1', 'ok': False},
+        {'run_id': 'run-2', 'message_id': 'old', 'attachment_id': 'x', 'ok': True},
+    ])
+    gmail = FakeGmail(_emails())
+    worker = threading.Thread(target=run_worker, args=(broker, FakeProcessor()))
+    worker.start()
+
+    summary = run_coordinator(broker, 1, gmail_service=gmail)
+    worker.join(timeout=5)
+
+    assert not worker.is_alive()
+    assert summary['succeeded'] == 2 and summary['failed'] == 0 and summary['lost'] == 0
+    assert gmail.marked == ['m1', 'm2']
+    assert broker.ended
+
+def test_coordinator_stops_waiting_when_workers_are_dead(monkeypatch):
+    _fast_polling(monkeypatch)
+    broker = FakeBroker()
+    gmail = FakeGmail(_emails())
+
+    summary = run_coordinator(broker, 1, gmail_service=gmail, workers_alive=lambda: False)
+
+    assert summary['lost'] == 2
+    assert gmail.marked == []
+
+def test_coordinator_gives_up_after_result_timeout(monkeypatch):
+    _fast_polling(monkeypatch)
+    monkeypatch.setattr(distributed.config, 'WORKER_RESULT_TIMEOUT', 0.05)
+    broker = FakeBroker()
+
+    summary = run_coordinator(broker, 1, gmail_service=FakeGmail(_emails()))
+
+    assert summary['lost'] == 2
+
+def test_worker_exits_on_stop_event_without_a_stop_job(monkeypatch):
+    _fast_polling(monkeypatch)
+    broker = FakeBroker()
+    stop_event = threading.Event()
+    worker = threading.Thread(target=run_worker, args=(broker, FakeProcessor(), stop_event))
+    worker.start()
+
+    broker.put_job({'run_id': 'run-2', 'email': {'message_id': 'm1'}, 'attachment': {'id': 'a1'}})
+    assert broker.get_result(timeout=5) == {'run_id': 'run-2', 'message_id': 'm1',
+                                            'attachment_id': 'a1', 'ok': True}
+    stop_event.set()
+    worker.join(timeout=5)
+
+    assert not worker.is_alive()
+    assert broker.jobs.empty()
+
+def test_coordinator_registers_copies_for_all_workers(monkeypatch):
+    _fast_polling(monkeypatch)
+    broker = FakeBroker()
+    emails = _emails()
+    for email in emails:
+        email['attachments'][0].update(size=100, mimeType='application/pdf')
+
+    run_coordinator(broker, 0, gmail_service=FakeGmail(emails), workers_alive=lambda: False)
+
+    # Each worker builds its own BrokerSingleFlight over the shared broker
+    assert BrokerSingleFlight(broker).may_have_copies({'size': 100, 'mimeType': 'application/pdf'})
+    assert not BrokerSingleFlight(broker).may_have_copies({'size': 200, 'mimeType': 'application/pdf'})
+
+def test_copies_in_other_workers_reuse_the_leader_result(monkeypatch):
+    _fast_polling(monkeypatch)
+    broker = FakeBroker()
+    leader_flights, copy_flights = BrokerSingleFlight(broker), BrokerSingleFlight(broker)
+    key = leader_flights.copy_key({'filename': 'a.pdf', 'size': 100, 'mimeType': 'application/pdf'})
+
+    flight, leader = leader_flights.begin(key)
+    other, copy_leads = copy_flights.begin(key)
+    assert leader and not copy_leads
+
+    leader_flights.finish(key, flight, True)
+    assert other.wait() is True
+
+def test_failed_leader_in_another_worker_lets_a_copy_lead(monkeypatch):
+    _fast_polling(monkeypatch)
+    broker = FakeBroker()
+    flights = BrokerSingleFlight(broker)
+    flight, _ = flights.begin('abc')
+    other, _ = BrokerSingleFlight(broker).begin('abc')
+
+    flights.finish('abc', flight, False)
+
+    assert other.wait() is None
+    assert BrokerSingleFlight(broker).begin('abc')[1] is True
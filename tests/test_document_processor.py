@@ -39,6 +39,34 @@ def test_extract_invoice_info(document_processor, sample_invoice_text):
     assert '範例企業' in info['seller']
     assert info['amount'] == '3000'
 
+def test_extract_information_skips_ner_when_parties_found(document_processor, sample_invoice_text, monkeypatch):
+    def fail_ner(text):
+        raise AssertionError("NER should not run when the patterns find both parties")
+    monkeypatch.setattr(document_processor, '_run_ner', fail_ner)
+    
+    info = document_processor._extract_information(sample_invoice_text, 'invoice')
+    
+    assert info['seller'] == '範例企業有限公司'
+    assert info['buyer'] == '測試公司'
+
+def test_parse_einvoice_qr(document_processor):
+    # AB12345678, 民國113年03月15日, random 1234, sales 2858 (0xB2A), total 3000 (0xBB8)
+    payload = 'AB12345678' + '1130315' + '1234' + '00000B2A' + '00000BB8' + \
+        '00000000' + '87654321' + 'x' * 24 + ':**********:1:1:1:商品:1:3000'
+    
+    info = document_processor._parse_einvoice_qr(payload)
+    
+    assert info['invoice_number'] == 'AB12345678'
+    assert info['invoice_date'] == '2024-03-15'
+    assert info['amount'] == '3000'
+    assert info['sales_amount'] == '2858'
+    assert info['tax_id'] == '87654321'
+    assert info['buyer_tax_id'] == ''
+
+def test_parse_einvoice_qr_rejects_other_payloads(document_processor):
+    assert document_processor._parse_einvoice_qr('**商品:1:3000') is None
+    assert document_processor._parse_einvoice_qr('https://example.com') is None
+
 def test_pdf_to_images(document_processor, tmp_path):
     # Create a simple PDF file for testing
     pdf_path = tmp_path / "test.pdf"
@@ -57,4 +85,215 @@ def test_perform_ocr(document_processor):
     
     # This should return empty string for fake data
     result = document_processor._perform_ocr(image_data)
-    assert isinstance(result, str) 
\ No newline at end of file
+    assert isinstance(result, str) 
+
+
+def test_qr_invoice_does_not_need_spacy(monkeypatch):
+    processor = DocumentProcessor()
+    qr_info = {'invoice_number': 'AB12345678', 'invoice_date': '2024-03-15',
+               'buyer': '', 'seller': '', 'amount': '3000', 'tax_id': '87654321'}
+    monkeypatch.setattr(processor, '_extract_qr_invoice_info', lambda image_data: dict(qr_info))
+
+    def missing_model(self):
+        raise OSError("Can't find model 'zh_core_web_sm'")
+    monkeypatch.setattr(DocumentProcessor, 'nlp', property(missing_model))
+
+    result = processor.process_document(b'image', 'image/png')
+
+    assert result['document_type'] == 'invoice'
+    assert result['extracted_info'] == qr_info
+
+def _fake_pdf2image(monkeypatch, page_count, rendered):
+    def pdfinfo_from_path(pdf_path, poppler_path=None):
+        return {'Pages': page_count}
+
+    def convert_from_path(pdf_path, output_folder=None, first_page=None, last_page=None, **kwargs):
+        paths = []
+        for page_number in range(first_page, last_page + 1):
+            rendered.append(page_number)
+            page_path = os.path.join(output_folder, f"page-{page_number}.png")
+            with open(page_path, 'wb') as f:
+                f.write(f"page {page_number}".encode())
+            paths.append(page_path)
+        return paths
+
+    monkeypatch.setattr('pdf2image.pdfinfo_from_path', pdfinfo_from_path)
+    monkeypatch.setattr('pdf2image.convert_from_path', convert_from_path)
+
+def test_iter_pdf_pages_renders_one_page_at_a_time(document_processor, monkeypatch):
+    rendered = []
+    _fake_pdf2image(monkeypatch, 5, rendered)
+
+    pages = document_processor._iter_pdf_pages(b'%PDF-1.4\n%EOF')
+    assert next(pages) == b'page 1'
+    pages.close()
+
+    assert rendered == [1]
+
+def test_early_exit_stops_rendering_after_complete_page(document_processor, sample_invoice_text, monkeypatch):
+    rendered = []
+    _fake_pdf2image(monkeypatch, 5, rendered)
+    ocr_calls = []
+    document_processor.region_templates = None
+    monkeypatch.setattr('document_processor.config.OCR_EARLY_EXIT', True)
+    monkeypatch.setattr(document_processor, '_extract_qr_invoice_info', lambda image_data: None)
+    monkeypatch.setattr(document_processor, '_preprocess_image', lambda image_data, region=None: image_data)
+    monkeypatch.setattr(document_processor, '_perform_ocr_layout',
+                        lambda image_data: ocr_calls.append(image_data) or (sample_invoice_text, []))
+
+    result = document_processor.process_document(b'%PDF-1.4\n%EOF', 'application/pdf')
+
+    assert result['extracted_info']['invoice_number'] == 'AB12345678'
+    assert rendered == [1]
+    assert ocr_calls == [b'page 1']
+
+def _ocr_only(processor, monkeypatch, text):
+    processor.region_templates = None
+    monkeypatch.setattr(processor, '_extract_qr_invoice_info', lambda image_data: None)
+    monkeypatch.setattr(processor, '_preprocess_image', lambda image_data, region=None: image_data)
+    monkeypatch.setattr(processor, '_perform_ocr_layout', lambda image_data: (text, []))
+
+def _known_sender(patterns):
+    return {'doc_type': 'invoice', 'hits': 5, 'patterns': patterns, 'vendor_folders': {}}
+
+def test_fast_path_skips_ner(document_processor, sample_invoice_text, monkeypatch):
+    text = sample_invoice_text.replace('買受人：測試公司', '').replace('賣方：範例企業有限公司', '')
+    _ocr_only(document_processor, monkeypatch, text)
+    monkeypatch.setattr(document_processor, '_run_ner', lambda text: pytest.fail("NER ran on the fast path"))
+    profile = _known_sender({'invoice_number': ['invoice_number'], 'invoice_date': ['date_ymd'],
+                             'amount': ['total']})
+
+    result = document_processor.process_document(b'image', 'image/png', profile=profile)
+
+    assert result['extracted_info']['invoice_number'] == 'AB12345678'
+    assert result['matched_patterns'] == {'invoice_number': 'invoice_number',
+                                          'invoice_date': 'date_ymd', 'amount': 'total'}
+
+def test_known_sender_gets_ner_when_fast_path_misses(document_processor, sample_invoice_text, monkeypatch):
+    text = sample_invoice_text.replace('買受人：測試公司', '').replace('賣方：範例企業有限公司', '')
+    _ocr_only(document_processor, monkeypatch, text)
+    ner_calls = []
+
+    class Doc:
+        ents = []
+    monkeypatch.setattr(document_processor, '_run_ner', lambda text: ner_calls.append(text) or Doc())
+    # The sender's layout changed: its remembered amount pattern no longer matches
+    profile = _known_sender({'invoice_number': ['invoice_number'], 'invoice_date': ['date_ymd'],
+                             'amount': ['grand_total']})
+
+    result = document_processor.process_document(b'image', 'image/png', profile=profile)
+
+    assert result['extracted_info']['amount'] == '3000'
+    assert len(ner_calls) == 1
+
+def test_run_ner_disables_other_pipes_per_call(document_processor):
+    class FakeNlp:
+        pipe_names = ['tok2vec', 'tagger', 'parser', 'ner']
+
+        def pipe(self, texts, batch_size=None, n_process=None, disable=()):
+            self.call = (list(texts), list(disable))
+            return iter(['doc'] * len(self.call[0]))
+
+        def select_pipes(self, **kwargs):
+            raise AssertionError("select_pipes changes the pipeline shared by all threads")
+
+    document_processor.nlp = FakeNlp()
+
+    assert document_processor._run_ner('統一發票') == 'doc'
+    assert document_processor.nlp.call == (['統一發票'], ['tagger', 'parser'])
+
+def test_ner_batcher_runs_concurrent_calls_as_one_batch(monkeypatch):
+    import threading
+    from document_processor import NerBatcher
+    monkeypatch.setattr('document_processor.config.NLP_BATCH_WAIT', 5)
+    batches = []
+    batcher = NerBatcher(lambda texts: batches.append(texts) or [t.upper() for t in texts], lambda: 4)
+
+    results = {}
+    threads = [threading.Thread(target=lambda t=t: results.update({t: batcher(t)})) for t in 'abcd']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert results == {'a': 'A', 'b': 'B', 'c': 'C', 'd': 'D'}
+    assert len(batches) == 1 and sorted(batches[0]) == ['a', 'b', 'c', 'd']
+
+def test_apply_batched_ner_pipes_pending_results_together(document_processor, monkeypatch):
+    class Ent:
+        def __init__(self, text):
+            self.text, self.label_ = text, 'ORG'
+
+    class Doc:
+        def __init__(self, text):
+            self.ents = [Ent(text)]
+
+    batches = []
+    monkeypatch.setattr(document_processor, '_pipe_ner',
+                        lambda windows: batches.append(windows) or [Doc(w) for w in windows])
+    results = [
+        {'needs_ner': True, 'extracted_text': '甲公司', 'extracted_info': {'seller': '', 'buyer': ''}},
+        {'needs_ner': False, 'extracted_text': '乙公司', 'extracted_info': {'seller': '乙', 'buyer': '丙'}},
+        None,
+        {'needs_ner': True, 'extracted_text': '丁公司', 'extracted_info': {'seller': '', 'buyer': ''}},
+    ]
+
+    document_processor.apply_batched_ner(results)
+
+    assert batches == [['甲公司', '丁公司']]
+    assert results[0]['extracted_info']['seller'] == '甲公司'
+    assert results[3]['extracted_info']['seller'] == '丁公司'
+    assert not results[0]['needs_ner']
+
+def test_preprocess_keeps_the_processed_frame_even_if_larger(document_processor, monkeypatch):
+    import io
+    from PIL import Image
+    monkeypatch.setattr('document_processor.config.OCR_PREPROCESS', True)
+    monkeypatch.setattr('document_processor.config.OCR_IMAGE_FORMAT', 'JPEG')
+    image = Image.new('L', (400, 200), 255)
+    image.paste(0, (100, 50, 300, 150))
+    output = io.BytesIO()
+    image.save(output, format='PNG')
+
+    processed = document_processor._preprocess_image(output.getvalue())
+
+    # Region templates are learned on this image, so its margins must be cropped
+    # even though the JPEG is larger than the flat PNG it came from
+    assert processed[:2] == b'\xff\xd8'
+    with Image.open(io.BytesIO(processed)) as result:
+        assert result.size == (240, 140)
+
+def test_pymupdf_fallback_closes_the_document(document_processor, monkeypatch):
+    import types
+    import fitz
+
+    def pdfinfo_from_path(pdf_path, poppler_path=None):
+        raise RuntimeError('poppler missing')
+
+    class Page:
+        def get_pixmap(self, dpi=None):
+            return types.SimpleNamespace(tobytes=lambda: b'png')
+
+    class Document:
+        closed = False
+
+        def __init__(self, *args, **kwargs):
+            self.pages = [Page() for _ in range(3)]
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            Document.closed = True
+
+        def __iter__(self):
+            return iter(self.pages)
+
+    monkeypatch.setattr('pdf2image.pdfinfo_from_path', pdfinfo_from_path)
+    monkeypatch.setattr(fitz, 'open', Document)
+
+    pages = document_processor._iter_pdf_pages(b'%PDF-1.4\n%EOF')
+    assert next(pages) == b'png'
+    pages.close()
+
+    assert Document.closed
@@ -0,0 +1,92 @@
+import pytest
+from drive_service import DriveService, DriveIndex, FOLDER_MIME_TYPE
+
+def folder(folder_id, name, parent):
+    return {'id': folder_id, 'name': name, 'mimeType': FOLDER_MIME_TYPE, 'parents': [parent]}
+
+def pdf(file_id, name, parent):
+    return {'id': file_id, 'name': name, 'mimeType': 'application/pdf', 'parents': [parent]}
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+class FakeDrive:
+    """Serves one page of changes and the listing of folders moved into the tree."""
+
+    def __init__(self, changes, children):
+        self._changes = changes
+        self._children = children
+
+    def changes(self):
+        return self
+
+    def files(self):
+        return self
+
+    def list(self, **kwargs):
+        if 'q' in kwargs:
+            parent = kwargs['q'].split("'")[1]
+            return FakeRequest({'files': self._children.get(parent, [])})
+        return FakeRequest({'changes': self._changes, 'newStartPageToken': 'token2'})
+
+@pytest.fixture
+def index():
+    index = DriveIndex('root-id', page_token='token1')
+    index.add(folder('y2024', '2024', 'root-id'))
+    index.add(folder('m03', '03', 'y2024'))
+    index.add(folder('vendor', '範例企業', 'm03'))
+    index.add(pdf('f1', '20240315_範例企業_AB12345678_1000元.pdf', 'vendor'))
+    return index
+
+def test_index_resolves_paths_and_finds_invoices(index):
+    assert index.resolve_path(['2024', '03', '範例企業']) == 'vendor'
+    assert index.resolve_path(['2024', '04']) is None
+    assert index.files_containing('AB12345678', '20240315')
+
+def test_index_round_trips_through_file(index, tmp_path):
+    path = str(tmp_path / 'index.json')
+    index.save(path)
+
+    loaded = DriveIndex.load(path)
+    assert loaded.page_token == 'token1'
+    assert loaded.resolve_path(['2024', '03', '範例企業']) == 'vendor'
+
+def test_apply_changes_handles_rename_delete_and_move_in(index):
+    drive_service = DriveService.__new__(DriveService)
+    drive_service.service = FakeDrive(
+        changes=[
+            {'changeType': 'file', 'fileId': 'vendor', 'file': folder('vendor', '範例企業股份有限公司', 'm03')},
+            {'changeType': 'file', 'fileId': 'f1', 'removed': True},
+            {'changeType': 'file', 'fileId': 'm04', 'file': folder('m04', '04', 'y2024')},
+            {'changeType': 'file', 'fileId': 'elsewhere', 'file': pdf('elsewhere', 'x.pdf', 'other-root')}
+        ],
+        children={'m04': [pdf('f2', 'moved.pdf', 'm04')]}
+    )
+
+    drive_service._apply_changes(index)
+
+    assert index.page_token == 'token2'
+    assert index.resolve_path(['2024', '03', '範例企業股份有限公司']) == 'vendor'
+    assert index.resolve_path(['2024', '03', '範例企業']) is None
+    assert not index.files_containing('AB12345678')
+    assert index.find_file('moved.pdf', 'm04') == 'f2'
+    assert 'elsewhere' not in index
+
+def test_index_lookups_follow_renames_and_removals(index):
+    index.add(pdf('f2', '20240315_範例企業_AB12345678_1000元.pdf', 'vendor'))
+    index.add(pdf('f1', '20240316_範例企業_CD87654321_500元.pdf', 'vendor'))
+
+    assert index.find_file('20240315_範例企業_AB12345678_1000元.pdf', 'vendor') == 'f2'
+    assert index.files_containing('AB12345678', '20240315') == ['20240315_範例企業_AB12345678_1000元.pdf']
+    assert index.files_containing('CD87654321')
+    # Parts must be whole parts of the name, as the live Drive query matches words
+    assert not index.files_containing('AB1234')
+
+    index.remove('f2')
+    assert index.find_file('20240315_範例企業_AB12345678_1000元.pdf', 'vendor') is None
+    assert not index.files_containing('AB12345678')
+    assert index.find_file('20240316_範例企業_CD87654321_500元.pdf', 'other') is None
@@ -0,0 +1,181 @@
+import pytest
+from gmail_service import GmailService
+
+@pytest.fixture
+def gmail_service():
+    # Skip OAuth; the payload helpers never touch the API client
+    return GmailService.__new__(GmailService)
+
+@pytest.fixture
+def nested_message():
+    return {
+        'id': 'msg1',
+        'payload': {
+            'mimeType': 'multipart/mixed',
+            'headers': [
+                {'name': 'Subject', 'value': 'Fwd: 電子發票'},
+                {'name': 'From', 'value': 'vendor@example.com'},
+                {'name': 'Date', 'value': 'Fri, 15 Mar 2024 10:00:00 +0800'}
+            ],
+            'parts': [
+                {
+                    'partId': '0',
+                    'mimeType': 'multipart/alternative',
+                    'filename': '',
+                    'parts': [
+                        {'partId': '0.0', 'mimeType': 'text/plain', 'filename': ''},
+                        {'partId': '0.1', 'mimeType': 'text/html', 'filename': ''}
+                    ]
+                },
+                {
+                    'partId': '1',
+                    'mimeType': 'message/rfc822',
+                    'filename': '',
+                    'parts': [
+                        {
+                            'partId': '1.0',
+                            'mimeType': 'multipart/mixed',
+                            'filename': '',
+                            'parts': [
+                                {
+                                    'partId': '1.0.1',
+                                    'mimeType': 'application/octet-stream',
+                                    'filename': 'invoice.pdf',
+                                    'body': {'attachmentId': 'att1', 'size': 1024}
+                                }
+                            ]
+                        }
+                    ]
+                },
+                {
+                    'partId': '2',
+                    'mimeType': 'image/png',
+                    'filename': 'receipt.png',
+                    'body': {'size': 512}
+                },
+                {
+                    'partId': '3',
+                    'mimeType': 'text/calendar',
+                    'filename': 'invite.ics',
+                    'body': {'attachmentId': 'att3', 'size': 256}
+                }
+            ]
+        }
+    }
+
+def test_has_attachments_finds_nested_parts(gmail_service, nested_message):
+    assert gmail_service._has_attachments(nested_message)
+
+def test_has_attachments_without_filenames(gmail_service):
+    message = {'payload': {'mimeType': 'text/plain', 'filename': ''}}
+    assert not gmail_service._has_attachments(message)
+
+def test_process_email_collects_nested_and_inline_parts(gmail_service, nested_message):
+    email_data = gmail_service._process_email(nested_message)
+
+    assert email_data['subject'] == 'Fwd: 電子發票'
+    attachments = {a['filename']: a for a in email_data['attachments']}
+    # The calendar invite is filtered out by SUPPORTED_MIME_TYPES
+    assert set(attachments) == {'invoice.pdf', 'receipt.png'}
+    assert attachments['invoice.pdf']['id'] == 'att1'
+    assert attachments['invoice.pdf']['mimeType'] == 'application/pdf'
+    assert attachments['receipt.png']['id'] is None
+    assert attachments['receipt.png']['part_id'] == '2'
+
+class FakeBatchModify:
+    """users().messages().batchModify() stand-in; the batch numbers in `fail` raise."""
+
+    def __init__(self, fail=()):
+        self.fail = set(fail)
+        self.batches = []
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def batchModify(self, userId, body):
+        self.batches.append(body)
+        return self
+
+    def execute(self):
+        if len(self.batches) in self.fail:
+            raise RuntimeError('backend error')
+        return {}
+
+def test_mark_processed_batches_and_deduplicates(gmail_service):
+    gmail_service.service = FakeBatchModify()
+    gmail_service._label_id = 'Label_1'
+    ids = [f'msg{i}' for i in range(2500)]
+
+    assert gmail_service.mark_processed(ids + ids[:10]) == 2500
+
+    batches = gmail_service.service.batches
+    assert [len(b['ids']) for b in batches] == [1000, 1000, 500]
+    assert [i for b in batches for i in b['ids']] == ids
+    assert all(b['addLabelIds'] == ['Label_1'] for b in batches)
+
+def test_mark_processed_counts_only_successful_batches(gmail_service):
+    gmail_service.service = FakeBatchModify(fail={2})
+    gmail_service._label_id = 'Label_1'
+
+    assert gmail_service.mark_processed([f'msg{i}' for i in range(2500)]) == 1500
+    assert len(gmail_service.service.batches) == 3
+    assert gmail_service.mark_processed([]) == 0
+
+def test_search_excludes_the_configured_label(gmail_service, monkeypatch):
+    from datetime import datetime
+    monkeypatch.setattr('gmail_service.config.GMAIL_QUERY', 'has:attachment')
+    monkeypatch.setattr('gmail_service.config.GMAIL_LABEL', '已處理 發票')
+    queries = []
+    gmail_service._list_message_ids = lambda query: queries.append(query) or []
+
+    assert gmail_service.get_emails_with_attachments(after=datetime(2024, 3, 1), before=datetime(2024, 3, 2)) == []
+    assert queries[0].startswith('has:attachment -label:"已處理 發票" after:')
+    assert '-label:processed' not in queries[0]
+
+def test_octet_stream_type_is_resolved_from_filename(gmail_service):
+    assert gmail_service._resolve_mime_type(
+        {'mimeType': 'application/octet-stream', 'filename': 'invoice.pdf'}) == 'application/pdf'
+    assert gmail_service._resolve_mime_type(
+        {'mimeType': 'application/octet-stream', 'filename': 'blob'}) == 'application/octet-stream'
+
+def test_oversized_attachment_is_skipped_before_download(gmail_service, monkeypatch):
+    monkeypatch.setattr('gmail_service.config.MAX_FILE_SIZE', 1000)
+    attachment = {'filename': 'invoice.pdf', 'mimeType': 'application/pdf', 'size': 1001}
+
+    assert not gmail_service._is_supported_attachment(attachment)
+    assert gmail_service._is_supported_attachment(dict(attachment, size=1000))
+
+def test_stream_decodes_unpadded_payload_across_chunks(gmail_service, monkeypatch):
+    import base64
+
+    class Request:
+        def __init__(self, result):
+            self.result = result
+
+        def execute(self):
+            return dict(self.result)
+
+    class Attachments:
+        def get(self, userId, messageId, id):
+            return Request({'data': payload})
+
+    class Service:
+        def users(self):
+            return self
+
+        def messages(self):
+            return self
+
+        def attachments(self):
+            return Attachments()
+
+    content = bytes(range(256)) * 3 + b'tail!'
+    payload = base64.urlsafe_b64encode(content).decode('ascii').rstrip('=')
+    monkeypatch.setattr('gmail_service.DECODE_CHUNK_SIZE', 16)
+    gmail_service.service = Service()
+
+    with gmail_service.download_attachment_stream('msg1', 'att1') as buffer:
+        assert bytes(buffer.view) == content
@@ -0,0 +1,31 @@
+import logging
+import threading
+import logging_setup
+from logging_setup import log_context
+
+def test_records_are_written_by_the_listener_with_context(tmp_path, monkeypatch):
+    log_file = tmp_path / 'helper.log'
+    monkeypatch.setattr(logging_setup.config, 'LOG_FILE', str(log_file))
+    monkeypatch.setattr(logging_setup.config, 'LOG_FORMAT', '%(threadName)s %(context)s%(message)s')
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+
+    logging_setup.setup_logging(console=False)
+    try:
+        assert logging_setup.setup_logging(console=False) is logging_setup._listener
+        logger = logging.getLogger('test')
+        with log_context(message='m1', attachment='invoice.pdf'):
+            thread = threading.Thread(target=logger.info, args=('no context in %s', 'a new thread'))
+            thread.start()
+            thread.join()
+            logger.info('uploaded %s', 'invoice.pdf')
+        logger.info('done')
+    finally:
+        logging_setup.stop_logging()
+        root.handlers[:] = handlers
+        root.setLevel(level)
+
+    lines = log_file.read_text(encoding='utf-8').splitlines()
+    assert lines[0].endswith(' no context in a new thread')
+    assert lines[1].endswith(' [message=m1] [attachment=invoice.pdf] uploaded invoice.pdf')
+    assert lines[2].endswith(' done')
@@ -0,0 +1,139 @@
+import io
+import zipfile
+import main
+from attachment_buffer import AttachmentBuffer
+from run_plan import RunPlan
+from sender_profiles import SenderProfileStore
+
+SENDER = 'Vendor <billing@vendor.example>'
+
+class FakeDrive:
+    """get_or_create_folder stand-in; nothing can be created in the `deleted` folders."""
+
+    def __init__(self, deleted=(), index=None):
+        self.deleted = set(deleted)
+        self.index = index
+        self.created = []
+
+    def get_or_create_folder(self, name, parent_folder_id=None):
+        if parent_folder_id in self.deleted:
+            return None
+        self.created.append((name, parent_folder_id))
+        return f"{parent_folder_id}/{name}"
+
+def _processor(tmp_path, drive):
+    processor = main.GmailAttachmentProcessor.__new__(main.GmailAttachmentProcessor)
+    processor.drive_service = drive
+    processor.sender_profiles = SenderProfileStore(str(tmp_path / 'profiles.json'))
+    return processor
+
+PATH = ['2024', '03', '範例企業', '20240315_AB12345678']
+
+def test_stale_vendor_folder_is_replaced(tmp_path):
+    processor = _processor(tmp_path, FakeDrive(deleted={'deleted-vendor-folder'}))
+    profiles = processor.sender_profiles
+    profiles.set_vendor_folder(SENDER, '範例企業', 'None/2024/03', 'deleted-vendor-folder')
+
+    folder = processor._ensure_folder_path(PATH, SENDER, True)
+
+    assert folder == 'None/2024/03/範例企業/20240315_AB12345678'
+    assert profiles.get_vendor_folder(SENDER, '範例企業', 'None/2024/03') == 'None/2024/03/範例企業'
+
+def test_cached_vendor_folder_missing_from_index_is_not_used(tmp_path):
+    # A path ending at the vendor level never tries to create below the stale folder
+    processor = _processor(tmp_path, FakeDrive(index={'None/2024', 'None/2024/03'}))
+    processor.sender_profiles.set_vendor_folder(SENDER, '範例企業', 'None/2024/03', 'deleted-vendor-folder')
+
+    assert processor._ensure_folder_path(PATH[:3], SENDER, True) == 'None/2024/03/範例企業'
+
+def test_extracted_seller_wins_over_remembered_vendor(tmp_path):
+    processor = _processor(tmp_path, FakeDrive())
+    processor.sender_profiles.set_vendor_folder(SENDER, '範例企業', 'None/2024/03', 'vendor-folder')
+    email_info = {'sender': SENDER, 'subject': '電子發票', 'date': 'Fri, 15 Mar 2024 10:00:00 +0800'}
+
+    def vendor(seller):
+        doc_info = {'extracted_info': {'seller': seller, 'invoice_date': '2024-03-15'}}
+        return processor._folder_path(email_info, 'invoice', doc_info)[2]
+
+    assert vendor('另一家公司') == '另一家公司'
+    assert vendor('') == '範例企業'
+
+class FakeIndex:
+    root_id = 'root'
+
+    def find_folder(self, name, parent_id):
+        return f"{parent_id}/{name}"
+
+    def find_file(self, name, parent_id):
+        return None
+
+class FakeApplyDrive:
+    def __init__(self):
+        self.uploaded = []
+
+    def sync_index(self, force=False):
+        return FakeIndex()
+
+    def create_folders_batch(self, folders):
+        return []
+
+    def upload_file(self, file_obj, filename, mime_type, folder_id, metadata=None):
+        self.uploaded.append((filename, file_obj.read(), folder_id))
+        return {'file_id': filename}
+
+class FakeGmail:
+    def __init__(self, data):
+        self.data = data
+        self.downloads = 0
+        self.labelled = None
+
+    def download_attachment_stream(self, message_id, attachment_id, part_id=None):
+        self.downloads += 1
+        buffer = AttachmentBuffer(len(self.data))
+        buffer.write(self.data)
+        return buffer.seal()
+
+    def mark_processed(self, message_ids):
+        self.labelled = list(message_ids)
+        return len(self.labelled)
+
+def test_apply_plan_downloads_each_archive_once(tmp_path):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as zf:
+        zf.writestr('a.pdf', b'%PDF one')
+        zf.writestr('b.pdf', b'%PDF two')
+    gmail = FakeGmail(data.getvalue())
+    processor = _processor(tmp_path, FakeApplyDrive())
+    processor.gmail_service = gmail
+
+    plan = RunPlan()
+    email = {'message_id': 'msg1', 'sender': SENDER}
+    doc_info = {'document_type': 'invoice', 'processed_date': '2024-03-15T10:00:00', 'extracted_info': {}}
+    for name in ('a.pdf', 'b.pdf'):
+        attachment = {'id': 'att1', 'filename': name, 'mimeType': 'application/pdf', 'member': name}
+        plan.add_upload(email, attachment, ['2024', '03', '範例企業'], name, doc_info)
+
+    result = processor.apply_plan(plan)
+
+    assert gmail.downloads == 1
+    assert result['uploaded'] == 2 and result['failed'] == 0
+    assert sorted(upload[:2] for upload in processor.drive_service.uploaded) == [
+        ('a.pdf', b'%PDF one'), ('b.pdf', b'%PDF two')]
+    assert gmail.labelled == ['msg1']
+
+def test_same_named_copy_is_not_downloaded_again(tmp_path):
+    from single_flight import AttachmentSingleFlight
+    gmail = FakeGmail(b'%PDF invoice')
+    processor = _processor(tmp_path, FakeApplyDrive())
+    processor.gmail_service = gmail
+    processor.single_flight = AttachmentSingleFlight()
+    processed = []
+    processor._process_attachment_data = lambda email, attachment, buffer: processed.append(email) or True
+
+    attachment = {'id': 'att', 'filename': 'invoice.pdf', 'mimeType': 'application/pdf', 'size': 12}
+    emails = [{'message_id': f"msg{i}", 'attachments': [dict(attachment)]} for i in range(2)]
+    processor.single_flight.register(emails)
+
+    assert all(processor._process_attachment(email, email['attachments'][0]) for email in emails)
+    assert gmail.downloads == 1
+    assert len(processed) == 1
@@ -0,0 +1,150 @@
+import sys
+import types
+from concurrent.futures import Future
+import ocr_backends
+from ocr_backends import NO_TEXT, OcrRouter, TesseractOcr, _join_words, _tesseract_recognize
+
+class FakeOcr:
+    def __init__(self, name, result, available=True):
+        self.name = name
+        self.result = result
+        self._available = available
+        self.calls = 0
+
+    def available(self):
+        return self._available
+
+    def recognize(self, image_data):
+        self.calls += 1
+        return self.result
+
+def _router(local_result, cloud_available=True, mode='auto'):
+    local = FakeOcr('tesseract', local_result)
+    cloud = FakeOcr('vision', ('cloud text', [], None), available=cloud_available)
+    return OcrRouter(mode=mode, local=local, cloud=cloud), local, cloud
+
+def test_confident_local_result_skips_the_cloud():
+    router, local, cloud = _router(('local text', [], 90.0))
+    assert router.recognize(b'page')[0] == 'local text'
+    assert cloud.calls == 0
+
+def test_low_confidence_falls_back_to_the_cloud():
+    router, local, cloud = _router(('l0cal t3xt', [], 40.0))
+    assert router.recognize(b'page')[0] == 'cloud text'
+    assert router.metrics()['fallback'] == 1
+
+def test_cloud_budget_and_missing_credentials_keep_local_results(monkeypatch):
+    monkeypatch.setattr('ocr_backends.config.OCR_CLOUD_BUDGET', 1)
+    router, local, cloud = _router(('l0cal', [], 40.0))
+    assert [router.recognize(b'page')[0] for _ in range(2)] == ['cloud text', 'l0cal']
+
+    router, local, cloud = _router(('l0cal', [], 40.0), cloud_available=False)
+    assert router.recognize(b'page')[0] == 'l0cal'
+
+def test_large_pages_go_straight_to_the_cloud(monkeypatch):
+    monkeypatch.setattr('ocr_backends.config.OCR_LOCAL_MAX_BYTES', 3)
+    router, local, cloud = _router(('local text', [], 90.0))
+    assert router.recognize(b'large page')[0] == 'cloud text'
+    assert local.calls == 0
+
+def test_fixed_modes_never_switch_backends():
+    router, local, cloud = _router(('', [], None), mode='tesseract')
+    assert router.recognize(b'page') == ('', [], None)
+    assert cloud.calls == 0
+
+    router, local, cloud = _router(('local text', [], 90.0), mode='vision')
+    assert router.recognize(b'page')[0] == 'cloud text'
+    assert local.calls == 0
+    assert router.metrics() == {'vision': 1, 'tesseract': 0, 'fallback': 0, 'mode': 'vision'}
+
+def test_auto_without_tesseract_uses_the_cloud():
+    local = FakeOcr('tesseract', ('local text', [], 90.0), available=False)
+    cloud = FakeOcr('vision', ('cloud text', [], None))
+    router = OcrRouter(mode='auto', local=local, cloud=cloud)
+    assert router.recognize(b'page')[0] == 'cloud text'
+    assert local.calls == 0
+
+def test_empty_cloud_fallback_keeps_the_local_result():
+    local = FakeOcr('tesseract', ('l0cal', [], 40.0))
+    cloud = FakeOcr('vision', NO_TEXT)
+    router = OcrRouter(mode='auto', local=local, cloud=cloud)
+    assert router.recognize(b'page')[0] == 'l0cal'
+    assert cloud.calls == 1
+
+class FakePool:
+    """ProcessPoolExecutor stand-in that runs submitted calls in-process."""
+
+    created = []
+
+    def __init__(self, max_workers=None, mp_context=None):
+        self.max_workers = max_workers
+        self.start_method = mp_context.get_start_method()
+        self.shutdown_called = False
+        FakePool.created.append(self)
+
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def shutdown(self):
+        self.shutdown_called = True
+
+def _fake_pytesseract(monkeypatch, data):
+    module = types.ModuleType('pytesseract')
+    module.pytesseract = types.SimpleNamespace(tesseract_cmd=None)
+    module.Output = types.SimpleNamespace(DICT='dict')
+    module.image_to_data = lambda image, lang, output_type: data
+    monkeypatch.setitem(sys.modules, 'pytesseract', module)
+    return module
+
+def _png(width=200, height=100):
+    import io
+    from PIL import Image
+    output = io.BytesIO()
+    Image.new('L', (width, height), 255).save(output, format='PNG')
+    return output.getvalue()
+
+def test_tesseract_runs_pages_in_one_spawned_pool(monkeypatch):
+    FakePool.created = []
+    monkeypatch.setattr(ocr_backends, 'ProcessPoolExecutor', FakePool)
+    _fake_pytesseract(monkeypatch, {
+        'text': ['發', '票', '', 'AB12345678'], 'conf': ['95', '93', '-1', '88'],
+        'block_num': [1, 1, 1, 1], 'par_num': [1, 1, 1, 1], 'line_num': [1, 1, 1, 2],
+        'left': [0, 20, 0, 0], 'top': [0, 0, 0, 50], 'width': [20, 20, 0, 100], 'height': [10, 10, 0, 10]
+    })
+    ocr = TesseractOcr(lang='chi_tra', cmd='tesseract', workers=2)
+
+    text, words, confidence = ocr.recognize(_png())
+    ocr.recognize(_png())
+
+    assert text == '發票\nAB12345678'
+    assert words[2] == ('AB12345678', (0.0, 0.5, 0.5, 0.6))
+    assert confidence == (95 + 93 + 88) / 3
+    assert len(FakePool.created) == 1
+    assert FakePool.created[0].max_workers == 2 and FakePool.created[0].start_method == 'spawn'
+
+    ocr.close()
+    assert FakePool.created[0].shutdown_called
+
+def test_tesseract_failure_returns_no_text(monkeypatch):
+    monkeypatch.setattr(ocr_backends, 'ProcessPoolExecutor', FakePool)
+    _fake_pytesseract(monkeypatch, None)
+    assert TesseractOcr(workers=1).recognize(b'not an image') == NO_TEXT
+
+def test_tesseract_is_unavailable_without_pytesseract(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'pytesseract', None)
+    assert not TesseractOcr().available()
+
+def test_tesseract_recognize_sets_the_binary_path(monkeypatch):
+    module = _fake_pytesseract(monkeypatch, {'text': [], 'conf': [], 'block_num': [], 'par_num': [],
+                                            'line_num': [], 'left': [], 'top': [], 'width': [], 'height': []})
+    assert _tesseract_recognize(_png(), 'chi_tra', '/opt/tesseract') == NO_TEXT
+    assert module.pytesseract.tesseract_cmd == '/opt/tesseract'
+
+def test_join_words_drops_spaces_between_cjk_characters():
+    assert _join_words(['發', '票', '號', '碼', ':', 'AB', '12345678']) == '發票號碼: AB 12345678'
+    assert _join_words(['總計', 'NT$3,000']) == '總計NT$3,000'
@@ -0,0 +1,26 @@
+import json
+import os
+import profiling
+
+def test_profiling_writes_stages_stacks_and_pstats(tmp_path):
+    @profiling.staged('regex')
+    def extract():
+        return sum(range(10000))
+
+    profiling.start(str(tmp_path), sample_interval=0.001, attachment_every=2)
+    for _ in range(3):
+        with profiling.attachment(), profiling.stage('attachment'):
+            extract()
+    summary = profiling.stop()
+
+    assert summary['stages']['regex']['calls'] == 3
+    assert summary['profiled_attachments'] == 2
+    with open(tmp_path / 'stages.json', encoding='utf-8') as f:
+        assert json.load(f)['stages']['attachment']['calls'] == 3
+    assert os.path.exists(tmp_path / 'stacks.collapsed')
+    assert os.path.exists(tmp_path / 'attachments.pstats')
+
+def test_stages_are_free_when_profiling_is_off():
+    assert profiling.stop() is None
+    with profiling.stage('ocr'), profiling.attachment():
+        pass
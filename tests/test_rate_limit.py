@@ -0,0 +1,73 @@
+import time
+import pytest
+from rate_limit import AdaptiveLimiter, RateLimiter, call_with_limits, is_transfer
+
+class Throttled(Exception):
+    code = 429
+
+def test_rate_limiter_spaces_requests_after_burst():
+    limiter = RateLimiter(rate=50, burst=5)
+    started = time.monotonic()
+    for _ in range(10):
+        limiter.acquire()
+    # The 5 requests beyond the burst wait about 1/50 s each
+    assert time.monotonic() - started >= 0.09
+
+def test_adaptive_limit_grows_while_latency_is_flat():
+    limiter = AdaptiveLimiter('test', initial=2, maximum=10)
+    for _ in range(20):
+        # A steady few milliseconds; empty calls would measure timer noise
+        with limiter.track('list'):
+            time.sleep(0.005)
+    assert limiter.limit > 4
+    assert limiter.in_flight == 0
+
+def test_adaptive_limit_backs_off_on_throttling():
+    limiter = AdaptiveLimiter('test', initial=8, maximum=10)
+    with pytest.raises(Throttled):
+        with limiter.track('list'):
+            raise Throttled()
+    assert limiter.limit == 4
+    assert limiter.metrics()['backoffs'] == 1
+
+def test_call_with_limits_retries_throttled_calls(monkeypatch):
+    monkeypatch.setattr('config.RETRY_DELAY', 0)
+    limiter = AdaptiveLimiter('test', initial=4, maximum=10)
+    attempts = []
+
+    def flaky():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise Throttled()
+        return 'ok'
+
+    assert call_with_limits(flaky, adaptive=limiter) == 'ok'
+    assert len(attempts) == 3
+    assert limiter.limit < 4
+
+def test_large_upload_does_not_cut_the_limit():
+    limiter = AdaptiveLimiter('test', initial=8, maximum=10)
+    for _ in range(5):
+        with limiter.track('drive.files.create'):
+            time.sleep(0.005)
+    limit = limiter.limit
+
+    # A resumable upload shares methodId with folder creation but takes far longer
+    with limiter.track('drive.files.create', transfer=True):
+        time.sleep(0.2)
+    assert limiter.limit >= limit
+    assert limiter.metrics()['backoffs'] == 0
+
+    with limiter.track('drive.files.create'):
+        time.sleep(0.2)
+    assert limiter.metrics()['backoffs'] == 1
+
+def test_media_requests_are_transfers():
+    class Request:
+        def __init__(self, methodId, uri='', resumable=None):
+            self.methodId, self.uri, self.resumable = methodId, uri, resumable
+
+    assert is_transfer(Request('drive.files.create', resumable=object()))
+    assert is_transfer(Request('gmail.users.messages.attachments.get'))
+    assert is_transfer(Request('drive.files.get', uri='https://example/files/1?alt=media'))
+    assert not is_transfer(Request('drive.files.create', uri='https://example/files'))
@@ -0,0 +1,51 @@
+import pytest
+from region_templates import RegionTemplateStore
+
+VENDOR = 'billing@vendor.example'
+INFO = {'invoice_number': 'AB12345678', 'amount': '3000', 'tax_id': '12345678'}
+WORDS = [
+    ('AB-12345678', (0.60, 0.05, 0.80, 0.08)),
+    ('12345678', (0.60, 0.10, 0.75, 0.13)),
+    ('NT$3,000', (0.70, 0.20, 0.85, 0.23)),
+    ('商品A', (0.10, 0.50, 0.20, 0.53)),
+]
+
+def test_region_is_used_only_after_min_hits(tmp_path, monkeypatch):
+    monkeypatch.setattr('region_templates.config.REGION_TEMPLATE_MIN_HITS', 2)
+    monkeypatch.setattr('region_templates.config.REGION_TEMPLATE_MARGIN', 0.05)
+    store = RegionTemplateStore(str(tmp_path / 'templates.json'))
+
+    store.learn(VENDOR, WORDS, INFO)
+    assert store.region_for(VENDOR) is None
+
+    store.learn(VENDOR, WORDS, INFO)
+    region = store.region_for(VENDOR)
+    assert region == tuple(store._templates[VENDOR]['region'])
+    assert region == pytest.approx((0.55, 0.0, 0.90, 0.28))
+
+    # Persisted for the next run
+    assert RegionTemplateStore(str(tmp_path / 'templates.json')).region_for(VENDOR) == region
+
+def test_region_is_dropped_after_max_misses(tmp_path, monkeypatch):
+    monkeypatch.setattr('region_templates.config.REGION_TEMPLATE_MIN_HITS', 1)
+    monkeypatch.setattr('region_templates.config.REGION_TEMPLATE_MAX_MISSES', 2)
+    store = RegionTemplateStore(str(tmp_path / 'templates.json'))
+    store.learn(VENDOR, WORDS, INFO)
+
+    store.record_miss(VENDOR)
+    store.record_hit(VENDOR)
+    store.record_miss(VENDOR)
+    assert store.region_for(VENDOR) is not None
+
+    store.record_miss(VENDOR)
+    assert store.region_for(VENDOR) is None
+
+def test_region_covering_most_of_the_page_is_not_kept(tmp_path, monkeypatch):
+    monkeypatch.setattr('region_templates.config.REGION_TEMPLATE_MIN_HITS', 1)
+    store = RegionTemplateStore(str(tmp_path / 'templates.json'))
+    words = [('AB12345678', (0.0, 0.0, 0.1, 0.05)), ('3000', (0.0, 0.0, 0.1, 0.05)),
+             ('12345678', (0.9, 0.9, 1.0, 1.0))]
+
+    store.learn(VENDOR, words, INFO)
+
+    assert store.region_for(VENDOR) is None
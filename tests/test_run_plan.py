@@ -0,0 +1,39 @@
+import pytest
+from run_plan import RunPlan
+
+@pytest.fixture
+def email():
+    return {'message_id': 'msg1', 'sender': 'vendor@example.com'}
+
+@pytest.fixture
+def doc_info():
+    return {'document_type': 'invoice', 'processed_date': '2024-03-15T10:00:00',
+            'extracted_info': {'invoice_number': 'AB12345678'}}
+
+def attachment(attachment_id, size=1024):
+    return {'id': attachment_id, 'mimeType': 'application/pdf', 'filename': 'invoice.pdf', 'size': size}
+
+def test_plan_deduplicates_folders_and_uploads(email, doc_info):
+    plan = RunPlan()
+    path = ['2024', '03', '範例企業']
+    for attachment_id in ('att1', 'att2'):
+        plan.add_folders(path, existing_depth=1)
+        plan.add_upload(email, attachment(attachment_id), path, 'AB12345678.pdf', doc_info)
+
+    assert plan.folders == [['2024', '03'], ['2024', '03', '範例企業']]
+    assert len(plan.uploads) == 1
+    assert plan.duplicates[0]['reason'] == 'duplicate_in_plan'
+
+    summary = plan.summary()
+    assert summary['estimated_api_calls']['drive_folder_batches'] == 2
+    assert summary['estimated_api_calls_total'] < summary['estimated_live_api_calls']
+
+def test_failed_attachment_keeps_message_unlabelled(email, doc_info, tmp_path):
+    plan = RunPlan()
+    plan.add_upload(email, attachment('att1'), ['2024', '03'], 'a.pdf', doc_info)
+    plan.add_failure(email, attachment('att2'), 'extraction_failed')
+    plan.save(tmp_path / 'plan.json')
+
+    loaded = RunPlan.load(tmp_path / 'plan.json')
+    assert loaded.messages == {'msg1': False}
+    assert loaded.summary()['messages_to_label'] == 0
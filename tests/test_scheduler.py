@@ -0,0 +1,28 @@
+from scheduler import AttachmentScheduler, predict_document_type
+
+def _job(subject, filename, size, date='Mon, 04 Mar 2024 10:00:00 +0800'):
+    return {'subject': subject, 'date': date}, {'filename': filename, 'size': size}
+
+def test_predicts_type_from_subject_and_filename():
+    assert predict_document_type(*_job('三月份電子發票', 'scan.pdf', 0)) == 'invoice'
+    assert predict_document_type(*_job('Fwd: documents', 'Service_Agreement.pdf', 0)) == 'contract'
+    assert predict_document_type(*_job('hello', 'photo.jpg', 0)) == 'unknown'
+
+def test_invoices_and_small_files_go_first():
+    scheduler = AttachmentScheduler()
+    contract = _job('合約', 'contract.pdf', 8 * 1024 * 1024)
+    invoice = _job('發票', 'invoice.pdf', 300 * 1024)
+    small = _job('hello', 'note.png', 20 * 1024)
+    for job in (contract, small, invoice):
+        scheduler.push(*job)
+
+    order = [attachment['filename'] for _, attachment in scheduler]
+    assert order == ['invoice.pdf', 'note.png', 'contract.pdf']
+    assert scheduler.pop() is None
+
+def test_old_mail_overtakes_newer_small_files():
+    scheduler = AttachmentScheduler()
+    scheduler.push(*_job('合約', 'old_contract.pdf', 8 * 1024 * 1024, 'Mon, 01 Jan 2024 10:00:00 +0800'))
+    scheduler.push(*_job('發票', 'new_invoice.pdf', 300 * 1024))
+
+    assert scheduler.pop()[1]['filename'] == 'old_contract.pdf'
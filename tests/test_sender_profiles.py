@@ -0,0 +1,64 @@
+import json
+from sender_profiles import SenderProfileStore
+
+SENDER = 'Vendor <Billing@Vendor.example>'
+
+def test_record_learns_patterns_and_restarts_on_new_doc_type(tmp_path):
+    store = SenderProfileStore(str(tmp_path / 'profiles.json'))
+    store.record(SENDER, 'invoice', {'amount': 'total'})
+    store.record(SENDER, 'invoice', {'amount': 'grand_total'})
+
+    profile = store.get('billing@vendor.example')
+    assert profile['hits'] == 2
+    assert profile['patterns'] == {'amount': ['grand_total', 'total']}
+
+    store.record(SENDER, 'quotation')
+    assert store.get(SENDER)['hits'] == 1
+    assert store.get(SENDER)['patterns'] == {}
+
+def test_vendor_folders_are_cached_per_vendor(tmp_path):
+    path = str(tmp_path / 'profiles.json')
+    store = SenderProfileStore(path)
+    store.set_vendor_folder(SENDER, '範例企業', 'month', 'folder-1')
+    store.set_vendor_folder(SENDER, '範例企業台北分公司', 'month', 'folder-2')
+
+    assert store.get_vendor_folder(SENDER, '範例企業', 'month') == 'folder-1'
+    assert store.get_vendor_folder(SENDER, '範例企業台北分公司', 'month') == 'folder-2'
+    # The latest vendor is remembered, not the first one ever seen
+    assert store.get_vendor(SENDER) == '範例企業台北分公司'
+
+    store.forget_vendor_folder(SENDER, '範例企業', 'month')
+    reloaded = SenderProfileStore(path)
+    assert reloaded.get_vendor_folder(SENDER, '範例企業', 'month') is None
+    assert reloaded.get_vendor_folder(SENDER, '範例企業台北分公司', 'month') == 'folder-2'
+
+def test_folder_ids_not_keyed_by_vendor_are_dropped_on_load(tmp_path):
+    path = tmp_path / 'profiles.json'
+    path.write_text(json.dumps({'billing@vendor.example': {
+        'doc_type': 'invoice', 'hits': 3, 'patterns': {}, 'vendor': '範例企業',
+        'vendor_folders': {'month': 'folder-1'}}}), encoding='utf-8')
+
+    store = SenderProfileStore(str(path))
+
+    assert store.get_vendor_folder(SENDER, '範例企業', 'month') is None
+    assert store.get(SENDER)['hits'] == 3
+
+def test_worker_files_are_merged_without_losing_updates(tmp_path):
+    path = str(tmp_path / 'profiles.json')
+    SenderProfileStore(path).set_vendor_folder('Old <old@vendor.example>', '舊企業', 'month', 'folder-0')
+
+    first = SenderProfileStore(path, save_path=f"{path}.worker-1")
+    second = SenderProfileStore(path, save_path=f"{path}.worker-2")
+    first.record(SENDER, 'invoice', {'amount': 'total'})
+    first.set_vendor_folder(SENDER, '範例企業', 'month-1', 'folder-1')
+    second.set_vendor_folder(SENDER, '範例企業', 'month-2', 'folder-2')
+    second.record('Other <other@vendor.example>', 'quotation')
+
+    assert SenderProfileStore.merge_worker_files(path) == 2
+
+    store = SenderProfileStore(path)
+    assert store.get_vendor_folder(SENDER, '範例企業', 'month-1') == 'folder-1'
+    assert store.get_vendor_folder(SENDER, '範例企業', 'month-2') == 'folder-2'
+    assert store.get('other@vendor.example')['doc_type'] == 'quotation'
+    assert store.get_vendor_folder('old@vendor.example', '舊企業', 'month') == 'folder-0'
+    assert list(tmp_path.iterdir()) == [tmp_path / 'profiles.json']
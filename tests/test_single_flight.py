@@ -0,0 +1,40 @@
+import threading
+from single_flight import AttachmentSingleFlight
+
+def _email(*sizes):
+    return {'attachments': [{'size': size, 'mimeType': 'application/pdf'} for size in sizes]}
+
+def test_prekey_skips_attachments_without_possible_copies():
+    flights = AttachmentSingleFlight()
+    flights.register([_email(100, 200), _email(100)])
+
+    assert flights.may_have_copies({'size': 100, 'mimeType': 'application/pdf'})
+    assert not flights.may_have_copies({'size': 200, 'mimeType': 'application/pdf'})
+    assert not flights.may_have_copies({'size': 100, 'mimeType': 'image/png'})
+
+def test_copies_wait_for_the_leader_result():
+    flights = AttachmentSingleFlight()
+    flight, leader = flights.begin('abc')
+    assert leader
+
+    results = []
+    def copy():
+        other, is_leader = flights.begin('abc')
+        results.append((is_leader, other.wait()))
+    threads = [threading.Thread(target=copy) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    flights.finish('abc', flight, True)
+    for thread in threads:
+        thread.join()
+
+    assert results == [(False, True)] * 3
+    assert flights.begin('abc')[1] is False
+
+def test_failed_leader_lets_the_next_copy_lead():
+    flights = AttachmentSingleFlight()
+    flight, _ = flights.begin('abc')
+    flights.finish('abc', flight, False)
+
+    assert flight.wait() is None
+    assert flights.begin('abc')[1] is True
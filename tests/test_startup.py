@@ -0,0 +1,26 @@
+import os
+import subprocess
+import sys
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_importing_run_does_not_load_heavy_libraries():
+    heavy = ['google.cloud.vision', 'spacy', 'fitz', 'pdf2image', 'PIL.Image', 'googleapiclient.discovery']
+    code = f"import sys, run; print(','.join(m for m in {heavy!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == ''
+
+def test_tesseract_backend_does_not_need_vision_credentials(tmp_path, monkeypatch):
+    import run
+
+    monkeypatch.setattr(run.config, 'GOOGLE_APPLICATION_CREDENTIALS', str(tmp_path / 'missing.json'))
+    for backend in ('tesseract', 'auto'):
+        monkeypatch.setattr(run.config, 'OCR_BACKEND', backend)
+        run.check_dependencies()
+
+    monkeypatch.setattr(run.config, 'OCR_BACKEND', 'vision')
+    with pytest.raises(FileNotFoundError):
+        run.check_dependencies()
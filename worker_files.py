@@ -0,0 +1,58 @@
+import glob
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+def worker_path(path):
+    """Return the file a worker process saves its copy of the JSON store at `path` to."""
+    return f"{path}.worker-{os.getpid()}"
+
+def worker_files(path):
+    # Skip the temporary files of saves still in progress
+    return sorted(p for p in glob.glob(f"{glob.escape(path)}.worker-*") if not p.endswith('.tmp'))
+
+def merge_worker_files(path, entries, merge_entry=None):
+    """Fold the workers' copies of a JSON store into `entries`, loaded from `path`.
+
+    Every worker starts from the same file and saves its whole store, so only
+    the keys a worker changed are taken from its copy; keys it deleted are
+    deleted. A key changed by several workers goes to the last copy, or to
+    merge_entry(current, theirs) when given.
+
+    Args:
+        path (str): Path of the shared store
+        entries (dict): The shared store as loaded from `path`, updated in place
+        merge_entry (callable): Optional merge of two versions of one entry
+
+    Returns:
+        list: Paths of the merged worker files, for the caller to remove once saved
+    """
+    base = json.loads(json.dumps(entries))
+    merged = []
+    for part_path in worker_files(path):
+        try:
+            with open(part_path, encoding='utf-8') as f:
+                part = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping unreadable worker file {part_path}: {str(e)}")
+            continue
+        for key in set(base) | set(part):
+            if part.get(key) == base.get(key):
+                continue
+            if key not in part:
+                entries.pop(key, None)
+            elif merge_entry and key in entries:
+                entries[key] = merge_entry(entries[key], part[key])
+            else:
+                entries[key] = part[key]
+        merged.append(part_path)
+    return merged
+
+def remove_worker_files(paths):
+    for part_path in paths:
+        try:
+            os.remove(part_path)
+        except OSError as e:
+            logger.warning(f"Error removing worker file {part_path}: {str(e)}")